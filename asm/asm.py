@@ -13,9 +13,33 @@
 #  DB 0x0a   ; a hex byte
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
+#
+# Writing to a file that ends in .ls8b makes a binary image (raw bytes with a
+# header holding the entry point, the symbol table and a source map) instead
+# of the .ls8 text format.
+#
+# -s (--stream) writes the output while the input is still being read, so
+# generated code can be piped straight through to the emulator.
+#
+# -O (--optimize) runs the peephole optimizer, see peephole().
+#
+# -c (--object) writes a relocatable object file (.ls8o) instead, for programs
+# split over many source files. Labels other files can use are marked with
+#
+#  GLOBAL Label1
+#
+# and ./link puts the objects together into the final program, see link().
+#
+# From Python: asm.assemble(source) returns a Program (the code as bytes, the
+# symbol table and the source map), see there.
 
+import os
 import sys
 import re
+import json
+import struct
+import hashlib
+from collections import namedtuple, deque
 
 # Opcodes
 OPCODES = {
@@ -55,20 +79,86 @@ OPCODES = {
     "XOR":  {"type": 2, "code": "10101011"},
 }
 
-# Regex for matching lines
-# Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
 
-# Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+# Opcode byte values, so the code isn't converted from the binary strings above for every instruction
+OPCODE_BYTES = {name: int(info["code"], 2) for name, info in OPCODES.items()}
+
+# Regex for matching lines, the only one every line goes through
+# Capturing groups: label, opcode, operands (everything after the opcode, the data of DS/DB), operandA, operandB
+LINE_REGEX = re.compile(r"(?:(\w+?):)?\s*(?:(\w+)\s*((?:(\w+)(?:\s*,\s*(\w+))?)?.*))?")
+
+# Regex for register operands
+REGISTER_REGEX = re.compile(r"R([0-7])")
+
+# Binary image format, must match ls8/image.py
+# header: magic, format version, entry point, code length, number of symbols, number of source map entries
+IMAGE_HEADER = struct.Struct("<4sBBHHH")
+IMAGE_SYMBOL = struct.Struct("<BB")
+IMAGE_SOURCE_LINE = struct.Struct("<BH")
+IMAGE_MAGIC = b"LS8I"
+IMAGE_VERSION = 1
+
+# Every byte as 8 binary digits, for the .ls8 text output
+BITS = [f"{v:08b}" for v in range(256)]
+
+
+# Changes whenever this file does, part of the assemble() cache key
+with open(__file__, "rb") as f:
+    VERSION = hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+class AsmError(Exception):
+    """Something wrong with the source, status is the exit code asm.py uses for it"""
+
+    def __init__(self, message, status=2):
+        super().__init__(message)
+        self.status = status
+
+
+# What parse() yields, see there
+Label = namedtuple("Label", ["name", "line_num"])
+Emit = namedtuple("Emit", ["line_num", "units", "opcode"])
+Export = namedtuple("Export", ["name", "line_num"])
+
+
+class Code:
+    """
+    Intermediate representation of the program between pass 1 and pass 2
+
+    * bytes: the machine code, symbols are 0 until pass 2 patches them
+    * fixups: (offset, symbol, line number) of every byte that holds a symbol
+    * comments: offset -> comment for the .ls8 text output, e.g. "LDI R0,10"
+    * labels: offset -> labels defined there, in source order
+    * source_map: offset -> source line number of each instruction
+    * exports: (label, line number) of every GLOBAL
+    * saved_bytes, saved_cycles: what the peephole optimizer saved
+    """
+
+    def __init__(self):
+        self.bytes = bytearray()
+        self.fixups = []
+        self.comments = {}
+        self.labels = {}
+        self.source_map = {}
+        self.exports = []
+        self.saved_bytes = 0
+        self.saved_cycles = 0
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-s|--stream] [-O|--optimize] [-c|--object] [inputfile] [outputfile]
+
+    Returns (inputfile, outputfile, options), options is the set of flags
+    given ("stream", "optimize", "object").
     """
 
+    # Flags can go anywhere
+    flags = {"-s": "stream", "--stream": "stream", "-O": "optimize", "--optimize": "optimize",
+             "-c": "object", "--object": "object"}
+    options = {flags[arg] for arg in argv[1:] if arg in flags}
+    argv = argv[:1] + [arg for arg in argv[1:] if arg not in flags]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,10 +172,18 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-s|--stream] [-O|--optimize] [-c|--object] [infile.asm] [outfile.ls8]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    if {"stream", "optimize"} <= options:
+        print("-O needs the whole program, it can't be used with -s", file=sys.stderr)
+        sys.exit(1)
+
+    if {"stream", "object"} <= options:
+        print("-c can't be used with -s", file=sys.stderr)
+        sys.exit(1)
+
+    return inputfile, outputfile, options
 
 
 def open_files(inputfile, outputfile):
@@ -101,302 +199,896 @@ def open_files(inputfile, outputfile):
 
     if outputfile == "-":
         outputfile = sys.stdout
+    elif outputfile.endswith(".ls8b"):
+        outputfile = open(outputfile, "wb")
     else:
         outputfile = open(outputfile, "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
+def p8(v):
+    return BITS[v]
+
+
+def parse(inputfile):
     """
-    Takes match groups and uppercases them if they're not None.
+    Read the source code lines one at a time and yield what each one
+    produces, without keeping anything from the lines before:
+
+    * Label(name, line_num) for a label
+    * Emit(line_num, units, opcode) for an instruction or DS/DB, where units is
+      one (value, symbol, comment) per output byte. symbol is None unless the
+      byte is the address of a label, then value is 0 until it's known.
+      opcode is the instruction name, None for DS/DB.
+    * Export(name, line_num) for GLOBAL name
     """
 
-    result = []
+    # Source line number
+    line_num = 0
+
+    def get_reg(op):
+        """Get a register number from a string, e.g. "R2" -> 2"""
 
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
+        m = REGISTER_REGEX.match(op)
 
-    return result
+        if m is None:
+            raise AsmError(f"Line {line_num}: unknown register {op}", 1)
+
+        return int(m.group(1))
 
+    def check_ops_count(opcode, desired, found):
+        # Makes sure we have right operand count
+        if found < desired:
+            raise AsmError(f"Line {line_num}: missing operand to {opcode}", 1)
+        elif found > desired:
+            raise AsmError(f"Line {line_num}: unexpected operand to {opcode}", 1)
 
-def p8(v):
-    return "{:08b}".format(v)
+    def handle_ds(data):
+        """
+        Handle DS pseudo-opcode
+        """
+
+        if not data:
+            raise AsmError(f"line {line_num}: missing argument to DS", 2)
+
+        return [(ord(char) & 0xff, None, '[space]' if char == ' ' else char) for char in data]
+
+    def handle_db(data):
+        """
+        Handle the DB pseudo-opcode
+        """
+
+        if not data:
+            raise AsmError(f"line {line_num}: missing argument to DB", 2)
+
+        try:
+            val = int(data, 0)
+
+        except ValueError:
+            raise AsmError(f"line {line_num}: invalid integer argument to DB", 2)
+
+        # Force to byte size
+        return [(val & 0xff, None, data)]
+
+    for line in inputfile:
+        line_num += 1
+
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
+
+        # Normalize
+        line = line.strip()
+
+        # Ignore blank lines
+        if line == '':
+            continue
+
+        m = LINE_REGEX.match(line)
+
+        if m is None:
+            raise AsmError(f"No match: {line}", 3)
+
+        label, opcode, operands, op_a, op_b = m.groups()
+
+        if label is not None:
+            yield Label(label.upper(), line_num)
+
+        if opcode is None:
+            continue
+
+        opcode = opcode.upper()
+
+        if opcode == 'DS':
+            yield Emit(line_num, handle_ds(operands), None)
+            continue
+        elif opcode == 'DB':
+            yield Emit(line_num, handle_db(operands), None)
+            continue
+        elif opcode == 'GLOBAL':
+            check_ops_count(opcode, 1, (op_a is not None) + (op_b is not None))
+            yield Export(op_a.upper(), line_num)
+            continue
+
+        # Make sure we know this opcode at all
+        if opcode not in OPCODES:
+            raise AsmError(f"line {line_num}: unknown opcode {opcode}", 2)
+
+        op_type = OPCODES[opcode]["type"]
+        total_operands = (op_a is not None) + (op_b is not None)
+
+        # Type 8 is LDI r,i or LDI r,label
+        check_ops_count(opcode, 2 if op_type == 8 else op_type, total_operands)
+
+        if op_a is not None:
+            op_a = op_a.upper()
+        if op_b is not None:
+            op_b = op_b.upper()
+
+        if op_type == 0:
+            units = [(OPCODE_BYTES[opcode], None, opcode)]
+
+        elif op_type == 1:
+            units = [(OPCODE_BYTES[opcode], None, f"{opcode} {op_a}"),
+                     (get_reg(op_a), None, None)]
+
+        elif op_type == 2:
+            units = [(OPCODE_BYTES[opcode], None, f"{opcode} {op_a},{op_b}"),
+                     (get_reg(op_a), None, None),
+                     (get_reg(op_b), None, None)]
+
+        elif op_type == 8:
+            try:
+                value = (int(op_b, 0) & 0xff, None, None)
+
+            except ValueError:
+                # If it's not a value, it might be a symbol
+                value = (0, op_b, None)
+
+            units = [(OPCODE_BYTES[opcode], None, f"{opcode} {op_a},{op_b}"),
+                     (get_reg(op_a), None, None),
+                     value]
+
+        yield Emit(line_num, units, opcode)
+
+
+# Registers each instruction reads and writes, for the peephole optimizer.
+# "a" and "b" are the operands. Instructions that aren't here (jumps, CALL,
+# RET, INT, IRET, HLT) can go anywhere, so every register counts as read.
+ALU_OPS = ("ADD", "AND", "DIV", "MOD", "MUL", "OR", "SHL", "SHR", "SUB", "XOR")
+EFFECTS = {op: ("ab", "a") for op in ALU_OPS}
+EFFECTS.update({
+    "CMP": ("ab", ""),
+    "DEC": ("a", "a"),
+    "INC": ("a", "a"),
+    "NOT": ("a", "a"),
+    "LD": ("b", "a"),
+    "LDI": ("", "a"),
+    "ST": ("ab", ""),
+    "PRN": ("a", ""),
+    "PRA": ("a", ""),
+    "PUSH": ("a", ""),
+    "POP": ("", "a"),
+    "NOP": ("", ""),
+})
+
+# Conditional jumps fall through to the next instruction
+CONDITIONAL_JUMPS = ("JEQ", "JGE", "JGT", "JLE", "JLT", "JNE")
+
+# IM, IS and SP, the hardware looks at them, so loads into them always stay
+ALL_REGISTERS = frozenset(range(8))
+SPECIAL_REGISTERS = frozenset((5, 6, 7))
+
+
+def instruction(opcode, *operands):
+    """Emit units for an instruction the optimizer makes up, operands are register numbers"""
+
+    text = ",".join(f"R{r}" for r in operands)
+    units = [(OPCODE_BYTES[opcode], None, f"{opcode} {text}")]
+    units.extend((r, None, None) for r in operands)
+    return units
+
+
+def regs(item, which):
+    """Register numbers of item's operands named in which ("a", "b" or "ab")"""
+
+    return {item.units[1 + "ab".index(operand)][0] for operand in which}
+
+
+def loaded(item):
+    """What an LDI loads, the symbol or the number"""
+
+    value, symbol, _ = item.units[2]
+    return value if symbol is None else symbol
+
+
+def is_op(item, opcode):
+    return isinstance(item, Emit) and item.opcode == opcode
+
+
+def peephole(items):
+    """
+    Optional optimizer between parsing and pass 1, so addresses aren't
+    given out yet and removing code needs no fixing up.
+
+    * JMP chains: an LDI Rn,L1 + JMP Rn that lands on LDI Rn,L2 + JMP Rn
+      loads L2 straight away
+    * PUSH Rn right before POP Rn: both go
+    * ADD/SUB Rn,Rm when Rm is known to hold 1: INC/DEC Rn
+    * LDI Rn,x when Rn already holds x, or when Rn gets written again before
+      anything reads it: removed
+
+    Nothing is moved across a label or data, those can be jumped to.
+    Returns (items, bytes saved, cycles saved), cycles are counted once for
+    every instruction removed, whatever number of times it would have run.
+    """
+
+    items = list(items)
+    size = sum(len(item.units) for item in items if isinstance(item, Emit))
+    cycles = jump_chains(items)
+
+    while True:
+        before = len(items)
+        items, removed = fold(items)
+        cycles += removed
+        items, removed = dead_loads(items)
+        cycles += removed
+
+        if len(items) == before:
+            break
+
+    saved = size - sum(len(item.units) for item in items if isinstance(item, Emit))
+    return items, saved, cycles
+
+
+def jump_chains(items):
+    """Points every LDI Rn,label + JMP Rn at the end of its chain, returns cycles saved"""
+
+    # Index of the first instruction after each label
+    targets = {}
+    for index, item in enumerate(items):
+        if isinstance(item, Label):
+            following = index + 1
+            while following < len(items) and isinstance(items[following], Label):
+                following += 1
+            targets[item.name] = following
+
+    def jump_at(index):
+        """(register, label) if an LDI Rn,label + JMP Rn starts at index"""
+
+        if index + 1 >= len(items):
+            return None
+
+        load, jump = items[index], items[index + 1]
+        if not (is_op(load, "LDI") and is_op(jump, "JMP") and load.units[2][1] is not None):
+            return None
+
+        register = load.units[1][0]
+        if jump.units[1][0] != register:
+            return None
+
+        return register, load.units[2][1]
+
+    saved = 0
 
+    for index, item in enumerate(items):
+        jump = jump_at(index)
+        if jump is None:
+            continue
+
+        register, label = jump
+        seen = {label}
+        hops = 0
+
+        while label in targets:
+            following = jump_at(targets[label])
+            if following is None or following[0] != register or following[1] in seen:
+                break
+            label = following[1]
+            seen.add(label)
+            hops += 1
+
+        if hops:
+            opcode, _, _ = item.units[0]
+            items[index] = item._replace(units=[(opcode, None, f"LDI R{register},{label}"),
+                                                item.units[1],
+                                                (0, label, None)])
+            saved += 2 * hops
+
+    return saved
+
+
+def fold(items):
+    """
+    One pass forward through the code, keeping track of the registers that
+    hold a known value. Returns (items, instructions removed).
+    """
+
+    out = []
+    known = {}
+    removed = 0
+
+    for item in items:
+        if not isinstance(item, Emit) or item.opcode is None:
+            known.clear()
+            out.append(item)
+            continue
+
+        opcode = item.opcode
+
+        if opcode == "LDI":
+            register = item.units[1][0]
+            value = loaded(item)
+
+            if register not in SPECIAL_REGISTERS and known.get(register) == value:
+                removed += 1
+                continue
+
+            known[register] = value
+
+        elif opcode == "POP" and out and is_op(out[-1], "PUSH") \
+                and out[-1].units[1][0] == item.units[1][0] not in SPECIAL_REGISTERS:
+            out.pop()
+            removed += 2
+            continue
+
+        elif opcode in ("ADD", "SUB"):
+            a, b = item.units[1][0], item.units[2][0]
+
+            if a != b and known.get(b) == 1:
+                opcode = "INC" if opcode == "ADD" else "DEC"
+                item = item._replace(units=instruction(opcode, a), opcode=opcode)
+
+        if item.opcode in EFFECTS:
+            for register in regs(item, EFFECTS[item.opcode][1]):
+                known.pop(register, None)
+            if item.opcode == "LDI":
+                known[item.units[1][0]] = loaded(item)
+        elif item.opcode not in CONDITIONAL_JUMPS:
+            known.clear()
+
+        out.append(item)
+
+    return out, removed
+
+
+def dead_loads(items):
+    """
+    Removes every LDI whose register is written again before anything reads
+    it, walking each stretch of code between labels backwards.
+    Returns (items, instructions removed).
+    """
+
+    out = []
+    live = ALL_REGISTERS
+    removed = 0
+
+    for item in reversed(items):
+        if not isinstance(item, Emit) or item.opcode is None:
+            live = ALL_REGISTERS
+            out.append(item)
+            continue
+
+        if item.opcode == "LDI" and item.units[1][0] not in live:
+            removed += 1
+            continue
+
+        if item.opcode in EFFECTS:
+            reads, writes = EFFECTS[item.opcode]
+            live = (live - regs(item, writes)) | regs(item, reads) | SPECIAL_REGISTERS
+        else:
+            live = ALL_REGISTERS
 
-def pass1(inputfile, sym, code):
+        out.append(item)
+
+    out.reverse()
+    return out, removed
+
+
+def pass1(inputfile, sym, code, optimize=False):
     """
     Pass 1
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
+    * Parse the source code (see parse())
+    * Run the peephole optimizer over it if optimize is on
     * Record label offsets
-    * Emit machine code
+    * Emit machine code bytes into code (a Code), with a fixup for each symbol
     """
 
-    # Source line number
-    line_num = 0
+    out = code.bytes
+    items = exports(parse(inputfile), code.exports)
 
-    # Current code address (for labels)
-    addr = 0
+    if optimize:
+        items, code.saved_bytes, code.saved_cycles = peephole(items)
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
+    for item in items:
+        # The current code address is always the length of the output
+        if isinstance(item, Label):
+            sym[item.name] = len(out)
+            code.labels.setdefault(len(out), []).append(item.name)
+            continue
 
-        nonlocal line_num
+        code.source_map[len(out)] = item.line_num
 
-        m = re.match(r"R([0-7])", op)
+        for value, symbol, comment in item.units:
+            if comment is not None:
+                code.comments[len(out)] = comment
+            if symbol is not None:
+                code.fixups.append((len(out), symbol, item.line_num))
+            out.append(value)
 
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+
+def exports(items, found):
+    """Takes the GLOBALs out of the parse() items, adding (name, line number) to found"""
+
+    for item in items:
+        if isinstance(item, Export):
+            found.append(tuple(item))
+        else:
+            yield item
+
+
+def pass2(sym, code):
+    """
+    Patch every symbol into the machine code, straight from the fixups list.
+    """
+
+    for offset, s, line_num in code.fixups:
+        if s in sym:
+            if sym[s] > 0xff:
+                raise AsmError(f"line {line_num}: address of {s} ({sym[s]}) doesn't fit in 8 bits", 2)
+
+            code.bytes[offset] = sym[s]
+
+        else:
+            raise AsmError(f"unknown symbol: {s}", 2)
+
+
+class Program(namedtuple("Program", ["code", "symbols", "source_map", "comments", "labels", "saved"],
+                         defaults=((0, 0),))):
+    """
+    An assembled program, what assemble() returns
+
+    * code: the machine code (bytes)
+    * symbols: label -> address
+    * source_map: address -> source line number of each instruction
+    * comments, labels: what the .ls8 text output shows next to the bytes, see Code
+    * saved: (bytes, cycles) the peephole optimizer saved
+    """
+
+    __slots__ = ()
+
+    def text(self):
+        """The program in the .ls8 text format, one byte per line with the source as comments"""
+
+        lines = []
+        comments = self.comments
+        labels = self.labels
+
+        for offset, byte in enumerate(self.code):
+            for label in labels.get(offset, ()):
+                lines.append(f"# {label} (address {offset}):\n")
+
+            comment = comments.get(offset)
+            if comment is None:
+                lines.append(BITS[byte] + "\n")
             else:
-                return None
+                lines.append(f"{BITS[byte]} # {comment}\n")
 
-        return int(m.group(1))
+        # Labels after the last byte
+        for label in labels.get(len(self.code), ()):
+            lines.append(f"# {label} (address {len(self.code)}):\n")
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
+        return "".join(lines)
 
-        nonlocal addr
+    def image(self):
+        """The program as a binary image (.ls8b)"""
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+        if len(self.code) > 256:
+            raise AsmError(f"program is {len(self.code)} bytes, it doesn't fit in 256 bytes of RAM", 2)
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+        parts = [IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, 0, len(self.code), len(self.symbols),
+                                   len(self.source_map)),
+                 self.code]
 
-        nonlocal addr
+        for name, address in self.symbols.items():
+            name = name.encode()
+            parts.append(IMAGE_SYMBOL.pack(address, len(name)) + name)
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+        for address, line in sorted(self.source_map.items()):
+            parts.append(IMAGE_SOURCE_LINE.pack(address, line))
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+        return b"".join(parts)
 
-        nonlocal addr
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+def assemble(source, cache=None, optimize=False):
+    """
+    Assemble source (a string, or lines like an open file) and return a Program.
+    optimize runs the peephole optimizer (see peephole()).
+    Raises AsmError if there's something wrong with the source.
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+    cache is an optional directory of programs assembled before. They're found
+    by a hash of the source and of this assembler, so a source that didn't
+    change isn't assembled again, and changing the assembler starts over.
+    """
 
-        addr += 3
+    if cache is None:
+        if isinstance(source, str):
+            source = source.splitlines(True)
+        return build(source, optimize)
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+    if not isinstance(source, str):
+        source = "".join(source)
 
-        nonlocal addr
+    key = hashlib.sha256(f"{VERSION}{optimize:d}".encode() + b"\0" + source.encode()).hexdigest()
+    return cached(cache, key, lambda: build(source.splitlines(True), optimize), save_program, load_program)
 
-        reg_a = get_reg(op_a)
 
-        try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+def cached(cache, key, make, save, load):
+    """
+    Returns what's kept under key in the cache directory, or what make()
+    returns after keeping it there. save and load turn it into something json
+    can write and back.
+    """
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+    path = os.path.join(cache, key + ".json")
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+    try:
+        with open(path) as file:
+            return load(json.load(file))
+    except (OSError, ValueError, KeyError, TypeError):
+        # Not there yet (or broken, then it gets written again)
+        pass
 
-        addr += 3
+    result = make()
 
-    def handle_ds(line):
-        """
-        Handle DS pseudo-opcode
-        """
+    os.makedirs(cache, exist_ok=True)
+    # Written under another name first, so nobody reads a half written entry
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as file:
+        json.dump(save(result), file)
+    os.replace(temp, path)
 
-        nonlocal addr
+    return result
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
 
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+def build(lines, optimize=False):
+    """Runs both passes over the source lines, returns the Program"""
 
-        data = m.group(2)
+    sym = {}
+    code = Code()
 
-        for i in range(len(data)):
-            print_char = data[i]
+    pass1(lines, sym, code, optimize)
+    pass2(sym, code)
 
-            if print_char == ' ':
-                print_char = '[space]'
+    return Program(bytes(code.bytes), sym, code.source_map, code.comments, code.labels,
+                   (code.saved_bytes, code.saved_cycles))
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
 
-        addr += len(data)
+def save_program(program):
+    """Program -> something json can write, for the cache"""
 
-    def handle_db(line):
-        """
-        Handle the DB pseudo-opcode
-        """
+    return {
+        "code": program.code.hex(),
+        "symbols": program.symbols,
+        "source_map": program.source_map,
+        "comments": program.comments,
+        "labels": program.labels,
+        "saved": program.saved,
+    }
 
-        nonlocal addr
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+def load_program(data):
+    """Inverse of save_program(), json turned the offsets into strings"""
 
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+    return Program(
+        bytes.fromhex(data["code"]),
+        data["symbols"],
+        {int(offset): line for offset, line in data["source_map"].items()},
+        {int(offset): comment for offset, comment in data["comments"].items()},
+        {int(offset): names for offset, names in data["labels"].items()},
+        tuple(data["saved"]),
+    )
 
-        data = m.group(2)
 
-        try:
-            val = int(data, 0)
+class Object(namedtuple("Object", ["name", "code", "symbols", "exports", "relocations", "source_map", "comments",
+                                   "labels", "saved"])):
+    """
+    A relocatable object, one source file of a bigger program. What
+    assemble_object() returns and link() puts together, its code starts at
+    address 0 until link() moves it.
+
+    * name: the source file, for error messages
+    * code: the machine code, bytes that hold a label address are 0
+    * symbols: label -> offset of every label in it
+    * exports: the labels other objects can use (GLOBAL)
+    * relocations: (offset, label, line number) of every byte that holds a
+      label address, the label can be in this object or exported by another
+    * source_map, comments, labels, saved: like Program
+    """
 
-        except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+    __slots__ = ()
 
-        # Force to byte size
-        val &= 0xff
 
-        code.append(f"{p8(val)} # {data}")
+def assemble_object(source, name="", cache=None, optimize=False):
+    """
+    Assemble one source file of a program into an Object, see assemble() for
+    source, cache and optimize. Only the files that changed since they were
+    put in the cache get assembled again.
+    """
 
-        addr += 1
+    if cache is None:
+        if isinstance(source, str):
+            source = source.splitlines(True)
+        return build_object(source, name, optimize)
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+    if not isinstance(source, str):
+        source = "".join(source)
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+    key = hashlib.sha256(f"{VERSION}{optimize:d}object\0{name}".encode() + b"\0" + source.encode()).hexdigest()
+    return cached(cache, key, lambda: build_object(source.splitlines(True), name, optimize), save_object, load_object)
 
-        # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
 
-        op_type = OPCODES[opcode]["type"]
+def build_object(lines, name="", optimize=False):
+    """Pass 1 over the source lines, the label addresses are left for link()"""
 
-        total_operands = 0
+    sym = {}
+    code = Code()
 
-        if op_a is not None:
-            total_operands += 1
+    pass1(lines, sym, code, optimize)
 
-        if op_b is not None:
-            total_operands += 1
+    for label, line_num in code.exports:
+        if label not in sym:
+            raise AsmError(f"{name} line {line_num}: GLOBAL {label} isn't a label in this file", 2)
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+    return Object(name, bytes(code.bytes), sym, sorted({label for label, _ in code.exports}), code.fixups,
+                  code.source_map, code.comments, code.labels, (code.saved_bytes, code.saved_cycles))
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
-
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
+
+def save_object(obj):
+    """Object -> something json can write, for .ls8o files and the cache"""
+
+    return {
+        "name": obj.name,
+        "code": obj.code.hex(),
+        "symbols": obj.symbols,
+        "exports": obj.exports,
+        "relocations": obj.relocations,
+        "source_map": obj.source_map,
+        "comments": obj.comments,
+        "labels": obj.labels,
+        "saved": obj.saved,
     }
 
-    for line in inputfile:
-        line_num += 1
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+def load_object(data):
+    """Inverse of save_object()"""
 
-        # Normalize
-        line = line.strip()
+    program = load_program(data)
 
-        # Ignore blank lines
-        if input == '':
-            continue
+    return Object(
+        data["name"],
+        program.code,
+        program.symbols,
+        data["exports"],
+        [tuple(relocation) for relocation in data["relocations"]],
+        program.source_map,
+        program.comments,
+        program.labels,
+        program.saved,
+    )
 
-        # print(line)  # debug
 
-        m = re.match(REGEX, line)
+def link(objects):
+    """
+    Put objects together into a Program, one after the other in the order
+    given, so the first one starts at address 0 where the CPU does.
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+    Every relocation gets the address of its label: from the same object if
+    it has that label, otherwise from the one object that exports it.
+    Labels that aren't exported can have the same name in different objects.
+    """
+
+    exported = {}   # label -> (object name, address)
+    bases = []
+    base = 0
+
+    for obj in objects:
+        bases.append(base)
+        for label in obj.exports:
+            if label in exported:
+                raise AsmError(f"{obj.name}: {label} is exported by {exported[label][0]} too", 2)
+            exported[label] = (obj.name, base + obj.symbols[label])
+        base += len(obj.code)
+
+    code = bytearray()
+    # Exported labels first, so a local label with the same name elsewhere doesn't replace them
+    symbols = {label: address for label, (_, address) in exported.items()}
+    source_map = {}
+    comments = {}
+    labels = {}
+    saved_bytes = saved_cycles = 0
+
+    for obj, base in zip(objects, bases):
+        out = bytearray(obj.code)
+
+        for offset, label, line_num in obj.relocations:
+            if label in obj.symbols:
+                address = base + obj.symbols[label]
+            elif label in exported:
+                address = exported[label][1]
+            else:
+                raise AsmError(f"{obj.name} line {line_num}: unknown symbol: {label}", 2)
 
-            # print(label, opcode, op_a, op_b)  # debug
+            if address > 0xff:
+                raise AsmError(f"{obj.name} line {line_num}: address of {label} ({address}) doesn't fit in 8 bits", 2)
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+            out[offset] = address
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
+        code += out
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
-        else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+        for label, offset in obj.symbols.items():
+            symbols.setdefault(label, base + offset)
+        for offset, line_num in obj.source_map.items():
+            source_map[base + offset] = line_num
+        for offset, comment in obj.comments.items():
+            comments[base + offset] = comment
+        for offset, names in obj.labels.items():
+            labels.setdefault(base + offset, []).extend(names)
 
+        saved_bytes += obj.saved[0]
+        saved_cycles += obj.saved[1]
 
-def pass2(outputfile, sym, code):
+    return Program(bytes(code), symbols, source_map, comments, labels, (saved_bytes, saved_cycles))
+
+
+def stream(inputfile, outputfile, binary=False):
     """
-    Output the code, substituting in any symbols.
+    Streaming mode: assemble in one pass, writing each byte as soon as it's
+    final instead of keeping the whole program in memory.
+
+    A byte that holds a label nobody has defined yet is the only thing that
+    has to wait. If the output can seek it gets written as 0 and patched in
+    place when the label shows up, so only the forward references are kept.
+    If it can't (a pipe) everything from the first waiting byte on is held
+    back until the label shows up, since bytes have to go out in order.
+
+    A binary image written to something that can't seek has no header (the
+    loader takes it as raw code).
     """
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+    sym = {}
+    waiting = {}        # symbol -> [(line_num, file position or held entry)]
+    held = deque()      # [chunk] not written yet, chunk is None while its byte waits for a label
+    offset = 0
+    seekable = outputfile.seekable()
+    source_map = {}     # address -> line, for the image
+
+    if binary and seekable:
+        # Filled in at the end, when the lengths are known
+        start = outputfile.tell()
+        outputfile.write(bytes(IMAGE_HEADER.size))
+
+    def chunk(value, comment=None):
+        if binary:
+            return bytes((value,))
+        if comment is None:
+            return BITS[value] + "\n"
+        return f"{BITS[value]} # {comment}\n"
+
+    def write(data):
+        if held:
+            held.append([data])
+        else:
+            outputfile.write(data)
+
+    def address(s, line_num):
+        if sym[s] > 0xff:
+            raise AsmError(f"line {line_num}: address of {s} ({sym[s]}) doesn't fit in 8 bits", 2)
+
+        return sym[s]
 
-            if s in sym:
-                c = p8(sym[s])
+    def resolve(name):
+        for line_num, where in waiting.pop(name, ()):
+            value = address(name, line_num)
 
+            if seekable:
+                end = outputfile.tell()
+                outputfile.seek(where)
+                outputfile.write(chunk(value))
+                outputfile.seek(end)
             else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+                where[0] = chunk(value)
 
-        outputfile.write(f"{c}\n")
+        while held and held[0][0] is not None:
+            outputfile.write(held.popleft()[0])
+
+    for item in parse(inputfile):
+        if isinstance(item, Export):
+            continue
+
+        if isinstance(item, Label):
+            sym[item.name] = offset
+            if not binary:
+                write(f"# {item.name} (address {offset}):\n")
+            resolve(item.name)
+            continue
+
+        if binary and seekable:
+            # only the image has room for it
+            source_map[offset] = item.line_num
+
+        for value, s, comment in item.units:
+            if binary and offset >= 256:
+                raise AsmError(f"line {item.line_num}: program doesn't fit in 256 bytes of RAM", 2)
+
+            if s is None:
+                write(chunk(value, comment))
+            elif s in sym:
+                write(chunk(address(s, item.line_num), comment))
+            elif seekable:
+                waiting.setdefault(s, []).append((item.line_num, outputfile.tell()))
+                outputfile.write(chunk(0))
+            else:
+                entry = [None]
+                held.append(entry)
+                waiting.setdefault(s, []).append((item.line_num, entry))
+
+            offset += 1
+
+    for s in waiting:
+        raise AsmError(f"unknown symbol: {s}", 2)
+
+    if binary and seekable:
+        for name, label_address in sym.items():
+            name = name.encode()
+            outputfile.write(IMAGE_SYMBOL.pack(label_address, len(name)) + name)
+
+        for label_address, line in sorted(source_map.items()):
+            outputfile.write(IMAGE_SOURCE_LINE.pack(label_address, line))
+
+        end = outputfile.tell()
+        outputfile.seek(start)
+        outputfile.write(IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, 0, offset, len(sym), len(source_map)))
+        outputfile.seek(end)
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, options = parse_commandline(argv)
 
     # Open files
     inputfile, outputfile = open_files(inputfile, outputfile)
+    binary = "b" in getattr(outputfile, "mode", "")
 
-    # Set up the symbol table
-    sym = {}
+    try:
+        if "stream" in options:
+            stream(inputfile, outputfile, binary)
+            return 0
 
-    # Set up the machine code output
-    code = []
+        if "object" in options:
+            name = getattr(inputfile, "name", "-")
+            obj = assemble_object(inputfile, name, optimize="optimize" in options)
+            json.dump(save_object(obj), outputfile)
+            return 0
+
+        # Assemble
+        program = assemble(inputfile, optimize="optimize" in options)
+
+        if "optimize" in options:
+            saved_bytes, saved_cycles = program.saved
+            print(f"optimizer: {saved_bytes} bytes and about {saved_cycles} cycles saved", file=sys.stderr)
+
+        if binary:
+            outputfile.write(program.image())
+        else:
+            outputfile.write(program.text())
 
-    # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    except AsmError as e:
+        print(e, file=sys.stderr)
+        return e.status
 
     return 0
 
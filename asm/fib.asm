@@ -0,0 +1,35 @@
+; Recursive fibonacci, a benchmark kernel for CALL/RET and the stack
+;
+; Expected output: 233
+
+    LDI R0,13            ; n
+    LDI R3,Fib           ; R3 always holds the address of Fib
+    CALL R3
+    PRN R1               ; fib(13)
+    HLT
+
+; Fib
+;
+; R0 is n, returns fib(n) in R1. Keeps R0 and R3, uses R2.
+
+Fib:
+    LDI R2,2
+    CMP R0,R2
+    LDI R2,FibRecurse
+    JGE R2               ; n >= 2
+
+    LDI R1,0             ; fib(0) = 0, fib(1) = 1
+    ADD R1,R0
+    RET
+
+FibRecurse:
+    PUSH R0
+    DEC R0
+    CALL R3              ; R1 = fib(n - 1)
+    PUSH R1
+    DEC R0
+    CALL R3              ; R1 = fib(n - 2)
+    POP R2               ; R2 = fib(n - 1)
+    ADD R1,R2
+    POP R0
+    RET
@@ -0,0 +1,25 @@
+; Nested counted loops, a benchmark kernel
+;
+; Runs the inner loop 250 times for each of the 100 outer iterations.
+;
+; Expected output: 0
+
+    LDI R0,100           ; outer counter
+    LDI R2,0             ; zero to compare against
+    LDI R3,Inner
+    LDI R4,Outer
+
+Outer:
+    LDI R1,250           ; inner counter
+
+Inner:
+    DEC R1
+    CMP R1,R2
+    JNE R3               ; keep going until R1 is 0
+
+    DEC R0
+    CMP R0,R2
+    JNE R4               ; keep going until R0 is 0
+
+    PRN R0
+    HLT
@@ -0,0 +1,257 @@
+"""
+Tests for asm.py: the example programs assemble to the machine code in ../ls8/examples, the streaming mode and the
+optimizer against the normal assembler, the assemble() cache and linking. The assembled programs run on the CPU
+from ../ls8. Run it from this directory with python -m pytest.
+"""
+
+import io
+import os
+import sys
+import glob
+import tempfile
+import unittest
+
+import asm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "ls8"))
+
+from cpu import CPU     # noqa: E402
+
+EXAMPLES = sorted(glob.glob(os.path.join(HERE, "*.asm")))
+
+# interrupts.asm, keyboard.asm and loop.asm don't halt on their own
+MAX_CYCLES = 20000
+
+# every peephole pass has something to do in here
+OPTIMIZABLE = """
+    LDI R3,Hop      ; goes straight to Start
+    JMP R3
+Hop:
+    LDI R3,Start
+    JMP R3
+Start:
+    LDI R0,5
+    LDI R0,7        ; dead, R0 is written before anything reads it
+    LDI R0,8
+    LDI R1,1
+    ADD R0,R1       ; R1 holds 1, becomes INC R0
+    LDI R1,1        ; R1 already holds 1
+    PUSH R0
+    POP R0
+    SUB R0,R1       ; DEC R0
+    PRN R0
+    PRN R1
+    HLT
+"""
+
+
+class Pipe(io.BytesIO):
+    """Output that can't seek, like a pipe"""
+
+    def seekable(self):
+        return False
+
+
+class TextPipe(io.StringIO):
+
+    def seekable(self):
+        return False
+
+
+def source(path):
+    with open(path) as file:
+        return file.read()
+
+
+def streamed(text, output):
+    asm.stream(io.StringIO(text), output, binary=isinstance(output, io.BytesIO))
+    return output.getvalue()
+
+
+def run(code):
+    cpu = CPU()
+    cpu.load_bytes(code)
+    return cpu.run(MAX_CYCLES)
+
+
+def opcodes(program):
+    """The instruction names in a Program, in order"""
+
+    return [comment.split()[0] for _, comment in sorted(program.comments.items())]
+
+
+class AssembleTest(unittest.TestCase):
+
+    def test_examples(self):
+        for path in EXAMPLES:
+            name = os.path.basename(path)[:-len(".asm")] + ".ls8"
+            with self.subTest(program=name):
+                got = CPU()
+                got.load_bytes(asm.assemble(source(path)).code)
+                want = CPU()
+                want.load_file(os.path.join(HERE, "..", "ls8", "examples", name))
+
+                self.assertEqual(got.ram, want.ram)
+
+
+class StreamTest(unittest.TestCase):
+
+    def test_same_output_as_assemble(self):
+        for path in EXAMPLES:
+            with self.subTest(program=os.path.basename(path)):
+                text = source(path)
+                program = asm.assemble(text)
+
+                self.assertEqual(streamed(text, io.BytesIO()), program.image())
+                # no header without seeking, just the code
+                self.assertEqual(streamed(text, Pipe()), program.code)
+                self.assertEqual(streamed(text, io.StringIO()), program.text())
+                self.assertEqual(streamed(text, TextPipe()), program.text())
+
+    def test_unknown_symbol(self):
+        for output in (io.BytesIO(), Pipe(), io.StringIO(), TextPipe()):
+            with self.assertRaises(asm.AsmError):
+                streamed("LDI R0,Nowhere\nHLT\n", output)
+
+
+class OptimizerTest(unittest.TestCase):
+
+    def test_examples_run_the_same(self):
+        for path in EXAMPLES + [None]:
+            text = OPTIMIZABLE if path is None else source(path)
+            with self.subTest(program="OPTIMIZABLE" if path is None else os.path.basename(path)):
+                plain = run(asm.assemble(text).code)
+                optimized = asm.assemble(text, optimize=True)
+                result = run(optimized.code)
+
+                self.assertEqual((result.reason, result.output), (plain.reason, plain.output))
+                if plain.reason == "HLT":
+                    self.assertEqual(result.registers, plain.registers)
+                    self.assertEqual(plain.cycles - result.cycles, optimized.saved[1])
+
+    def test_passes(self):
+        program = asm.assemble(OPTIMIZABLE, optimize=True)
+
+        # the first jump goes straight to START, the loads and the PUSH/POP pair are gone
+        self.assertEqual(program.code[1:3], bytes([3, program.symbols["START"]]))
+        self.assertEqual(opcodes(program)[4:], ["LDI", "LDI", "INC", "DEC", "PRN", "PRN", "HLT"])
+        # 3 LDIs, PUSH and POP, and INC/DEC are a byte shorter than ADD/SUB. Every one of them runs once,
+        # and so does the LDI+JMP at HOP that isn't needed any more
+        self.assertEqual(program.saved, (3 * 3 + 2 * 2 + 2, 5 + 2))
+        self.assertEqual(run(program.code).output, "8\n1\n")
+
+    def test_jump_chain_loop(self):
+        # A jumps to B and B to A, threading has to stop instead of going round forever
+        text = "A:\n LDI R0,B\n JMP R0\nB:\n LDI R0,A\n JMP R0\n"
+        self.assertEqual(run(asm.assemble(text, optimize=True).code).reason, "max cycles")
+
+    def test_nothing_moves_across_a_label(self):
+        text = "LDI R0,1\nHere:\nLDI R0,1\nPRN R0\nHLT\n"
+        self.assertEqual(asm.assemble(text, optimize=True).code, asm.assemble(text).code)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def entries(self):
+        return sorted(glob.glob(os.path.join(self.cache, "*.json")))
+
+    def test_hit(self):
+        text = source(EXAMPLES[0])
+        first = asm.assemble(text, self.cache)
+        self.assertEqual(len(self.entries()), 1)
+
+        self.assertEqual(asm.assemble(text, self.cache), first)
+        self.assertEqual(first, asm.assemble(text))
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_key(self):
+        asm.assemble(OPTIMIZABLE, self.cache)
+        asm.assemble(OPTIMIZABLE, self.cache, optimize=True)
+        changed = asm.assemble(OPTIMIZABLE.replace("PRN R1", "PRA R1"), self.cache)
+
+        self.assertEqual(len(self.entries()), 3)
+        self.assertEqual(changed, asm.assemble(OPTIMIZABLE.replace("PRN R1", "PRA R1")))
+        self.assertEqual(asm.assemble(OPTIMIZABLE, self.cache, optimize=True).saved, (15, 7))
+
+    def test_broken_entry_is_assembled_again(self):
+        text = source(EXAMPLES[0])
+        asm.assemble(text, self.cache)
+        entry, = self.entries()
+
+        for broken in ("{not json", '{"code": "00"}', ""):
+            with self.subTest(entry=broken):
+                with open(entry, "w") as file:
+                    file.write(broken)
+
+                self.assertEqual(asm.assemble(text, self.cache), asm.assemble(text))
+                # and it was written again
+                self.assertEqual(asm.assemble(text, self.cache), asm.assemble(text))
+
+
+MAIN = """
+    GLOBAL Main
+Main:
+    LDI R0,6
+    LDI R1,7
+    LDI R2,Mult
+    CALL R2
+    PRN R0
+    HLT
+"""
+
+MULT = """
+    GLOBAL Mult
+Mult:
+    MUL R0,R1
+    RET
+"""
+
+
+class LinkTest(unittest.TestCase):
+
+    def test_cross_reference(self):
+        main = asm.assemble_object(MAIN, "main.asm")
+        mult = asm.assemble_object(MULT, "mult.asm")
+        program = asm.link([main, mult])
+
+        self.assertEqual(program.symbols["MULT"], len(main.code))
+        self.assertEqual(program.code, asm.assemble(MAIN.replace("GLOBAL Main", "") + MULT.replace("GLOBAL Mult", "")).code)
+        self.assertEqual(run(program.code).output, "42\n")
+
+        # the same through .ls8o files
+        objects = [asm.load_object(asm.save_object(obj)) for obj in (main, mult)]
+        self.assertEqual(asm.link(objects), program)
+
+    def test_local_labels_dont_clash(self):
+        first = asm.assemble_object("LDI R0,Skip\nJMP R0\nSkip:\nLDI R0,Next\nJMP R0\n GLOBAL Next\nNext:\n", "a.asm")
+        second = asm.assemble_object("Skip:\nPRN R0\nHLT\n", "b.asm")
+        program = asm.link([first, second])
+        # a.asm's SKIP, not the one in b.asm
+        self.assertEqual(program.code[2], 5)
+
+    def test_exported_twice(self):
+        objects = [asm.assemble_object(MULT, "mult.asm"), asm.assemble_object(MULT, "other.asm")]
+        with self.assertRaises(asm.AsmError) as raised:
+            asm.link(objects)
+        self.assertIn("exported by mult.asm too", str(raised.exception))
+
+    def test_undefined(self):
+        with self.assertRaises(asm.AsmError) as raised:
+            asm.link([asm.assemble_object(MAIN, "main.asm")])
+        self.assertIn("unknown symbol: MULT", str(raised.exception))
+
+    def test_export_that_isnt_a_label(self):
+        with self.assertRaises(asm.AsmError):
+            asm.assemble_object("GLOBAL Missing\nHLT\n", "main.asm")
+
+
+if __name__ == "__main__":
+    unittest.main()
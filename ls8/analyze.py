@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+"""
+Static analyzer for LS-8 programs: control flow graph, basic blocks, unreachable code and stack depth,
+all without running the program.
+"""
+
+import sys
+import argparse
+from collections import namedtuple, deque
+
+from cpu import ALU, NAMES, IM, VECTORS, WRITES_REGISTER, invalid_register, parse_program
+from image import read_image, MAGIC as IMAGE_MAGIC
+from profiler import read_labels
+
+OPCODES = {name: opcode for opcode, name in NAMES.items()}
+
+CONDITIONAL = {OPCODES[name] for name in ("JEQ", "JNE", "JGT", "JLT", "JGE", "JLE")}
+JMP = OPCODES["JMP"]
+CALL = OPCODES["CALL"]
+INT = OPCODES["INT"]
+# instructions that never go on to the next one
+STOPS = {OPCODES["RET"], OPCODES["IRET"], OPCODES["HLT"], JMP}
+# instructions that end a basic block
+ENDS = STOPS | CONDITIONAL | {CALL, INT}
+
+STACK_START = 0xF4      # SP when the CPU starts, the stack grows down from here
+INTERRUPT_FRAME = 9     # bytes an interrupt pushes: PC, FL and R0-R6
+
+UNKNOWN = (None,) * 8
+ALL_REGISTERS = frozenset(range(8))
+
+# start: address of its first instruction, end: address after its last byte
+# successors: addresses it can go on to (jumps and falling through, not CALL targets)
+Block = namedtuple("Block", ["start", "end", "successors"])
+
+
+class Analysis(namedtuple("Analysis", ["code", "entry", "instructions", "blocks", "calls", "handlers",
+                                       "unreachable", "stack", "max_stack", "problems"])):
+    """
+    What analyze() returns.
+
+    instructions: {address: opcode} of every instruction that can run
+    blocks: {start: Block}
+    calls: {address of a CALL: target}, handlers: interrupt handler addresses found in the vector table
+    unreachable: [(start, end)] byte ranges of the program that never run (dead code or data)
+    stack: {subroutine or handler address: most bytes it pushes, calls included}, None if there's no limit (recursion)
+    max_stack: most bytes the whole program can have on the stack, interrupts included, None if there's no limit
+    problems: [(address, message)] things that will go wrong when it runs, or that the analyzer couldn't follow
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    @property
+    def stack_room(self):
+        """Bytes between the end of the program and the start of the stack"""
+        return STACK_START - len(self.code)
+
+
+def meet(old, new):
+    """Register values that are the same on both paths, the others become unknown"""
+    return tuple(a if a == b else None for a, b in zip(old, new))
+
+
+def analyze(code, entry=0):
+    """
+    Decodes every instruction reachable from entry and follows the jumps, calls and interrupt handlers.
+    Jump and call targets are found by keeping track of the register values that are known (LDI Rn,label
+    and arithmetic on known values), so LDI Rn,label + JMP/CALL Rn is resolved.
+    """
+
+    code = bytes(code)
+    if len(code) > 256:
+        # it can't be loaded, nothing else is worth looking at
+        return Analysis(code, entry, {}, {}, {}, set(), [], {}, 0,
+                        [(0, f"program of {len(code)} bytes doesn't fit in RAM")])
+
+    ram = code + bytes(256 - len(code))
+
+    # The registers a subroutine changes aren't known until it's been explored (and exploring it can need them,
+    # e.g. a recursive CALL through a register), so the first time around subroutines are taken to change nothing,
+    # then it goes again with what they were found to change until that doesn't change any more.
+    # If it never settles every register is unknown after a CALL.
+    clobbers = {}
+    for _ in range(8):
+        states, successors, calls, handlers, roots, problems = explore(ram, len(code), entry, clobbers, frozenset())
+        found = {target: clobbered(ram, target, successors, calls) for target in set(calls.values())}
+        if found == clobbers:
+            break
+        clobbers = found
+    else:
+        states, successors, calls, handlers, roots, problems = explore(ram, len(code), entry, {}, ALL_REGISTERS)
+
+    instructions = {address: ram[address] for address in states}
+
+    # basic blocks start at the entry, every jump/call target and after every instruction that ends one
+    leaders = set(roots)
+    for address, targets in successors.items():
+        if ram[address] in ENDS:
+            leaders.update(targets)
+
+    blocks = {}
+    for start in sorted(leaders & set(instructions)):
+        address = start
+        while True:
+            opcode = ram[address]
+            following = address + (opcode >> 6) + 1
+            if opcode in ENDS or following in leaders or following not in instructions or address in problems:
+                break
+            address = following
+        end = min(following, 256)
+        blocks[start] = Block(start, end, tuple(sorted(successors.get(address, ()))))
+
+    # bytes that no instruction covers
+    covered = bytearray(len(code))
+    for address, opcode in instructions.items():
+        for offset in range(address, min(address + (opcode >> 6) + 1, len(code))):
+            covered[offset] = 1
+
+    unreachable = []
+    start = None
+    for address in range(len(code) + 1):
+        if address < len(code) and not covered[address]:
+            if start is None:
+                start = address
+        elif start is not None:
+            unreachable.append((start, address))
+            start = None
+
+    stack = stack_depths(ram, instructions, successors, calls, set(calls.values()) | handlers, problems)
+    main_depth = stack_depth(ram, entry, successors, calls, stack, problems)
+
+    max_stack = main_depth
+    if handlers and max_stack is not None:
+        # one interrupt at a time, they're disabled while a handler runs
+        deepest = [stack.get(handler) for handler in handlers]
+        max_stack = None if None in deepest else max_stack + INTERRUPT_FRAME + max(deepest)
+    elif any(ram[address] == OPCODES["LDI"] and ram[address + 1] == IM for address in instructions) \
+            and max_stack is not None:
+        # interrupts are turned on but no handler was found, at least the frame gets pushed
+        max_stack += INTERRUPT_FRAME
+
+    problems = sorted(problems.items())
+    if max_stack is not None and max_stack > STACK_START - len(code):
+        problems.append((entry, f"the stack can grow to {max_stack} bytes, "
+                                f"only {STACK_START - len(code)} fit above the program"))
+
+    return Analysis(code, entry, instructions, blocks, calls, sorted(handlers), unreachable, stack, max_stack,
+                    problems)
+
+
+def explore(ram, length, entry, clobbers, default):
+    """
+    Runs through the program from entry keeping track of the known register values (see analyze()).
+    clobbers has the registers each subroutine can change, the others keep their values across a CALL,
+    default is what's taken for the subroutines that aren't in it.
+    Returns (states, successors, calls, handlers, roots, problems).
+    """
+
+    problems = {}
+    states = {}             # address -> register values known before the instruction runs
+    successors = {}         # address -> addresses it can go on to
+    calls = {}
+    handlers = set()
+    roots = [entry]
+    worklist = deque()
+
+    def reach(address, state, source):
+        """Queue address to run with state, coming from source"""
+
+        if address >= length:
+            problems[source] = f"runs past the end of the program to {address:02X}"
+            return False
+
+        old = states.get(address)
+        new = state if old is None else meet(old, state)
+        if new != old:
+            states[address] = new
+            worklist.append(address)
+        return True
+
+    def root(address, source):
+        if address not in roots:
+            roots.append(address)
+        reach(address, UNKNOWN, source)
+
+    reach(entry, UNKNOWN, entry)
+
+    while worklist:
+        address = worklist.popleft()
+        state = list(states[address])
+        opcode = ram[address]
+        size = (opcode >> 6) + 1
+        a, b = (ram[address + 1] if address + 1 < 256 else 0), (ram[address + 2] if address + 2 < 256 else 0)
+        following = address + size
+        targets = set()
+
+        if opcode not in NAMES:
+            problems[address] = f"invalid instruction {opcode:08b}"
+            successors[address] = targets
+            continue
+
+        if following > 256:
+            problems[address] = "runs off the end of RAM"
+            successors[address] = targets
+            continue
+
+        problem = invalid_register(opcode, a, b)
+        if problem is not None:
+            problems[address] = problem
+            successors[address] = targets
+            continue
+
+        register = state[a] if size > 1 else None
+
+        if opcode == OPCODES["LDI"]:
+            state[a] = b
+        elif ALU[opcode] is not None:
+            # NOT, INC and DEC only have registerA, b is whatever byte comes next
+            x, y = state[a], (state[b] if size > 2 else 0)
+            try:
+                state[a] = None if x is None or y is None else ALU[opcode](x, y)
+            except ZeroDivisionError:
+                problems[address] = "division by zero"
+                successors[address] = targets
+                continue
+        elif opcode in (OPCODES["LD"], OPCODES["POP"]):
+            state[a] = None
+        elif opcode == OPCODES["ST"]:
+            # a handler going into the vector table
+            where, value = state[a], state[b]
+            if where is not None and where >= VECTORS and value is not None:
+                handlers.add(value)
+                root(value, address)
+        elif opcode == JMP or opcode in CONDITIONAL or opcode == CALL:
+            if register is None:
+                problems[address] = f"can't tell where {NAMES[opcode]} R{a} goes"
+            elif opcode == CALL:
+                calls[address] = register
+                # the subroutine starts with what the caller had in the registers
+                reach(register, tuple(state), address)
+                if register not in roots:
+                    roots.append(register)
+            elif reach(register, tuple(state), address):
+                targets.add(register)
+
+        if opcode == CALL:
+            changed = clobbers.get(register, default)
+            state = [None if n in changed else value for n, value in enumerate(state)]
+        elif opcode == INT:
+            # anything can come back from a handler
+            state = UNKNOWN
+
+        if opcode not in STOPS and reach(following, tuple(state), address):
+            targets.add(following)
+
+        successors[address] = targets
+
+    return states, successors, calls, handlers, roots, problems
+
+
+def clobbered(ram, start, successors, calls, seen=None):
+    """Registers the subroutine at start can change, the ones its calls change included"""
+
+    seen = set() if seen is None else seen
+    seen.add(start)
+    changed = set()
+
+    for address in reachable_from(start, successors):
+        opcode = ram[address]
+
+        if opcode in WRITES_REGISTER:
+            changed.add(ram[address + 1])
+        elif opcode == CALL:
+            if address not in calls:
+                return ALL_REGISTERS
+            if calls[address] not in seen:
+                changed |= clobbered(ram, calls[address], successors, calls, seen)
+        elif opcode == INT:
+            return ALL_REGISTERS
+
+    return frozenset(changed)
+
+
+def stack_depth(ram, start, successors, calls, stack, problems):
+    """
+    Most bytes the code from start pushes before it returns, CALLs included (stack has the subroutines' depths).
+    None if it has no limit.
+    """
+
+    depths = {start: 0}
+    worklist = deque([start])
+    deepest = 0
+
+    while worklist:
+        address = worklist.popleft()
+        depth = depths[address]
+        opcode = ram[address]
+
+        if opcode == OPCODES["PUSH"]:
+            depth += 1
+        elif opcode == OPCODES["POP"]:
+            depth -= 1
+        elif opcode == CALL and address in calls:
+            called = stack.get(calls[address])
+            if called is None:
+                return None
+            deepest = max(deepest, depth + 1 + called)
+
+        deepest = max(deepest, depth)
+        if deepest > 256:
+            problems[address] = "the stack keeps growing in this loop"
+            return None
+
+        for following in successors.get(address, ()):
+            if depths.get(following, -1) < depth:
+                depths[following] = depth
+                worklist.append(following)
+
+    return deepest
+
+
+def stack_depths(ram, instructions, successors, calls, subroutines, problems):
+    """Stack depth of every subroutine and handler, deepest calls first so the callers can add them up"""
+
+    stack = {}
+    working = set()
+
+    def depth_of(subroutine):
+        if subroutine in stack:
+            return stack[subroutine]
+        if subroutine in working:
+            # recursion, the depth depends on the values at run time
+            return None
+
+        working.add(subroutine)
+        # the subroutines it calls first
+        for address in reachable_from(subroutine, successors):
+            if address in calls and calls[address] != subroutine:
+                depth_of(calls[address])
+        working.discard(subroutine)
+
+        stack[subroutine] = stack_depth(ram, subroutine, successors, calls, stack, problems)
+        return stack[subroutine]
+
+    for subroutine in sorted(subroutines):
+        if subroutine in instructions:
+            depth_of(subroutine)
+
+    return stack
+
+
+def reachable_from(start, successors):
+    seen = {start}
+    worklist = [start]
+    while worklist:
+        for following in successors.get(worklist.pop(), ()):
+            if following not in seen:
+                seen.add(following)
+                worklist.append(following)
+    return seen
+
+
+def report(analysis, labels=None, file=sys.stdout):
+    """Prints the blocks, the graph, dead code, stack depths and problems"""
+
+    labels = labels or {}
+
+    def name(address):
+        label = labels.get(address)
+        return f"{address:02X}" + (f" {label}" if label else "")
+
+    code = analysis.code
+
+    print("blocks:", file=file)
+    for block in analysis.blocks.values():
+        last = max(address for address in analysis.instructions if block.start <= address < block.end)
+        going = ", ".join(f"{address:02X}" for address in block.successors)
+        called = f"  calls {analysis.calls[last]:02X}" if last in analysis.calls else ""
+        print(f"  {block.start:02X}-{block.end - 1:02X} {labels.get(block.start, ''):16} "
+              f"{NAMES.get(code[last], '?'):5}-> {going or '-'}{called}", file=file)
+
+    if analysis.unreachable:
+        print("\nnever runs (dead code or data):", file=file)
+        for start, end in analysis.unreachable:
+            print(f"  {start:02X}-{end - 1:02X} {labels.get(start, '')}".rstrip(), file=file)
+
+    if analysis.stack:
+        print("\nstack depth of subroutines and handlers (calls included):", file=file)
+        for address, depth in sorted(analysis.stack.items()):
+            kind = "handler" if address in analysis.handlers else "subroutine"
+            print(f"  {name(address):20} {kind:10} {'no limit' if depth is None else f'{depth} bytes'}", file=file)
+
+    print(f"\nprogram: {len(code)} bytes, stack room {analysis.stack_room} bytes (down from {STACK_START:02X})", file=file)
+    if analysis.max_stack is None:
+        print("stack: no limit (recursion or pushes in a loop)", file=file)
+    else:
+        print(f"stack: at most {analysis.max_stack} bytes (SP down to {STACK_START - analysis.max_stack:02X})",
+              file=file)
+
+    for address, message in analysis.problems:
+        print(f"problem: {name(address)}: {message}", file=file)
+
+
+def dot(analysis, labels=None, file=sys.stdout):
+    """Prints the control flow graph in graphviz format, calls are dashed"""
+
+    labels = labels or {}
+
+    print("digraph ls8 {", file=file)
+    print("  node [shape=box];", file=file)
+    for block in analysis.blocks.values():
+        label = labels.get(block.start, "")
+        print(f'  b{block.start} [label="{block.start:02X}-{block.end - 1:02X} {label}"];', file=file)
+        for following in block.successors:
+            print(f"  b{block.start} -> b{following};", file=file)
+    for address, target in analysis.calls.items():
+        block = max(start for start in analysis.blocks if start <= address)
+        print(f"  b{block} -> b{target} [style=dashed];", file=file)
+    print("}", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Analyze an LS-8 program without running it.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("--dot", action="store_true", help="print the control flow graph for graphviz instead")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.program, "rb") as file:
+        data = file.read()
+
+    if args.program.endswith(".ls8b") or data.startswith(IMAGE_MAGIC):
+        image = read_image(data)
+        code, entry = image.code, image.entry
+        labels = {address: label for label, address in image.symbols.items()}
+    else:
+        lines = data.decode().splitlines()
+        code, entry = parse_program(lines), 0
+        labels = read_labels(lines)
+
+    analysis = analyze(code, entry)
+
+    if args.dot:
+        dot(analysis, labels)
+    else:
+        report(analysis, labels)
+
+    # a program with problems is rejected
+    return 0 if analysis.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""CPU that runs on an asyncio event loop, so one process can host many machines."""
+
+import sys
+import asyncio
+import argparse
+
+from cpu import CPU, HALTED
+from devices import TIMER_INTERRUPT, KEYBOARD_INTERRUPT, KEY_ADDRESS
+
+
+class OutputPort:
+    """
+    Output sink for an AsyncCPU. PRN/PRA write() into it without blocking, the CPU drains it at the end of every slice
+    and whoever reads the port awaits read(). At most maxsize chunks wait to be read, after that the CPU waits for the
+    reader (backpressure) instead of piling up output.
+    """
+
+    def __init__(self, maxsize=64):
+        self.pending = []
+        self.queue = asyncio.Queue(maxsize)
+
+    def write(self, text):
+        self.pending.append(text)
+
+    async def drain(self):
+        if self.pending:
+            text = "".join(self.pending)
+            self.pending.clear()
+            await self.queue.put(text)
+
+    async def close(self):
+        """Flush and tell the reader there is nothing else coming"""
+        await self.drain()
+        await self.queue.put(None)
+
+    async def read(self):
+        """Next chunk of output, or None when the CPU stopped"""
+        return await self.queue.get()
+
+
+class InputPort:
+    """Keyboard for an AsyncCPU, every byte sent raises the keyboard interrupt with the key at 0xF4"""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+    async def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+
+        for key in data:
+            self.cpu.raise_interrupt(KEYBOARD_INTERRUPT, KEY_ADDRESS, key)
+            # let the CPU take the key before the next one
+            await asyncio.sleep(0)
+
+
+class AsyncCPU(CPU):
+    """
+    CPU that runs slice_cycles instructions at a time and then yields to the event loop.
+    Its output goes to an OutputPort (self.output) and its keyboard is an InputPort (self.keyboard).
+    """
+
+    __slots__ = ("slice_cycles", "keyboard")
+
+    def __init__(self, output=None, slice_cycles=1000):
+        # output comes first like in CPU(), fork() and from_snapshot() pass it that way
+        super().__init__(OutputPort() if output is None else output)
+        self.slice_cycles = slice_cycles
+        self.keyboard = InputPort(self)
+
+    def fork(self, output=None):
+        """Same as CPU.fork(), the fork runs the same number of cycles per slice"""
+
+        cpu = super().fork(output)
+        cpu.slice_cycles = self.slice_cycles
+        return cpu
+
+    async def run_async(self, max_cycles=None, blocks=False):
+        """
+        Same as run()/run_blocks() but awaits between slices, so other machines on the same loop get to run.
+        Closes the output port when it's done and returns the RunResult.
+        """
+
+        run = self.run_blocks if blocks else self.run
+        limit = None if max_cycles is None else self.cycles + max_cycles
+
+        while True:
+            cycles = self.slice_cycles if limit is None else min(self.slice_cycles, limit - self.cycles)
+            result = run(cycles)
+
+            if result.reason != "max cycles" or (limit is not None and self.cycles >= limit):
+                break
+
+            await self.output.drain()
+            await asyncio.sleep(0)
+
+        await self.output.close()
+        return result
+
+    async def timer(self, interval=1.0):
+        """Raises the timer interrupt every interval seconds, run it as a task next to run_async()"""
+
+        while True:
+            await asyncio.sleep(interval)
+            self.raise_interrupt(TIMER_INTERRUPT)
+
+
+async def serve_client(program, reader, writer, slice_cycles=1000, max_cycles=None):
+    """Runs a fresh machine for one connection, its output goes to the client and the client's bytes are the keyboard"""
+
+    cpu = AsyncCPU(slice_cycles=slice_cycles)
+    cpu.load_program(program)
+
+    async def send_output():
+        while True:
+            text = await cpu.output.read()
+            if text is None:
+                break
+            writer.write(text.encode("latin-1"))
+            await writer.drain()
+
+    async def read_input():
+        while True:
+            data = await reader.read(256)
+            if not data:
+                break
+            await cpu.keyboard.send(data)
+
+    machine = asyncio.ensure_future(cpu.run_async(max_cycles))
+    timer = asyncio.ensure_future(cpu.timer())
+    keyboard = asyncio.ensure_future(read_input())
+    output = asyncio.ensure_future(send_output())
+    tasks = (machine, timer, keyboard, output)
+
+    try:
+        # if the client hangs up (or can't be written to any more) before the machine stops, it's stopped below
+        await asyncio.wait((machine, keyboard, output), return_when=asyncio.FIRST_COMPLETED)
+        if machine.done():
+            await output
+            result = machine.result()
+            if result.reason != HALTED:
+                writer.write(f"{result.reason}\n".encode("latin-1"))
+                await writer.drain()
+    finally:
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+    # cancelled tasks are fine, anything that went wrong in one of them is not
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def run_local(programs, slice_cycles, max_cycles):
+    """Runs every program on the same loop, printing each line of output with the program's number in front"""
+
+    async def run_one(number, program):
+        cpu = AsyncCPU(slice_cycles=slice_cycles)
+        cpu.load_program(program)
+        timer = asyncio.ensure_future(cpu.timer())
+
+        async def print_output():
+            line = ""
+            while True:
+                text = await cpu.output.read()
+                if text is None:
+                    break
+                # only whole lines are printed, so output from different machines doesn't get mixed up
+                *lines, line = (line + text).split("\n")
+                for finished in lines:
+                    print(f"[{number}] {finished}")
+            if line:
+                print(f"[{number}] {line}")
+
+        try:
+            result, _ = await asyncio.gather(cpu.run_async(max_cycles), print_output())
+        finally:
+            timer.cancel()
+        print(f"[{number}] {result.reason}, {result.cycles} cycles")
+        return result
+
+    results = await asyncio.gather(*(run_one(number, program) for number, program in enumerate(programs)))
+    return max(result.status for result in results)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run LS-8 programs on an asyncio event loop.")
+    parser.add_argument("programs", nargs="+", help=".ls8 files, all of them run at the same time")
+    parser.add_argument("--slice", type=int, default=1000, help="instructions to run before yielding to other machines")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop each machine after this many instructions")
+    parser.add_argument("--port", type=int, default=None,
+                        help="instead of running them, serve the first program on this TCP port, one machine per client")
+    args = parser.parse_args(argv[1:])
+
+    programs = []
+    for path in args.programs:
+        with open(path) as file:
+            programs.append(file.read())
+
+    if args.port is None:
+        return asyncio.run(run_local(programs, args.slice, args.max_cycles))
+
+    async def serve():
+        server = await asyncio.start_server(
+            lambda reader, writer: serve_client(programs[0], reader, writer, args.slice, args.max_cycles),
+            "127.0.0.1", args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
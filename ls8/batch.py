@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Batch runner, runs many LS-8 programs in a pool of worker processes."""
+
+import sys
+import json
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import CPU
+
+# What a worker sends back for each run
+# program: path of the .ls8 file, inputs: values loaded into R0, R1, ... before running (or None)
+# output: everything the program printed, status: exit status (0 after HLT), cycles: instructions executed
+# error: why the program didn't end with HLT, or None
+BatchResult = namedtuple("BatchResult", ["program", "inputs", "output", "status", "cycles", "error"])
+
+
+def run_one(job):
+    """
+    Runs a single (program, inputs, blocks, max_cycles) job and returns a BatchResult.
+    This is what each worker process executes, it has to live at module level so it can be pickled.
+    """
+
+    program, inputs, blocks, max_cycles = job
+    cpu = CPU()
+
+    try:
+        cpu.load_file(program)
+
+        if inputs is not None:
+            for register, value in enumerate(inputs):
+                cpu.reg[register] = value & 0xFF
+
+        if blocks:
+            result = cpu.run_blocks(max_cycles)
+        else:
+            result = cpu.run(max_cycles)
+    except Exception as e:
+        return BatchResult(program, inputs, cpu.output.getvalue(), 1, cpu.cycles, f"{type(e).__name__}: {e}")
+
+    return BatchResult(program, inputs, result.output, result.status, result.cycles,
+                       None if result.status == 0 else result.reason)
+
+
+def run_batch(programs, inputs=None, workers=None, blocks=False, max_cycles=None, chunksize=16):
+    """
+    Runs every program once for each set of inputs (or once if inputs is None) across a pool of processes.
+    Returns a list of BatchResult in the same order as the jobs, programs first then inputs.
+    """
+
+    if inputs is None:
+        inputs = [None]
+
+    jobs = [(program, seed, blocks, max_cycles) for program in programs for seed in inputs]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_one, jobs, chunksize=chunksize))
+
+
+def run_lockstep(programs, inputs=None, max_cycles=None):
+    """
+    Same as run_batch() but each program runs over all the inputs at once in one process,
+    on the NumPy lockstep engine (see lockstep.py). Raises ImportError without numpy.
+    """
+
+    from lockstep import Lockstep
+
+    if inputs is None:
+        inputs = [None]
+
+    results = []
+
+    for program in programs:
+        cpu = CPU()
+        try:
+            cpu.load_file(program)
+        except Exception as e:
+            results.extend(BatchResult(program, seed, "", 1, 0, f"{type(e).__name__}: {e}") for seed in inputs)
+            continue
+
+        engine = Lockstep.from_cpu(cpu, len(inputs))
+        for machine, seed in enumerate(inputs):
+            for register, value in enumerate(seed or ()):
+                engine.reg[machine, register] = value & 0xFF
+
+        for seed, result in zip(inputs, engine.run(max_cycles)):
+            results.append(BatchResult(program, seed, result.output, result.status, result.cycles,
+                                       None if result.status == 0 else result.reason))
+
+    return results
+
+
+def read_inputs(path):
+    """Reads a file with one set of inputs per line, comma separated register values e.g. 10,0x14,0b11"""
+
+    inputs = []
+
+    with open(path) as file:
+        for line in file:
+            line = line.split("#")[0].strip()
+            if line != "":
+                inputs.append(tuple(int(value, 0) for value in line.split(",")))
+
+    return inputs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run many LS-8 programs in parallel.")
+    parser.add_argument("programs", nargs="+", help=".ls8 files to run")
+    parser.add_argument("-i", "--inputs", help="file with one set of comma separated register values per line, "
+                                               "every program runs once per line")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--blocks", action="store_true", help="run with the block compiler instead of the interpreter")
+    parser.add_argument("--lockstep", action="store_true",
+                        help="run all the inputs of a program at once with NumPy (see lockstep.py) instead of the pool")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop each run after this many instructions")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per run")
+    args = parser.parse_args(argv[1:])
+
+    inputs = read_inputs(args.inputs) if args.inputs else None
+
+    if args.lockstep:
+        try:
+            results = run_lockstep(args.programs, inputs, args.max_cycles)
+        except ImportError as e:
+            print(e, file=sys.stderr)
+            return 2
+    else:
+        results = run_batch(args.programs, inputs, args.jobs, args.blocks, args.max_cycles)
+
+    failed = 0
+    for result in results:
+        if result.status != 0:
+            failed += 1
+
+        if args.json:
+            print(json.dumps(result._asdict()))
+        else:
+            inputs = "" if result.inputs is None else " " + ",".join(str(value) for value in result.inputs)
+            print(f"== {result.program}{inputs}: status {result.status}, {result.cycles} cycles"
+                  + (f", {result.error}" if result.error else ""))
+            print(result.output, end="")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""Benchmarks, runs the example programs under every execution mode and compares against a saved baseline."""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+from cpu import CPU
+from memo import Memo
+from fastforward import FastForward
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# execution modes, each one runs a loaded CPU and returns its RunResult
+MODES = {
+    "interpreter": lambda cpu, max_cycles: cpu.run(max_cycles),
+    "blocks": lambda cpu, max_cycles: cpu.run_blocks(max_cycles),
+    "memo": lambda cpu, max_cycles: cpu.run(max_cycles, engine=Memo()),
+    "fastforward": lambda cpu, max_cycles: cpu.run(max_cycles, engine=FastForward()),
+}
+
+
+def run_once(source, mode, max_cycles):
+    """Loads and runs a program once, returns (startup seconds, run seconds, RunResult)"""
+
+    start = time.perf_counter()
+    cpu = CPU()
+    cpu.load_program(source)
+    loaded = time.perf_counter()
+    result = MODES[mode](cpu, max_cycles)
+    done = time.perf_counter()
+
+    return loaded - start, done - loaded, result
+
+
+def bench(source, mode, repeat=5, max_cycles=100000):
+    """
+    Benchmarks one program in one mode. Times are the best of repeat runs,
+    the peak memory comes from one extra run with tracemalloc on (it slows things down so it isn't timed).
+    """
+
+    startup = wall = float("inf")
+    result = None
+
+    for _ in range(repeat):
+        try:
+            load_time, run_time, result = run_once(source, mode, max_cycles)
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+        startup = min(startup, load_time)
+        wall = min(wall, run_time)
+
+    tracemalloc.start()
+    run_once(source, mode, max_cycles)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "cycles": result.cycles,
+        "reason": result.reason,
+        "wall": wall,
+        "startup": startup,
+        "ips": result.cycles / wall if wall > 0 else 0,
+        "peak_memory": peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of messages for every program/mode that got slower than the baseline by more than threshold"""
+
+    regressions = []
+
+    for program, modes in results.items():
+        for mode, numbers in modes.items():
+            old = baseline.get(program, {}).get(mode)
+            if old is None or "ips" not in old or "ips" not in numbers:
+                continue
+
+            if numbers["ips"] < old["ips"] * (1 - threshold):
+                change = 100 * (numbers["ips"] / old["ips"] - 1)
+                regressions.append(f"{program} {mode}: {numbers['ips']:,.0f} ips, was {old['ips']:,.0f} ({change:+.1f}%)")
+
+            if numbers["cycles"] != old["cycles"]:
+                regressions.append(f"{program} {mode}: {numbers['cycles']} cycles, was {old['cycles']}")
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the LS-8 emulator.")
+    parser.add_argument("programs", nargs="*", help=".ls8 files (default: everything in examples/)")
+    parser.add_argument("-m", "--mode", action="append", choices=sorted(MODES), help="modes to run (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per program, the best one counts")
+    parser.add_argument("--max-cycles", type=int, default=100000, help="cap for programs that never halt")
+    parser.add_argument("--save", help="write the results to this JSON file, to use as a baseline later")
+    parser.add_argument("--baseline", help="JSON file from --save to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown that counts as a regression (default: 0.10 = 10%%)")
+    args = parser.parse_args(argv[1:])
+
+    programs = args.programs or sorted(os.path.join(EXAMPLES, name) for name in os.listdir(EXAMPLES)
+                                       if name.endswith(".ls8"))
+    modes = args.mode or sorted(MODES)
+    results = {}
+
+    print(f"{'program':20} {'mode':12} {'cycles':>8} {'ips':>12} {'wall ms':>9} {'startup ms':>10} {'peak KB':>8}")
+
+    for path in programs:
+        with open(path) as file:
+            source = file.read()
+
+        name = os.path.basename(path)
+        results[name] = {}
+
+        for mode in modes:
+            numbers = bench(source, mode, args.repeat, args.max_cycles)
+            results[name][mode] = numbers
+
+            if "error" in numbers:
+                print(f"{name:20} {mode:12} {numbers['error']}")
+                continue
+
+            note = "" if numbers["reason"] == "HLT" else f"  ({numbers['reason']})"
+            print(f"{name:20} {mode:12} {numbers['cycles']:8} {numbers['ips']:12,.0f} {1000 * numbers['wall']:9.3f} "
+                  f"{1000 * numbers['startup']:10.3f} {numbers['peak_memory'] / 1024:8.1f}{note}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": platform.python_version(), "results": results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,304 @@
+"""Basic block compiler, turns LS-8 machine code into python functions."""
+
+import re
+
+from cpu import WRITES_REGISTER, INTERRUPT_REGISTERS, DECIMAL, CHARACTERS, invalid_register
+
+# Python source for the instructions the compiler knows how to inline.
+# {a} and {b} are the operands, registers are kept in locals named r0-r7 and the flags in FL
+# (same semantics as the handlers in cpu.py, so the result is the same as CPU.run)
+TEMPLATES = {
+    0b10000010: "r{a} = {b}",                                       # LDI
+    0b10100000: "r{a} = (r{a} + r{b}) & 0xFF",                      # ADD
+    0b10100001: "r{a} = (r{a} - r{b}) & 0xFF",                      # SUB
+    0b10100010: "r{a} = (r{a} * r{b}) & 0xFF",                      # MUL
+    0b10101000: "r{a} &= r{b}",                                     # AND
+    0b10101010: "r{a} |= r{b}",                                     # OR
+    0b10101011: "r{a} ^= r{b}",                                     # XOR
+    0b10101100: "r{a} = (r{a} << r{b}) & 0xFF",                     # SHL
+    0b10101101: "r{a} >>= r{b}",                                    # SHR
+    0b10100111: "FL = (r{a} < r{b}) << 2 | (r{a} > r{b}) << 1 | (r{a} == r{b})",  # CMP
+    # 1 operand
+    0b01101001: "r{a} = ~r{a} & 0xFF",                              # NOT
+    0b01100101: "r{a} = (r{a} + 1) & 0xFF",                         # INC
+    0b01100110: "r{a} = (r{a} - 1) & 0xFF",                         # DEC
+}
+# DIV and MOD are left to the cpu handler, it prints an error and halts when dividing by 0
+
+# Python source for the instructions that use RAM, the stack pointer (R7) or the output, inlined too so the block
+# doesn't have to save and reload its registers around a handler.
+# ram and ram_write are cpu.ram and cpu.ram_write, write is the output's write()
+MEMORY = {
+    0b10000011: ["r{a} = ram[r{b}]"],                                       # LD
+    0b10000100: ["ram_write(r{a}, r{b})"],                                  # ST
+    0b01000101: ["r7 = (r7 - 1) & 0xFF", "ram_write(r7, r{a})"],            # PUSH
+    0b01000110: ["r{a} = ram[r7]", "r7 = (r7 + 1) & 0xFF"],                 # POP
+    0b01000111: ["write(DECIMAL[r{a}])"],                                   # PRN
+    0b01001000: ["write(CHARACTERS[r{a}])"],                                # PRA
+    0b00000000: [],                                                         # NOP
+}
+
+# Python source for the jumps, they end the block by returning the address where the next block starts
+# {next} is the address of the instruction right after the jump
+JUMPS = {
+    0b01010100: "return r{a}",                                      # JMP
+    0b01010101: "return r{a} if FL & 0b00000001 else {next}",       # JEQ
+    0b01010110: "return {next} if FL & 0b00000001 else r{a}",       # JNE
+    0b01010111: "return r{a} if FL & 0b00000010 else {next}",       # JGT
+    0b01011000: "return r{a} if FL & 0b00000100 else {next}",       # JLT
+    0b01011010: "return r{a} if FL & 0b00000011 else {next}",       # JGE
+    0b01011001: "return r{a} if FL & 0b00000101 else {next}",       # JLE
+}
+
+# CALL and RET end the block like the jumps, the last line is the return
+CALLS = {
+    0b01010000: ["r7 = (r7 - 1) & 0xFF", "ram_write(r7, {next})", "return r{a}"],  # CALL
+    0b00010001: ["PC = ram[r7]", "r7 = (r7 + 1) & 0xFF", "return PC"],             # RET
+}
+
+# a register local in a line of source, and one being assigned to
+LOCAL = re.compile(r"\br([0-7])\b")
+ASSIGNED = re.compile(r"^r([0-7]) \S*= ")
+
+# Instructions that set the PC, a block always ends with one of these
+TERMINATORS = {
+    0b01010100,  # JMP
+    0b01010101,  # JEQ
+    0b01010110,  # JNE
+    0b01010111,  # JGT
+    0b01011000,  # JLT
+    0b01011010,  # JGE
+    0b01011001,  # JLE
+    0b01010000,  # CALL
+    0b00010001,  # RET
+    0b00000001,  # HLT
+    0b01010010,  # INT
+    0b00010011,  # IRET
+}
+
+# Instructions that write to RAM -> the register with the address they write to.
+# If it's the code of the rest of the block (self-modifying code) the block returns there, so the new code is compiled
+WRITES = {
+    0b01000101: "r7",       # PUSH
+    0b10000100: "r{a}",     # ST
+}
+
+# markers for where the compiled code has to save/load the registers kept in locals
+SPILL = object()
+RELOAD = object()
+# (EXIT, condition, instructions run so far, next address, save registers) marks where the block returns early:
+# a handler stopped the CPU or a write changed the code that follows. {end} in the condition is where the block ends
+EXIT = "exit"
+
+
+class BlockCompiler:
+    """
+    Finds the basic block (straight-line code up to a jump, CALL, RET or HLT) that starts at a given address
+    and compiles it into a single python function, so the run loop only dispatches once per block.
+
+    Calling a block function runs the whole block and returns the address of the next block.
+    Blocks are cached by their start address and thrown away when a byte they were compiled from is written.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}                        # start address -> (block function, number of instructions)
+        self.covers = [set() for _ in range(256)]   # address -> start addresses of the blocks compiled from it
+
+    def invalidate(self, address):
+        """Throw away every block that was compiled from the byte at a given address"""
+
+        for start in self.covers[address]:
+            if start in self.blocks:
+                del self.blocks[start]
+        self.covers[address].clear()
+
+    def clear(self):
+        """Throw away every compiled block"""
+
+        self.blocks.clear()
+        for starts in self.covers:
+            starts.clear()
+
+    def compile(self, start):
+        """
+        Compiles the block starting at a given address and saves it in the cache.
+        Returns None if the instruction at that address can't go in a block (invalid opcode or register).
+        """
+
+        cpu = self.cpu
+        ram = cpu.ram
+        body = []       # lines of the function body
+        used = set()    # registers the block keeps in locals
+        written = set()     # registers the block changes, only these have to be saved back
+        flags = False       # the block reads or sets FL
+        sets_flags = False
+        prints = False      # the block has a PRN or PRA
+        handlers = {}   # names of the cpu handlers the block calls -> bound method
+        address = start
+        count = 0
+
+        # save the locals back so a cpu handler sees the real state, and read them again after it.
+        # these are placeholders until the end, when we know every register the block uses
+        def spill():
+            body.append(SPILL)
+
+        def reload():
+            body.append(RELOAD)
+
+        def inline(lines):
+            nonlocal flags, sets_flags
+            for line in lines:
+                used.update(int(r) for r in LOCAL.findall(line))
+                written.update(int(r) for r in ASSIGNED.findall(line))
+                flags = flags or "FL" in line
+                sets_flags = sets_flags or line.startswith("FL =")
+                body.append(line)
+
+        def call(IR, size, a, b):
+            # run the instruction with its normal cpu handler
+            name = f"h_{address:02x}"
+            handlers[name] = cpu.branchtable[IR]
+            operands = ", ".join(str(op) for op in (a, b)[:size - 1])
+            spill()
+            body.append(f"cpu.PC = {address}")
+            body.append(f"{name}({operands})")
+
+        while address < len(ram):
+            IR = ram[address]
+            size = (IR >> 6) + 1
+            if IR not in cpu.branchtable or address + size > len(ram):
+                break
+
+            a = ram[address + 1] if size > 1 else 0
+            b = ram[address + 2] if size > 2 else 0
+            if invalid_register(IR, a, b) is not None:
+                # the run loop stops there with the reason, like the interpreter
+                break
+            count += 1
+
+            body.append(f"# {address:02X}: {IR:08b}")
+
+            if IR in JUMPS:
+                spill()
+                inline([JUMPS[IR].format(a=a, next=address + size)])
+            elif IR in CALLS:
+                *lines, ret = [line.format(a=a, next=(address + size) & 0xFF) for line in CALLS[IR]]
+                inline(lines)
+                spill()
+                inline([ret])
+            elif IR in TERMINATORS:
+                call(IR, size, a, b)
+                body.append(f"return cpu.PC + {size}")
+            elif IR in TEMPLATES:
+                inline([TEMPLATES[IR].format(a=a, b=b)])
+            elif IR in MEMORY:
+                prints = prints or any(line.startswith("write(") for line in MEMORY[IR])
+                inline([line.format(a=a, b=b) for line in MEMORY[IR]])
+            else:
+                call(IR, size, a, b)
+                reload()
+                # the handler can stop the CPU (e.g. DIV by 0), then the rest of the block must not run
+                body.append((EXIT, "not cpu.running", count, address + size, False))
+
+            address += size
+
+            if IR in TERMINATORS:
+                break
+            if IR in WRITES_REGISTER and a in INTERRUPT_REGISTERS:
+                # IM or IS changed, go back to the run loop so it checks the interrupts
+                spill()
+                body.append("cpu.running = False")
+                body.append(f"return {address}")
+                break
+            if IR in WRITES:
+                written_to = WRITES[IR].format(a=a)
+                body.append((EXIT, f"{address} <= {written_to} < {{end}}", count, address, True))
+        else:
+            # ran off the end of RAM, let the run loop fail on the next address the same way the interpreter does
+            spill()
+            body.append(f"return {address}")
+
+        if count == 0:
+            return None
+
+        if not isinstance(body[-1], str) or not body[-1].startswith("return"):
+            # stopped before an invalid opcode or register, continue there
+            spill()
+            body.append(f"return {address}")
+
+        # only what the block changed is saved, but everything it reads is loaded again after a handler
+        spill_lines = [f"reg[{r}] = r{r}" for r in sorted(written)] + (["cpu.FL = FL"] if sets_flags else [])
+        reload_lines = [f"r{r} = reg[{r}]" for r in sorted(used)] + (["FL = cpu.FL"] if flags else [])
+        lines = reload_lines + (["write = cpu.output.write"] if prints else [])
+        for line in body:
+            if line is SPILL:
+                lines.extend(spill_lines)
+            elif line is RELOAD:
+                lines.extend(reload_lines)
+            elif isinstance(line, tuple):
+                # the run loop added the cycles of the whole block before calling it, give back the ones that didn't run
+                _, condition, done, next_address, save = line
+                if next_address >= address:
+                    # nothing after it in the block
+                    continue
+                lines.append(f"if {condition.format(end=address)}:")
+                if save:
+                    lines.extend(f"    {spilled}" for spilled in spill_lines)
+                if count > done:
+                    lines.append(f"    cpu.cycles -= {count - done}")
+                lines.append(f"    return {next_address}")
+            else:
+                lines.append(line)
+
+        source = f"def block_{start:02x}(cpu, reg):\n" + "".join(f"    {line}\n" for line in lines)
+
+        namespace = dict(handlers, ram=ram, ram_write=cpu.ram_write, DECIMAL=DECIMAL, CHARACTERS=CHARACTERS)
+        exec(compile(source, f"<block {start:02X}>", "exec"), namespace)
+        block = namespace[f"block_{start:02x}"]
+        block.source = source   # handy when debugging a block
+
+        self.blocks[start] = (block, count)
+        for covered in range(start, address):
+            self.covers[covered].add(start)
+
+        return self.blocks[start]
+
+    def run(self, max_cycles=None, deadline=None):
+        """Run the CPU one block at a time, until it stops or until max_cycles more instructions have run (see CPU.run)."""
+
+        return self.cpu.execute(self.loop, max_cycles, deadline)
+
+    def loop(self, limit):
+        """Runs blocks while running is True and the cycle count is under limit (see CPU.execute)"""
+
+        cpu = self.cpu
+        blocks = self.blocks
+        reg = cpu.reg
+
+        while cpu.running:
+            cycles = cpu.cycles
+            if cycles >= limit:
+                cpu.running = False
+                cpu.halt_reason = "max cycles"
+                break
+
+            PC = cpu.PC
+            block = blocks.get(PC) or self.compile(PC)
+
+            if block is None or cycles + block[1] > limit:
+                # can't start a block here, or the whole block would go over max_cycles,
+                # so run this single instruction exactly like CPU.run does
+                instruction = cpu.decoded.get(PC) or cpu.fetch(PC)
+                if instruction is None:
+                    break
+
+                handler, size = instruction
+                cpu.cycles = cycles + 1
+                handler()
+                cpu.PC += size
+                continue
+
+            function, count = block
+            cpu.cycles = cycles + count
+            cpu.PC = function(cpu, reg)
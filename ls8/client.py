@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Thin client for server.py, same command line as ls8.py: ./client.py <filename>
+Whatever comes in on stdin (when it isn't a terminal) is typed on the keyboard.
+If no server is running it runs the program with ls8.py instead.
+
+From Python, Client keeps its connection open so every run after the first one is just a round trip
+(starting this script is still starting Python).
+"""
+
+import os
+import sys
+import stat
+import select
+import socket
+
+import ipc
+
+LS8 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ls8.py")
+
+
+class Client:
+    """
+    Connection to server.py. Raises FileNotFoundError or ConnectionRefusedError if it isn't running.
+    """
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(ipc.SOCKET if path is None else path)
+
+    def run(self, program, keys=b"", binary=False, **options):
+        """
+        Runs a program (the contents of a .ls8 or .ls8b file) with keys typed on its keyboard.
+        options go along with the request: max_cycles, timeout, timer, blocks (see server.run_request()).
+        Returns the reply, a dict with output, status, reason and cycles.
+        """
+
+        request = {"program": ipc.encode(program), "binary": binary, "input": ipc.encode(keys)}
+        request.update(options)
+        ipc.send(self.sock, request)
+
+        reply = ipc.receive(self.sock)
+        if reply is None:
+            raise ConnectionError("the server closed the connection")
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def typed_keys():
+    """
+    stdin when it's a file or something is being piped in, it all goes to the program up front.
+    A terminal, or a pipe nobody writes to, gives nothing instead of waiting forever.
+    """
+
+    if sys.stdin is None or sys.stdin.isatty():
+        return b""
+
+    if not stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+        readable, _, _ = select.select([sys.stdin], [], [], 0.1)
+        if not readable:
+            return b""
+
+    return sys.stdin.buffer.read()
+
+
+def main(argv):
+    if len(argv) != 2:
+        print("usage: ./client.py <filename>")
+        return 1
+
+    path = argv[1]
+
+    try:
+        client = Client()
+    except (FileNotFoundError, ConnectionRefusedError):
+        os.execv(sys.executable, [sys.executable, LS8, path])
+
+    try:
+        if path == "-":
+            program, keys = sys.stdin.buffer.read(), b""
+        else:
+            with open(path, "rb") as file:
+                program = file.read()
+            keys = typed_keys()
+    except FileNotFoundError:
+        print("file not found!")
+        return 2
+
+    options = {}
+    if "LS8_TIMEOUT" in os.environ:
+        options["timeout"] = float(os.environ["LS8_TIMEOUT"])
+
+    try:
+        with client:
+            reply = client.run(program, keys, path.endswith(".ls8b"), **options)
+    except ConnectionError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    sys.stdout.write(reply["output"])
+    sys.stdout.flush()
+
+    if reply["reason"] != "HLT":
+        print(reply["reason"], file=sys.stderr)
+
+    return reply["status"]
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,30 +1,155 @@
 """CPU functionality."""
 
 import sys
+import io
 import re
+import time
+import struct
+from collections import namedtuple, deque
+from functools import partial
+
+from image import read_image, MAGIC as IMAGE_MAGIC
+
+"""
+ALU (Arithmetic Logic Unit) operations indexed by opcode, so an instruction goes straight to its function
+instead of comparing strings. Each one takes the values of registerA and registerB and returns the new value of registerA.
+0xFF is used to mask(cut/slice) the result to 255 (8 bits) since our machine is only 8 bits
+"""
+ALU = [None] * 256
+ALU[0b10100000] = lambda a, b: (a + b) & 0xFF     # ADD
+ALU[0b10100001] = lambda a, b: (a - b) & 0xFF     # SUB
+ALU[0b10100010] = lambda a, b: (a * b) & 0xFF     # MUL
+ALU[0b10100011] = lambda a, b: a // b             # DIV (raises ZeroDivisionError, see CPU.alu)
+ALU[0b10100100] = lambda a, b: a % b              # MOD (raises ZeroDivisionError, see CPU.alu)
+# normal "and" doesnt work. try "4 and 3" vs "4 & 3" and see the results
+ALU[0b10101000] = lambda a, b: a & b              # AND
+ALU[0b10101010] = lambda a, b: a | b              # OR
+ALU[0b10101011] = lambda a, b: a ^ b              # XOR
+ALU[0b10101100] = lambda a, b: (a << b) & 0xFF    # SHL
+ALU[0b10101101] = lambda a, b: a >> b             # SHR
+# these only have 1 operand, registerB is ignored
+ALU[0b01101001] = lambda a, b: ~a & 0xFF          # NOT
+ALU[0b01100101] = lambda a, b: (a + 1) & 0xFF     # INC
+ALU[0b01100110] = lambda a, b: (a - 1) & 0xFF     # DEC
+
+
+# Instruction names by opcode (from the spec), for tools that print or analyze machine code
+NAMES = {
+    0b10100000: "ADD", 0b10101000: "AND", 0b01010000: "CALL", 0b10100111: "CMP", 0b01100110: "DEC",
+    0b10100011: "DIV", 0b00000001: "HLT", 0b01100101: "INC", 0b01010010: "INT", 0b00010011: "IRET",
+    0b01010101: "JEQ", 0b01011010: "JGE", 0b01010111: "JGT", 0b01011001: "JLE", 0b01011000: "JLT",
+    0b01010100: "JMP", 0b01010110: "JNE", 0b10000011: "LD", 0b10000010: "LDI", 0b10100100: "MOD",
+    0b10100010: "MUL", 0b00000000: "NOP", 0b01101001: "NOT", 0b10101010: "OR", 0b01000110: "POP",
+    0b01001000: "PRA", 0b01000111: "PRN", 0b01000101: "PUSH", 0b00010001: "RET", 0b10101100: "SHL",
+    0b10101101: "SHR", 0b10000100: "ST", 0b10100001: "SUB", 0b10101011: "XOR",
+}
+
+# what PRN and PRA print for each value, made once so printing doesn't format anything
+DECIMAL = [f"{value}\n" for value in range(256)]
+CHARACTERS = [chr(value) for value in range(256)]
+
+# halt reason after a HLT instruction, anything else means the program didn't finish normally
+HALTED = "HLT"
+
+# snapshot header: magic, format version, PC, FL, running, interrupts enabled, cycles. The registers and RAM follow it
+SNAPSHOT = struct.Struct("<4sBHBBBQ")
+SNAPSHOT_MAGIC = b"LS8S"
+SNAPSHOT_VERSION = 2
+
+# with a deadline the run loops get this many cycles at a time and the clock is checked in between, see execute()
+DEADLINE_CHECK = 10000
+
+IM = 5                  # R5 is the interrupt mask
+IS = 6                  # R6 is the interrupt status
+VECTORS = 0xF8          # interrupt vector table, I0 handler address at 0xF8 up to I7 at 0xFF
+
+# conditional jumps: opcode -> (FL bits they look at, True if the jump is taken when none of them are set)
+CONDITIONS = {
+    0b01010101: (0b001, False),     # JEQ
+    0b01010110: (0b001, True),      # JNE
+    0b01010111: (0b010, False),     # JGT
+    0b01011000: (0b100, False),     # JLT
+    0b01011010: (0b011, False),     # JGE
+    0b01011001: (0b101, False),     # JLE
+}
+
+# instructions that write to the register in their first operand (LDI, LD, POP and the ALU except CMP)
+# when that register is IM or IS the interrupts have to be checked again, see decode()
+WRITES_REGISTER = {0b10000010, 0b10000011, 0b01000110} | {opcode for opcode in range(256) if ALU[opcode] is not None}
+INTERRUPT_REGISTERS = {IM, IS}
+
+
+def parse_program(source):
+    """The bytes of a program in the .ls8 text format, source is the whole text or lines (see CPU.load_program)"""
+
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    program = []
+    for instruction in source:
+        instruction = re.sub(r'[^01]+', '', instruction.split("#")[0])
+        if instruction != "":
+            program.append(int(instruction, 2))
+
+    return bytes(program)
+
+
+def invalid_register(IR, a, b):
+    """
+    Every operand is a register (R0-R7) except the value of LDI. Returns the halt reason if one of the operands
+    of IR a b isn't, None if they're fine. The run loops stop with it before the instruction runs (see decode()).
+    """
+
+    operands = IR >> 6
+    if operands >= 1 and a > 7:
+        return f"invalid register [R{a}]"
+    if operands == 2 and IR != 0b10000010 and b > 7:
+        return f"invalid register [R{b}]"
+    return None
+
+
+class RunResult(namedtuple("RunResult", ["reason", "cycles", "registers", "PC", "FL", "output"])):
+    """
+    What CPU.run() returns.
+    reason: why the CPU stopped (HALTED, "max cycles", "deadline", "invalid instruction [...]",
+            "invalid register [...]", "division by zero")
+    cycles: instructions executed so far, registers: copy of R0-R7
+    output: everything PRN printed when the CPU captures its output (CPU(output=None)), otherwise None
+    """
+
+    __slots__ = ()
+
+    @property
+    def status(self):
+        """Exit status like a process would have, 0 after HLT, 1 otherwise"""
+        return 0 if self.reason == HALTED else 1
 
 
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
+    # fixed set of attributes so every CPU instance is small (no __dict__), we run thousands of them at once
+    __slots__ = ("running", "PC", "FL", "reg", "sp", "ram", "branchtable", "decoded", "blocks", "cycles",
+                 "halt_reason", "output", "interrupts_enabled", "requests")
+
+    def __init__(self, output=None):
+        """
+        Construct a new CPU.
+        output is where PRN and PRA write to, anything with a write() method like sys.stdout, an open file
+        or an output.OutputBuffer (much faster for programs that print a lot).
+        If it's None the output is captured in memory and returned by run().
+        """
         self.running = False    # Self explanatory
         self.PC = 0             # Program Counter, address of the currently executing instruction
         self.FL = 0
-        self.reg = [0] * 8      # Registers, R0-R7, to hold values
+        self.reg = bytearray(8)     # Registers, R0-R7, to hold values (a bytearray only takes 0-255 like the real 8 bit registers)
         # Register 7 is the Stack Pointer (index of register that knows where the stack is at) self.reg[sp] += 1
         self.sp = 7
         # self.ram[self.reg[self.sp]] = 244 - Is the top of the stack and grows down
         self.reg[self.sp] = 0xF4
-        self.ram = [0] * 256    # RAM to load the program into.
+        self.ram = bytearray(256)   # RAM to load the program into, one byte per address
         self.branchtable = {    # branchtable avoids if/elif statements by using an index to know which function to run
             0b10000010: self.LDI,   # Load "Immediate"
-            0b10100000: self.ADD,   # ALU function
-            0b10100001: self.SUB,   # ALU function
-            0b10100010: self.MUL,   # ALU function
-            0b10100011: self.DIV,   # ALU function
-            0b10100100: self.MOD,   # ALU function
             0b01000111: self.PRN,   # Print
             0b00000001: self.HLT,   # Halt
             0b01000101: self.PUSH,  # Push
@@ -39,30 +164,166 @@ class CPU:
             0b01011001: self.JLE,   # Jump Less than or Equal
             0b01011000: self.JLT,   # Jump Less than
             0b01010110: self.JNE,   # Jump Not Equal
-            0b10101000: self.AND,   #
-            0b10101010: self.OR,    #
-            0b10101011: self.XOR,   #
-            0b01101001: self.NOT,   #
-            0b10101100: self.SHL,   # Shift left by reg B bits
-            0b10101101: self.SHR,   # Shift right by reg B bits
+            0b10000100: self.ST,    # Store register B into the address in register A
+            0b10000011: self.LD,    # Load register A from the address in register B
+            0b01001000: self.PRA,   # Print alpha character
+            0b01010010: self.INT,   # Interrupt
+            0b00010011: self.IRET,  # Return from interrupt
+            0b00000000: self.NOP,   # No operation
         }
+        # ALU instructions (ADD, SUB, MUL, DIV, MOD, AND, OR, XOR, SHL, SHR, NOT, INC, DEC) all go to alu() with their opcode already bound
+        for opcode, operation in enumerate(ALU):
+            if operation is not None:
+                self.branchtable[opcode] = partial(self.alu, opcode)
+        # decoded instruction cache: address -> (handler with its operands already bound, instruction size)
+        # an entry is dropped by ram_write() when any byte of that instruction changes
+        self.decoded = {}
+        self.blocks = None      # BlockCompiler when running with run_blocks()
+        self.cycles = 0         # number of instructions executed so far
+        self.halt_reason = None     # why the last run() stopped, see RunResult
+        self.output = io.StringIO() if output is None else output
+        self.interrupts_enabled = True
+        # interrupts raised by devices (see devices.py) waiting for the CPU to take them: (number, address, value)
+        # they can come from other threads, so they're queued here and only touch the registers and RAM in the CPU thread
+        self.requests = deque()
+
+    def reset(self):
+        """Power on state (see the spec) so the same CPU can run another program, keeps the output sink"""
+        self.running = False
+        self.PC = 0
+        self.FL = 0
+        self.reg[:] = bytes(8)
+        self.reg[self.sp] = 0xF4
+        self.ram[:] = bytes(256)
+        self.invalidate()
+        self.cycles = 0
+        self.halt_reason = None
+        self.interrupts_enabled = True
+        self.requests.clear()
+        if isinstance(self.output, io.StringIO):
+            self.output.seek(0)
+            self.output.truncate()
+
+    def snapshot(self):
+        """
+        Returns the whole machine state (PC, FL, running, interrupts enabled, cycles, registers and RAM) as bytes, 282 bytes in total.
+        Use restore() or CPU.from_snapshot() to get it back. The output sink is not part of the state.
+        """
+
+        header = SNAPSHOT.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.PC, self.FL, self.running,
+                               self.interrupts_enabled, self.cycles)
+        return header + self.reg + self.ram
+
+    def restore(self, data):
+        """
+        Sets the machine state from a snapshot() made by this or another CPU.
+        Raises ValueError, without changing anything, if data isn't a whole snapshot.
+        """
+
+        if len(data) != SNAPSHOT.size + 8 + 256:
+            raise ValueError(f"an LS-8 snapshot is {SNAPSHOT.size + 8 + 256} bytes, not {len(data)}")
+
+        magic, version, PC, FL, running, interrupts_enabled, cycles = SNAPSHOT.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("not an LS-8 snapshot")
+
+        start = SNAPSHOT.size
+        self.PC = PC
+        self.FL = FL
+        self.running = bool(running)
+        self.interrupts_enabled = bool(interrupts_enabled)
+        self.cycles = cycles
+        self.halt_reason = None
+        self.reg[:] = data[start:start + 8]
+        self.ram[:] = data[start + 8:start + 8 + 256]
+        self.invalidate()
+
+    @classmethod
+    def from_snapshot(cls, data, output=None):
+        """New CPU with the state of a snapshot()"""
+
+        cpu = cls(output)
+        cpu.restore(data)
+        return cpu
+
+    def fork(self, output=None):
+        """
+        New CPU with a copy of this one's state, e.g. to set up a program once and then run it with many different inputs.
+        RAM is only 256 bytes so copying it is cheaper than sharing pages copy-on-write.
+        The fork doesn't share the output sink, it captures its own output unless one is given.
+        """
+
+        cpu = type(self)(output)
+        cpu.PC = self.PC
+        cpu.FL = self.FL
+        cpu.running = self.running
+        cpu.interrupts_enabled = self.interrupts_enabled
+        cpu.cycles = self.cycles
+        cpu.reg[:] = self.reg
+        cpu.ram[:] = self.ram
+        return cpu
+
+    def load_bytes(self, data, address=0):
+        """Copy machine code (bytes, bytearray, memoryview or a list of ints) into RAM starting at a given address."""
+
+        if address + len(data) > len(self.ram):
+            raise ValueError(f"program of {len(data)} bytes doesn't fit in RAM at address {address}")
+
+        self.ram[address:address + len(data)] = bytes(data)
+        self.invalidate()
+        return len(data)
+
+    def load_program(self, source):
+        """
+        Load a program in the .ls8 text format (one binary number per line, # starts a comment) from memory.
+        source can be the whole text or anything that gives lines like an open file. Returns the number of bytes loaded.
+        """
+
+        return self.load_bytes(parse_program(source))
+
+    def load_image(self, data):
+        """
+        Load a binary image (see image.py), the code goes straight into RAM and the PC is set to its entry point.
+        Returns the Image so the caller can use its symbols and source map.
+        """
+
+        image = read_image(data)
+        self.load_bytes(image.code)
+        self.PC = image.entry
+        return image
+
+    def load_file(self, path):
+        """
+        Load a .ls8 text file or a .ls8b binary image (files that start with the image header are always images).
+        "-" reads the program from stdin, e.g. piped from asm.py -s.
+        Raises FileNotFoundError if it doesn't exist. Returns the number of bytes loaded.
+        """
+
+        if path == "-":
+            data = sys.stdin.buffer.read()
+        else:
+            with open(path, "rb") as file:
+                data = file.read()
+
+        return self.load_data(data, path.endswith(".ls8b"))
+
+    def load_data(self, data, binary=False):
+        """
+        Load the contents of a .ls8 or .ls8b file (binary, or data that starts with the image header, is an image).
+        Returns the number of bytes loaded.
+        """
+
+        if binary or data.startswith(IMAGE_MAGIC):
+            return len(self.load_image(data).code)
+
+        return self.load_program(data.decode())
 
     def load(self, args=sys.argv):
-        """Load a program into memory."""
+        """Load the program given on the command line into memory, exits with a usage message on errors."""
 
-        address = 0
         if(len(args) == 2):
             try:
-                with open(args[1], "r") as file:
-                    for instruction in file:
-                        instruction = re.sub(
-                            r'[^01]+', '', instruction.split("#")[0])
-                        # print(re.sub(r'[^01]+', '', instruction.split("#")[0]))
-                        if instruction != "":
-                            # self.ram[address] = bin(int("0b"+instruction, 2))
-                            # print(f"{int(instruction,2):08b}")
-                            self.ram_write(address, int(instruction, 2))
-                            address += 1
+                self.load_file(args[1])
             except FileNotFoundError:
                 print("file not found!")
                 sys.exit(2)
@@ -70,44 +331,14 @@ class CPU:
             print("usage: ./ls8.py <filename>")
             sys.exit(1)
 
-    def alu(self, op, reg_a, reg_b):
-        """ALU (Arithmetic Logic Instructions) operations."""
-        """ 0xFF is used to mask(cut/slice) the size of the output to 255 (8 bits) since our machine is only 8 bits"""
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b] & 0xFF
-        elif op == "SUB":
-            self.reg[reg_a] -= self.reg[reg_b] & 0xFF
-        elif op == "MUL":
-            self.reg[reg_a] *= self.reg[reg_b] & 0xFF
-        elif op == "DIV":
-            self.reg[reg_a] /= self.reg[reg_b] & 0xFF
-        elif op == "MOD":
-            self.reg[reg_a] %= self.reg[reg_b] & 0xFF
-        elif op == "CMP":
-            # clean the previous flag value or it will influence the bitwise or |
-            self.FL = 0b0
-            if self.reg[reg_a] == self.reg[reg_b]:
-                self.FL = self.FL | 0b00000001
-            if self.reg[reg_a] > self.reg[reg_b]:
-                self.FL = self.FL | 0b00000010
-            if self.reg[reg_a] < self.reg[reg_b]:
-                self.FL = self.FL | 0b00000100
-        elif op == "AND":
-            # normal "and" doesnt work. try "4 and 3" vs "4 & 3" and see the results
-            self.reg[reg_a] &= self.reg[reg_b]
-        elif op == "OR":
-            self.reg[reg_a] |= self.reg[reg_b]
-        elif op == "XOR":
-            self.reg[reg_a] ^= self.reg[reg_b]
-        elif op == "NOT":
-            self.reg[reg_a] = ~self.reg[reg_a]
-        elif op == "SHL":
-            self.reg[reg_a] <<= self.reg[reg_b] & 0xFF
-        elif op == "SHR":
-            self.reg[reg_a] >>= self.reg[reg_b] & 0xFF
-
-        else:
-            raise Exception("Unsupported ALU operation")
+    def alu(self, op, reg_a, reg_b=0):
+        """ALU (Arithmetic Logic Instructions) operations, op is the opcode of the instruction (see ALU)."""
+        try:
+            self.reg[reg_a] = ALU[op](self.reg[reg_a], self.reg[reg_b])
+        except ZeroDivisionError:
+            # the spec says DIV and MOD by 0 should print an error and halt, whoever called run() gets the error as the halt reason
+            self.running = False
+            self.halt_reason = "division by zero"
 
     def trace(self):
         """
@@ -129,65 +360,197 @@ class CPU:
 
         print()
 
+    def ram_view(self):
+        """
+        Returns a memoryview of the RAM, so loaders, snapshots and debuggers can read or copy it without making a copy first.
+        Writing through the view skips ram_write(), so call invalidate() after changing code with it.
+        """
+        return memoryview(self.ram)
+
+    def reg_view(self):
+        """Returns a memoryview of the registers R0-R7"""
+        return memoryview(self.reg)
+
+    def invalidate(self):
+        """Forget every decoded instruction and compiled block, needed after RAM is changed without ram_write()"""
+        self.decoded.clear()
+        if self.blocks is not None:
+            self.blocks.clear()
+
     def ram_read(self, position):
         return self.ram[position]
 
     def ram_write(self, position, value):
         self.ram[position] = value
+        # the written byte can be the opcode of a cached instruction or one of the operands of the 2 before it
+        self.decoded.pop(position, None)
+        self.decoded.pop((position - 1) & 0xFF, None)
+        self.decoded.pop((position - 2) & 0xFF, None)
+        if self.blocks is not None:
+            self.blocks.invalidate(position)
+
+    def decode(self, address):
+        """
+        Decodes the instruction at a given address only once and saves it in the decoded cache.
+        Returns a tuple with the handler (operands are already bound so it can be called without arguments)
+        and the instruction size (number of operands + 1) that the PC has to move after running it.
+        Raises KeyError if the opcode is not in the branchtable and ValueError if an operand that has to be
+        a register isn't one (see invalid_register()).
+        """
+
+        IR = self.ram_read(address)  # Instruction Register
+        op_size = (IR >> 6)  # number of operands, see run()
+        handler = self.branchtable[IR]
+        a = self.ram_read((address + 1) & 0xFF)
+        b = self.ram_read((address + 2) & 0xFF)
+
+        error = invalid_register(IR, a, b)
+        if error is not None:
+            raise ValueError(error)
+
+        if op_size == 1:
+            handler = partial(handler, a)
+        elif op_size == 2:
+            handler = partial(handler, a, b)
+
+        if IR in WRITES_REGISTER and a in INTERRUPT_REGISTERS:
+            # an interrupt that was masked (or just set in IS) can be taken now, only these instructions pay for checking it
+            handler = partial(self.mask_changed, handler)
+
+        self.decoded[address] = (handler, op_size + 1)
+        return self.decoded[address]
+
+    def fetch(self, address):
+        """
+        Same as decode() but for the run loops, if there is no valid instruction at that address
+        it stops the CPU with the reason and returns None instead of raising.
+        """
+
+        try:
+            return self.decode(address)
+        except KeyError:
+            self.halt_reason = f"invalid instruction [{self.ram[address]:08b}]"
+        except IndexError:
+            self.halt_reason = f"PC out of RAM [{address:02X}]"
+        except ValueError as error:
+            self.halt_reason = str(error)
+
+        self.running = False
+        return None
+
+    def result(self):
+        """RunResult with the current state"""
+
+        output = self.output.getvalue() if isinstance(self.output, io.StringIO) else None
+        return RunResult(self.halt_reason, self.cycles, bytes(self.reg), self.PC, self.FL, output)
 
     def LDI(self, position, value):
         """Load Immediate"""
         self.reg[position] = value
 
-    def ADD(self, a, b):
-        self.alu("ADD", a, b)
+    def PRN(self, position):
+        self.output.write(DECIMAL[self.reg[position]])
+
+    def NOP(self):
+        pass
+
+    def PRA(self, position):
+        """Print the ASCII character of the value in a register"""
+        self.output.write(CHARACTERS[self.reg[position]])
+
+    def LD(self, register1, register2):
+        """Load register1 with the value at the address stored in register2"""
+        self.reg[register1] = self.ram_read(self.reg[register2])
+
+    def INT(self, register):
+        """Issue the interrupt number stored in a register, it's taken before the next instruction"""
+        self.reg[IS] |= 1 << (self.reg[register] & 0b111)
+        # stop the run loop after this instruction so it checks the interrupts (see execute())
+        self.running = False
 
-    def SUB(self, a, b):
-        self.alu("SUB", a, b)
+    def IRET(self):
+        """Return from an interrupt handler, undoes what service_interrupts() pushed and enables interrupts again"""
 
-    def MUL(self, a, b):
-        self.alu("MUL", a, b)
+        for register in range(IS, -1, -1):
+            self.POP(register)
+        self.FL = self.ram_read(self.reg[self.sp])
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
+        # minus 1 because the operation size (op_size) does +1 after
+        self.PC = self.ram_read(self.reg[self.sp]) - 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
+        self.interrupts_enabled = True
 
-    def DIV(self, a, b):
-        self.alu("DIV", a, b)
+        # back to execute() so it flushes what the handler printed and takes interrupts that waited while this one ran
+        self.running = False
 
-    def MOD(self, a, b):
-        self.alu("MOD", a, b)
+    def raise_interrupt(self, number, address=None, value=None):
+        """
+        Called by devices, possibly from another thread, to set bit `number` of IS.
+        If address is given, value is written there first (the keyboard puts the key in 0xF4).
+        The run loop only notices because running goes False, so it doesn't have to check anything per instruction.
+        """
+        self.requests.append((number, address, value))
+        self.running = False
 
-    def AND(self, a, b):
-        self.alu("AND", a, b)
+    def mask_changed(self, handler):
+        """Runs an instruction that writes IM or IS, then stops the run loop so execute() checks the interrupts"""
+        handler()
+        self.running = False
 
-    def OR(self, a, b):
-        self.alu("OR", a, b)
+    def service_interrupts(self):
+        """
+        Takes the queued device interrupts into IS, then if interrupts are enabled and one of them isn't masked by IM
+        jumps to its handler: pushes the PC, FL and R0-R6, disables interrupts and sets the PC from the vector table.
+        """
 
-    def XOR(self, a, b):
-        self.alu("XOR", a, b)
+        while self.requests:
+            number, address, value = self.requests[0]
 
-    def NOT(self, a, b):
-        self.alu("NOT", a, b)
+            if self.reg[IS] & (1 << number) and address is not None:
+                # the last one wasn't handled yet, keep this one (e.g. the next key) queued so it doesn't overwrite it
+                break
 
-    def SHL(self, a, b):
-        self.alu("SHL", a, b)
+            self.requests.popleft()
+            if address is not None:
+                self.ram_write(address, value)
+            self.reg[IS] |= 1 << number
 
-    def SHR(self, a, b):
-        self.alu("SHR", a, b)
+        if not self.interrupts_enabled:
+            return
 
-    def PRN(self, position):
-        print(self.reg[position])
+        masked = self.reg[IM] & self.reg[IS]
+        if masked == 0:
+            return
+
+        # lowest interrupt number first
+        number = (masked & -masked).bit_length() - 1
+
+        self.interrupts_enabled = False
+        self.reg[IS] &= ~(1 << number) & 0xFF
+
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
+        self.ram_write(self.reg[self.sp], self.PC & 0xFF)
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
+        self.ram_write(self.reg[self.sp], self.FL)
+        for register in range(IS + 1):
+            self.PUSH(register)
+
+        self.PC = self.ram_read(VECTORS + number)
 
     def HLT(self):
-        self.running = False  # This is not really needed
-        sys.exit(0)
+        self.running = False
+        self.halt_reason = HALTED
 
     # pushes a given register to the stack
     def PUSH(self, register):
-        self.reg[self.sp] -= 1
+        # & 0xFF because the SP is an 8 bit register too
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
         self.ram_write(self.reg[self.sp], self.reg[register])
 
     # pops from the stack into a given register
     def POP(self, register):
-        self.reg[register] = self.ram_read()[self.reg[self.sp]]
-        self.reg[self.sp] += 1
+        self.reg[register] = self.ram_read(self.reg[self.sp])
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
 
     def CALL(self, register):
         """
@@ -195,9 +558,9 @@ class CPU:
         and sets the PC (Program Counter) to a given register value that stored where it wants to go/call
         """
 
-        self.reg[self.sp] -= 1
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
         # plus 2 because its the current instruction + the next one + the actual one it should come to later when it does RET
-        self.ram_write(self.reg[self.sp], self.PC + 2)
+        self.ram_write(self.reg[self.sp], (self.PC + 2) & 0xFF)
         # minus 2 because the operation size (op_size) is 1 and does another +1 after
         self.PC = self.reg[register] - 2
 
@@ -209,7 +572,12 @@ class CPU:
 
         # minus 1 because the operation size (op_size) does does +1 after
         self.PC = self.ram_read(self.reg[self.sp]) - 1
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
+
+    def ST(self, register1, register2):
+        """Store the value in register2 in the address stored in register1"""
+        # goes through ram_write() so the decoded cache is updated if the program modifies itself
+        self.ram_write(self.reg[register1], self.reg[register2])
 
     def CMP(self, register1, register2):
         """
@@ -221,8 +589,12 @@ class CPU:
         L Less-than: during a CMP, set to 1 if registerA is less than registerB, zero otherwise.
         G Greater-than: during a CMP, set to 1 if registerA is greater than registerB, zero otherwise.
         E Equal: during a CMP, set to 1 if registerA is equal to registerB, zero otherwise.
+
+        The whole FL is replaced so flags from the previous CMP don't stay set.
         """
-        self.alu("CMP", register1, register2)
+        a = self.reg[register1]
+        b = self.reg[register2]
+        self.FL = (a < b) << 2 | (a > b) << 1 | (a == b)
 
     def JMP(self, register):
         # minus 2 because the operation size (op_size) is 1 and does another +1 after
@@ -265,41 +637,151 @@ class CPU:
         else:
             self.PC += 2 - 2
 
-    def run(self):
-        """Run the CPU."""
+    def execute(self, loop, max_cycles=None, deadline=None):
+        """
+        Runs one of the run loops (CPU.loop, BlockCompiler.loop, Profile.loop) until the CPU stops,
+        with max_cycles turned into the cycle count where it has to stop. Returns a RunResult.
+
+        A loop returns when running goes False. If that happened without a halt reason it was an interrupt
+        (a device, INT or IRET), so the interrupts are serviced here and the loop starts again.
+        That way the loops themselves don't check anything for interrupts.
+
+        deadline is a time.monotonic() time. The loops never look at the clock, with a deadline they get
+        DEADLINE_CHECK cycles at a time and the clock is checked here in between.
+        """
+
+        self.halt_reason = None
+        limit = float("inf") if max_cycles is None else self.cycles + max_cycles
+
+        try:
+            while True:
+                # running has to be True before the interrupts are checked, a device that raises one after this
+                # sets it back to False and the loop comes back here straight away
+                self.running = True
+                self.service_interrupts()
+                loop(limit if deadline is None else min(limit, self.cycles + DEADLINE_CHECK))
+
+                # buffered output goes out on interrupts too so interactive programs show it
+                self.flush()
+
+                if self.halt_reason == "max cycles" and self.cycles < limit:
+                    # only the slice before the next clock check ran out
+                    if time.monotonic() >= deadline:
+                        self.halt_reason = "deadline"
+                        break
+                    self.halt_reason = None
+
+                if self.halt_reason is not None:
+                    break
+        finally:
+            # and when the CPU stops, even if a loop raised, so what the program printed before isn't lost
+            self.flush()
 
-        self.running = True
-        op_size = 0  # operation size
+        return self.result()
+
+    def flush(self):
+        """Flush the output sink, if it has anything to flush"""
+
+        flush = getattr(self.output, "flush", None)
+        if flush is not None:
+            flush()
+
+    def run(self, max_cycles=None, profile=None, deadline=None, engine=None):
+        """
+        Run the CPU until HLT, an error, until it has executed max_cycles more instructions
+        or until time.monotonic() gets to deadline.
+        Returns a RunResult, after "max cycles" or "deadline" calling run() again continues where it stopped.
+
+        engine is anything with a run(cpu, max_cycles, deadline) that runs the CPU its own way: a profiler.Profile,
+        tracer.Recorder, memo.Memo or fastforward.FastForward. profile is the same thing, from before there were others.
+        """
+
+        if profile is not None:
+            if engine is not None:
+                raise ValueError("run() takes one engine, a profile is one")
+            engine = profile
+
+        if engine is not None:
+            return engine.run(self, max_cycles, deadline)
+
+        return self.execute(self.loop, max_cycles, deadline)
+
+    def loop(self, limit):
+        """The interpreter, runs instructions while running is True and the cycle count is under limit"""
+
+        decoded = self.decoded  # local name so the loop doesn't look it up on self every cycle
 
         while self.running:
-            IR = self.ram_read(self.PC)  # Instruction Register
+            if self.cycles >= limit:
+                self.running = False
+                self.halt_reason = "max cycles"
+                break
 
             """
-            This does a bitwise operation to shift the current IR (Instruction Register) value by 6 bits in this >> direction
-            so that 0b10000010 turns into 0b00000010
-            and 0b01000010 turns into 0b00000001
-            (ads 6 zeros on the left side, pushing everything else right and "eliminating/clipping it")
-            that tells us how many "jumps" we have to increase by (0, 1 or 2)
-            In other words: it turns the 2 "highest" (left) bits into a new binary 00, 01, 10 
-            that tells us how many operants will follow the current instruction, 0, 1, 2
+            Each instruction is only decoded the first time the PC reaches it (see decode()),
+            after that the handler and its operands come straight from the cache
+            so there is no ram_read, no IR >> 6 and no branchtable lookup per cycle
             """
-            op_size = (IR >> 6)
+            instruction = decoded.get(self.PC)
 
-            operand_a = self.ram_read(self.PC + 1)
-            operand_b = self.ram_read(self.PC + 2)
+            if instruction is None:
+                instruction = self.fetch(self.PC)
+                if instruction is None:
+                    break
 
-            # print(f"{IR:08b}")
-            # print(f"{self.branchtable[IR]}")
+            handler, size = instruction
+            self.cycles += 1
+            handler()
 
-            try:
-                if op_size == 0:
-                    self.branchtable[IR]()
-                elif op_size == 1:
-                    self.branchtable[IR](operand_a)
-                elif op_size == 2:
-                    self.branchtable[IR](operand_a, operand_b)
-            except KeyError:
-                print(f"invalid instruction [{self.ram[self.PC]:08b}]")
-                running = False
-
-            self.PC += (op_size+1)
+            self.PC += size
+
+    def hooked_loop(self, limit, before=None, after=None, watch=None):
+        """
+        Same as loop() for the engines that have to see every instruction, so they all fetch, count cycles and stop
+        exactly the way the interpreter does. loop() is kept separate so a plain run doesn't pay for the hooks.
+
+        before(PC) is called once the instruction at PC is fetched, if it returns True it did the instruction itself
+        (moving the PC and the cycle count) and the loop goes on from there.
+        after(PC) is called after the instruction at PC ran, the PC has already moved past it.
+        With watch (a set of opcodes, the caller can change it while the loop runs) the hooks are only called for
+        the instructions in it.
+        """
+
+        decoded = self.decoded
+        ram = self.ram
+        hooked = True
+
+        while self.running:
+            if self.cycles >= limit:
+                self.running = False
+                self.halt_reason = "max cycles"
+                break
+
+            PC = self.PC
+            instruction = decoded.get(PC) or self.fetch(PC)
+            if instruction is None:
+                break
+
+            if watch is not None:
+                hooked = ram[PC] in watch
+
+            if hooked and before is not None and before(PC):
+                continue
+
+            handler, size = instruction
+            self.cycles += 1
+            handler()
+
+            self.PC += size
+
+            if hooked and after is not None:
+                after(PC)
+
+    def run_blocks(self, max_cycles=None, deadline=None):
+        """Run the CPU compiling the program into python functions, one per basic block (see blocks.py)."""
+
+        from blocks import BlockCompiler
+
+        if self.blocks is None:
+            self.blocks = BlockCompiler(self)
+        return self.execute(self.blocks.loop, max_cycles, deadline)
@@ -0,0 +1,77 @@
+"""Devices that raise interrupts: a timer (I0) and the keyboard (I1)."""
+
+import os
+import sys
+import threading
+
+TIMER_INTERRUPT = 0
+KEYBOARD_INTERRUPT = 1
+KEY_ADDRESS = 0xF4      # the keyboard leaves the last key pressed here
+
+
+class Timer:
+    """Raises the timer interrupt every interval seconds (once per second in the spec) from its own thread"""
+
+    def __init__(self, cpu, interval=1.0):
+        self.cpu = cpu
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.tick, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def tick(self):
+        # wait() returns True when stop() is called, otherwise it timed out and it's time for an interrupt
+        while not self.stopped.wait(self.interval):
+            self.cpu.raise_interrupt(TIMER_INTERRUPT)
+
+
+class Keyboard:
+    """
+    Reads keys from a stream (stdin by default) in its own thread, so the CPU never blocks waiting for input.
+    Each key goes to address 0xF4 and raises the keyboard interrupt.
+    If the stream is a terminal it's put in cbreak mode so keys arrive as soon as they're pressed, stop() puts it back.
+    """
+
+    def __init__(self, cpu, stream=None):
+        self.cpu = cpu
+        self.stream = sys.stdin if stream is None else stream
+        self.saved_mode = None
+        self.thread = threading.Thread(target=self.read, daemon=True)
+
+    def start(self):
+        if self.stream.isatty():
+            import termios
+            import tty
+
+            fd = self.stream.fileno()
+            self.saved_mode = termios.tcgetattr(fd)
+            tty.setcbreak(fd)
+
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.saved_mode is not None:
+            import termios
+
+            termios.tcsetattr(self.stream.fileno(), termios.TCSADRAIN, self.saved_mode)
+            self.saved_mode = None
+
+    def read(self):
+        fd = self.stream.fileno() if hasattr(self.stream, "fileno") and self.stream.isatty() else None
+
+        while True:
+            # a terminal is read with os.read() so a single key comes back without waiting for a whole line
+            key = os.read(fd, 1) if fd is not None else self.stream.read(1)
+            if not key:
+                break
+
+            if isinstance(key, str):
+                key = key.encode()[:1]
+            self.cpu.raise_interrupt(KEYBOARD_INTERRUPT, KEY_ADDRESS, key[0])
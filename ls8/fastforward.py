@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+"""
+Hot loop fast-forwarding. A loop whose body is straight-line register arithmetic ending in a conditional jump back
+to its start (the inner loop of loop.asm, multiply/accumulate kernels) is found by counting how often that jump is
+taken, and then run in bulk instead of one instruction at a time: in closed form when every register the body
+changes goes up or down by the same amount each time around, otherwise as a compiled Python loop.
+Registers, FL, the PC and the cycle count come out exactly as if every instruction had run.
+"""
+
+import sys
+import argparse
+from collections import namedtuple
+
+from cpu import CPU, NAMES, CONDITIONS, INTERRUPT_REGISTERS
+from blocks import TEMPLATES
+
+OPCODES = {name: opcode for opcode, name in NAMES.items()}
+NOP = OPCODES["NOP"]
+LDI = OPCODES["LDI"]
+CMP = OPCODES["CMP"]
+
+HOT = 16            # times a jump back has to be taken before its loop is looked at
+BULK = 100000       # most cycles a compiled loop runs at a time, so device interrupts don't wait too long
+# the registers in a closed form loop repeat after 256 iterations at most, one that hasn't left by then never will
+SEARCH = 256
+
+"""
+A loop that can be fast-forwarded, from head (the jump target) to the jump at the end of the body.
+length: instructions in the body with the jump
+condition: (FL bits, taken when clear) of the jump, written: registers the body writes
+closed: what the body does to the registers, see closed_form(), None if it needs bulk
+bulk: compiled function that runs up to n iterations, see compile_bulk()
+"""
+Loop = namedtuple("Loop", ["head", "jump", "length", "condition", "written", "closed", "bulk"])
+
+
+def find_loop(ram, head, jump):
+    """The Loop from head to the jump at jump, None if it isn't one that can be fast-forwarded"""
+
+    if jump + 1 >= len(ram) or ram[jump] not in CONDITIONS or ram[jump + 1] > 7:
+        return None
+
+    body = []
+    address = head
+
+    while address < jump:
+        IR = ram[address]
+        size = (IR >> 6) + 1
+        a = ram[address + 1] if size > 1 else 0
+        b = ram[address + 2] if size > 2 else 0
+
+        if IR != NOP and IR not in TEMPLATES:
+            return None
+        if a > 7 or (size > 2 and IR != LDI and b > 7):
+            return None
+        if IR not in (NOP, CMP) and a in INTERRUPT_REGISTERS:
+            # writing IM or IS has to go back to the run loop
+            return None
+
+        body.append((IR, a, b))
+        address += size
+
+    written = frozenset(a for IR, a, b in body if IR not in (NOP, CMP))
+    if address != jump or ram[jump + 1] in written:
+        return None
+
+    return Loop(head, jump, len(body) + 1, CONDITIONS[ram[jump]], written,
+                closed_form(body, written), compile_bulk(head, body, CONDITIONS[ram[jump]]))
+
+
+def closed_form(body, written):
+    """
+    Follows the body keeping every register as (base, constant, terms): the value base had at the start of the
+    iteration (0 if base is None) plus constant plus sign * value for each (sign, register) in terms, registers
+    the loop never writes. Only INC, DEC, LDI, ADD and SUB of those keep that shape.
+    Returns (the registers at the end of the body, the operands of the last CMP or None), or None.
+    """
+
+    values = {register: (register, 0, ()) for register in range(8)}
+    compare = None
+
+    for IR, a, b in body:
+        name = NAMES[IR]
+
+        if name == "LDI":
+            values[a] = (None, b, ())
+        elif name in ("INC", "DEC"):
+            base, constant, terms = values[a]
+            values[a] = (base, constant + (1 if name == "INC" else -1), terms)
+        elif name in ("ADD", "SUB"):
+            base, constant, terms = values[a]
+            other, other_constant, other_terms = values[b]
+            if other is not None and other in written:
+                return None
+
+            sign = 1 if name == "ADD" else -1
+            if other is not None:
+                terms += ((sign, other),)
+            terms += tuple((sign * s, register) for s, register in other_terms)
+            values[a] = (base, constant + sign * other_constant, terms)
+        elif name == "CMP":
+            compare = (values[a], values[b])
+        elif name != "NOP":
+            return None
+
+    return values, compare
+
+
+def compile_bulk(head, body, condition):
+    """
+    Compiles the body into a function (r0, ..., r7, FL, n) that goes around the loop up to n times.
+    Returns (iterations, left the loop, r0, ..., r7, FL).
+    """
+
+    registers = ", ".join(f"r{register}" for register in range(8))
+    bits, when_clear = condition
+    # leaves when the jump isn't taken
+    leaves = f"FL & {bits}" if when_clear else f"not FL & {bits}"
+
+    lines = [f"def loop_{head:02x}({registers}, FL, n):", "    for i in range(n):"]
+    lines.extend("        " + ("pass" if IR == NOP else TEMPLATES[IR].format(a=a, b=b)) for IR, a, b in body)
+    lines.append(f"        if {leaves}:")
+    lines.append(f"            return i + 1, True, {registers}, FL")
+    lines.append(f"    return n, False, {registers}, FL")
+
+    source = "\n".join(lines) + "\n"
+    namespace = {}
+    exec(compile(source, f"<loop {head:02X}>", "exec"), namespace)
+    bulk = namespace[f"loop_{head:02x}"]
+    bulk.source = source
+    return bulk
+
+
+class FastForward:
+    """
+    Runs a CPU with CPU.run(engine=fastforward) or fastforward.run(cpu). Loops are looked at once their jump back
+    has been taken HOT times, and checked against the bytes they were compiled from every time, so code that
+    changes just goes back to being interpreted. Device interrupts are taken between bulk steps, not in the middle of one.
+    """
+
+    def __init__(self):
+        self.counts = {}        # address of a jump back -> times it was taken
+        self.loops = {}         # (head, jump) -> (the bytes of the loop, Loop or None if it can't be fast-forwarded)
+        self.closed = 0         # times a loop was run in closed form
+        self.bulk = 0           # times a loop was run with its compiled function
+        self.skipped = 0        # cycles that didn't have to be interpreted
+
+    def run(self, cpu, max_cycles=None, deadline=None):
+        """Same as CPU.run() but fast-forwarding hot loops"""
+
+        return cpu.execute(lambda limit: self.loop(cpu, limit), max_cycles, deadline)
+
+    def loop(self, cpu, limit):
+        """CPU.loop() with a hook that counts the jumps back and fast-forwards the loops they close"""
+
+        ram = cpu.ram
+        counts = self.counts
+
+        def after(PC):
+            # a conditional jump that went back to (or before) itself
+            if cpu.PC <= PC and ram[PC] in CONDITIONS:
+                count = counts.get(PC, 0) + 1
+                counts[PC] = count
+                if count >= HOT:
+                    self.forward(cpu, PC, limit)
+
+        cpu.hooked_loop(limit, after=after)
+
+    def forward(self, cpu, jump, limit):
+        """The jump at jump just went back to the PC, runs the loop there in bulk if it can"""
+
+        head = cpu.PC
+        code = cpu.ram[head:jump + 2]
+        known = self.loops.get((head, jump))
+
+        if known is None or known[0] != code:
+            known = (bytes(code), find_loop(cpu.ram, head, jump))
+            self.loops[(head, jump)] = known
+
+        loop = known[1]
+        if loop is None:
+            return
+
+        # iterations that fit before limit
+        room = (limit - cpu.cycles) // loop.length if limit != float("inf") else limit
+        if room < 1:
+            return
+
+        if loop.closed is not None and self.run_closed(cpu, loop, room):
+            return
+        self.run_bulk(cpu, loop, room)
+
+    def run_closed(self, cpu, loop, room):
+        """
+        Works out how many times the loop goes around from the registers it compares, then sets every register
+        it writes to what it would be after that. Returns False if the loop never ends and there's no limit.
+        """
+
+        reg = cpu.reg
+        values, compare = loop.closed
+
+        def evaluate(constant, terms):
+            return constant + sum(sign * reg[register] for sign, register in terms)
+
+        steps = {}      # registers that change by the same amount every time around
+        resets = {}     # registers that are loaded with the same value every time around
+        for register in loop.written:
+            base, constant, terms = values[register]
+            if base is None:
+                resets[register] = evaluate(constant, terms) & 0xFF
+            else:
+                steps[register] = evaluate(constant, terms)
+
+        def operand(value):
+            # (value in the first iteration, p, q): in iteration i after that it's (p + q * i) & 0xFF
+            base, constant, terms = value
+            offset = evaluate(constant, terms)
+            if base is None:
+                return offset & 0xFF, offset, 0
+            if base in steps:
+                step = steps[base]
+                return (reg[base] + offset) & 0xFF, reg[base] - step + offset, step
+            if base in resets:
+                return (reg[base] + offset) & 0xFF, resets[base] + offset, 0
+            return (reg[base] + offset) & 0xFF, reg[base] + offset, 0
+
+        def flags(i):
+            x = first_x if i == 1 else (px + qx * i) & 0xFF
+            y = first_y if i == 1 else (py + qy * i) & 0xFF
+            return (x < y) << 2 | (x > y) << 1 | (x == y)
+
+        bits, when_clear = loop.condition
+        if compare is not None:
+            first_x, px, qx = operand(compare[0])
+            first_y, py, qy = operand(compare[1])
+
+        # iterations until the jump isn't taken, None if it always is
+        trips = None
+        for i in range(1, SEARCH + 2):
+            FL = flags(i) if compare is not None else cpu.FL
+            if bool(FL & bits) == when_clear:
+                trips = i
+                break
+
+        if trips is not None and trips <= room:
+            iterations = trips
+        elif room != float("inf"):
+            iterations = int(room)
+        else:
+            return False
+
+        for register, step in steps.items():
+            reg[register] = (reg[register] + iterations * step) & 0xFF
+        for register, value in resets.items():
+            reg[register] = value
+        if compare is not None:
+            cpu.FL = flags(iterations)
+
+        self.finish(cpu, loop, iterations, iterations == trips)
+        self.closed += 1
+        return True
+
+    def run_bulk(self, cpu, loop, room):
+        """Goes around the loop with its compiled function"""
+
+        reg = cpu.reg
+        iterations, left, *registers, FL = loop.bulk(*reg, cpu.FL, int(min(room, max(1, BULK // loop.length))))
+
+        reg[:] = bytes(registers)
+        cpu.FL = FL
+        self.finish(cpu, loop, iterations, left)
+        self.bulk += 1
+
+    def finish(self, cpu, loop, iterations, left):
+        cycles = iterations * loop.length
+        cpu.cycles += cycles
+        self.skipped += cycles
+        if left:
+            cpu.PC = loop.jump + 2
+
+    def report(self, file=sys.stdout):
+        print(f"{self.closed} loops run in closed form, {self.bulk} in bulk, {self.skipped} cycles skipped", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run an LS-8 program fast-forwarding its hot loops.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU(output=sys.stdout)
+    cpu.load_file(args.program)
+
+    fastforward = FastForward()
+    result = cpu.run(args.max_cycles, engine=fastforward)
+
+    if result.reason != "HLT":
+        print(result.reason, file=sys.stderr)
+    fastforward.report(file=sys.stderr)
+
+    return result.status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
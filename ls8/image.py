@@ -0,0 +1,74 @@
+"""Binary program images (.ls8b), the machine code as raw bytes with an optional header."""
+
+import struct
+from collections import namedtuple
+
+# header: magic, format version, entry point, code length, number of symbols, number of source map entries
+# then the code bytes, the symbols (address, name length, name) and the source map (address, source line)
+# asm/asm.py writes the same format
+HEADER = struct.Struct("<4sBBHHH")
+SYMBOL = struct.Struct("<BB")
+SOURCE_LINE = struct.Struct("<BH")
+MAGIC = b"LS8I"
+VERSION = 1
+
+# code: bytes to load at address 0, entry: address where execution starts
+# symbols: {label: address}, source_map: {address: line number in the .asm source}
+Image = namedtuple("Image", ["code", "entry", "symbols", "source_map"])
+
+
+def read_image(data):
+    """
+    Reads a binary image. Data without the header is taken as raw machine code that starts at address 0.
+    Raises ValueError if the header is there but the image is broken.
+    """
+
+    data = memoryview(data)
+
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        return Image(bytes(data), 0, {}, {})
+
+    try:
+        magic, version, entry, length, symbol_count, line_count = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f"unsupported image version {version}")
+
+        offset = HEADER.size
+        code = bytes(data[offset:offset + length])
+        if len(code) != length:
+            raise ValueError("image is truncated")
+        offset += length
+
+        symbols = {}
+        for _ in range(symbol_count):
+            address, name_length = SYMBOL.unpack_from(data, offset)
+            offset += SYMBOL.size
+            symbols[bytes(data[offset:offset + name_length]).decode()] = address
+            offset += name_length
+
+        source_map = {}
+        for _ in range(line_count):
+            address, line = SOURCE_LINE.unpack_from(data, offset)
+            offset += SOURCE_LINE.size
+            source_map[address] = line
+    except struct.error:
+        raise ValueError("image is truncated")
+
+    return Image(code, entry, symbols, source_map)
+
+
+def write_image(code, entry=0, symbols=None, source_map=None):
+    """Returns the bytes of a binary image with its header"""
+
+    symbols = symbols or {}
+    source_map = source_map or {}
+    parts = [HEADER.pack(MAGIC, VERSION, entry, len(code), len(symbols), len(source_map)), bytes(code)]
+
+    for name, address in symbols.items():
+        name = name.encode()
+        parts.append(SYMBOL.pack(address, len(name)) + name)
+
+    for address, line in sorted(source_map.items()):
+        parts.append(SOURCE_LINE.pack(address, line))
+
+    return b"".join(parts)
@@ -0,0 +1,55 @@
+"""
+Messages between server.py and client.py over a Unix domain socket: a 4 byte length and then that much JSON.
+Binary data (programs, input) goes in the JSON as base64. Only imports the standard library so the client starts fast.
+"""
+
+import os
+import json
+import struct
+import base64
+
+LENGTH = struct.Struct(">I")
+
+# where the server listens unless LS8_SOCKET says otherwise
+# (tempfile.gettempdir() would say the same but importing tempfile takes longer than the whole request)
+SOCKET = os.environ.get("LS8_SOCKET") or os.path.join(os.environ.get("TMPDIR", "/tmp"), f"ls8-{os.getuid()}.sock")
+
+
+def send(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+
+def receive(sock):
+    """The next message, or None if the other side closed the connection"""
+
+    header = read_exactly(sock, LENGTH.size)
+    if header is None:
+        return None
+
+    data = read_exactly(sock, LENGTH.unpack(header)[0])
+    if data is None:
+        return None
+
+    return json.loads(data)
+
+
+def read_exactly(sock, size):
+    parts = []
+
+    while size:
+        part = sock.recv(min(size, 65536))
+        if not part:
+            return None
+        parts.append(part)
+        size -= len(part)
+
+    return b"".join(parts)
+
+
+def encode(data):
+    return base64.b64encode(data).decode()
+
+
+def decode(text):
+    return base64.b64decode(text)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+Lockstep engine, runs one program on many machines at once with NumPy.
+
+All the machines live in arrays (RAM is N x 256, the registers N x 8) and every step runs the instruction at each
+distinct (PC, instruction) once for the whole group of machines that are there, so the Python overhead is paid per
+group instead of per machine. Machines whose PCs went different ways just end up in different groups.
+"""
+
+import sys
+import argparse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cpu import CPU, ALU, NAMES, DECIMAL, CHARACTERS, HALTED, RunResult, invalid_register
+
+OPCODES = {name: opcode for opcode, name in NAMES.items()}
+SP = 7
+
+# FL bits each conditional jump checks, the jump is taken if any of them is set (JNE: if E isn't)
+CONDITIONS = {
+    OPCODES["JEQ"]: 0b001,
+    OPCODES["JGT"]: 0b010,
+    OPCODES["JLT"]: 0b100,
+    OPCODES["JGE"]: 0b011,
+    OPCODES["JLE"]: 0b101,
+}
+DIVISIONS = {OPCODES["DIV"], OPCODES["MOD"]}
+SHIFTS = {OPCODES["SHL"], OPCODES["SHR"]}
+
+
+class Lockstep:
+    """
+    count copies of a CPU's state (see from_cpu()) that run together.
+    Set the starting values through the arrays before run(), e.g. engine.reg[:, 0] = inputs.
+
+    ram: count x 256, reg: count x 8, PC, FL and cycles: one per machine
+    reasons: why each machine stopped (None while it runs), output: what each one printed (lists of strings)
+
+    Interrupts aren't emulated, a machine that runs INT or IRET stops with a reason that says so.
+    """
+
+    def __init__(self, count):
+        if np is None:
+            raise ImportError("the lockstep engine needs numpy (pip install numpy)")
+
+        self.count = count
+        self.ram = np.zeros((count, 256), dtype=np.uint8)
+        self.reg = np.zeros((count, 8), dtype=np.uint8)
+        self.reg[:, SP] = 0xF4
+        self.PC = np.zeros(count, dtype=np.int64)
+        self.FL = np.zeros(count, dtype=np.uint8)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.active = np.ones(count, dtype=bool)
+        self.reasons = [None] * count
+        self.output = [[] for _ in range(count)]
+
+    @classmethod
+    def from_cpu(cls, cpu, count):
+        """count machines that all start where cpu is (a program loaded into it, usually)"""
+
+        engine = cls(count)
+        engine.ram[:] = np.frombuffer(bytes(cpu.ram), dtype=np.uint8)
+        engine.reg[:] = np.frombuffer(bytes(cpu.reg), dtype=np.uint8)
+        engine.PC[:] = cpu.PC
+        engine.FL[:] = cpu.FL
+        engine.cycles[:] = cpu.cycles
+        return engine
+
+    def stop(self, machines, reason):
+        self.active[machines] = False
+        for machine in machines:
+            self.reasons[machine] = reason
+
+    def run(self, max_cycles=None):
+        """Runs until every machine has stopped or run max_cycles more instructions, returns their RunResults"""
+
+        limit = None if max_cycles is None else self.cycles + max_cycles
+        rows = np.arange(self.count)
+
+        while True:
+            if limit is not None:
+                out = self.active & (self.cycles >= limit)
+                if out.any():
+                    self.stop(rows[out], "max cycles")
+
+            machines = rows[self.active]
+            if len(machines) == 0:
+                break
+
+            PC = self.PC[machines]
+            off = PC > 0xFF
+            if off.any():
+                for machine in machines[off]:
+                    self.stop([machine], f"PC out of RAM [{self.PC[machine]:02X}]")
+                machines, PC = machines[~off], PC[~off]
+                if len(machines) == 0:
+                    continue
+
+            # machines at the same address running the same bytes go together
+            ram = self.ram[machines]
+            IR = ram[np.arange(len(machines)), PC].astype(np.int64)
+            a = ram[np.arange(len(machines)), (PC + 1) & 0xFF].astype(np.int64)
+            b = ram[np.arange(len(machines)), (PC + 2) & 0xFF].astype(np.int64)
+            keys = PC << 24 | IR << 16 | a << 8 | b
+
+            if (keys == keys[0]).all():
+                self.step(machines, int(IR[0]), int(a[0]), int(b[0]))
+            else:
+                unique, groups = np.unique(keys, return_inverse=True)
+                for group, key in enumerate(unique.tolist()):
+                    self.step(machines[groups == group], (key >> 16) & 0xFF, (key >> 8) & 0xFF, key & 0xFF)
+
+        return self.results()
+
+    def step(self, m, IR, a, b):
+        """Runs the instruction IR a b on the machines m, they're all at the same PC"""
+
+        if IR not in NAMES:
+            self.stop(m, f"invalid instruction [{IR:08b}]")
+            return
+
+        error = invalid_register(IR, a, b)
+        if error is not None:
+            self.stop(m, error)
+            return
+
+        reg = self.reg
+        ram = self.ram
+        size = (IR >> 6) + 1
+        self.cycles[m] += 1
+        PC = self.PC[m] + size
+        name = NAMES[IR]
+
+        if ALU[IR] is not None:
+            x = reg[m, a].astype(np.int64)
+            # NOT, INC and DEC only have registerA
+            y = reg[m, b].astype(np.int64) if size == 3 else x
+
+            if IR in DIVISIONS:
+                zero = y == 0
+                if zero.any():
+                    # the same as CPU.alu(), they stop and the PC still moves past the instruction
+                    self.PC[m[zero]] = PC[zero]
+                    self.stop(m[zero], "division by zero")
+                    m, x, y, PC = m[~zero], x[~zero], y[~zero], PC[~zero]
+            elif IR in SHIFTS:
+                # anything past 63 gives 0 like it would in Python, numpy doesn't guarantee that
+                y = np.minimum(y, 63)
+
+            reg[m, a] = ALU[IR](x, y) & 0xFF
+
+        elif name == "LDI":
+            reg[m, a] = b
+        elif name == "CMP":
+            x, y = reg[m, a], reg[m, b]
+            self.FL[m] = (x < y).astype(np.uint8) << 2 | (x > y).astype(np.uint8) << 1 | (x == y)
+        elif name == "LD":
+            reg[m, a] = ram[m, reg[m, b]]
+        elif name == "ST":
+            ram[m, reg[m, a]] = reg[m, b]
+        elif name == "PUSH":
+            reg[m, SP] -= 1
+            ram[m, reg[m, SP]] = reg[m, a]
+        elif name == "POP":
+            reg[m, a] = ram[m, reg[m, SP]]
+            reg[m, SP] += 1
+        elif name == "CALL":
+            reg[m, SP] -= 1
+            ram[m, reg[m, SP]] = PC & 0xFF
+            PC = reg[m, a].astype(np.int64)
+        elif name == "RET":
+            PC = ram[m, reg[m, SP]].astype(np.int64)
+            reg[m, SP] += 1
+        elif name == "JMP":
+            PC = reg[m, a].astype(np.int64)
+        elif name == "JNE":
+            PC = np.where(self.FL[m] & 1, PC, reg[m, a])
+        elif IR in CONDITIONS:
+            PC = np.where(self.FL[m] & CONDITIONS[IR], reg[m, a], PC)
+        elif name in ("PRN", "PRA"):
+            table = DECIMAL if name == "PRN" else CHARACTERS
+            for machine, value in zip(m.tolist(), reg[m, a].tolist()):
+                self.output[machine].append(table[value])
+        elif name == "HLT":
+            self.stop(m, HALTED)
+        elif name in ("INT", "IRET"):
+            self.PC[m] = PC
+            self.stop(m, f"{name} isn't supported in lockstep")
+            return
+
+        self.PC[m] = PC
+
+    def results(self):
+        """A RunResult for every machine, like CPU.run() returns"""
+
+        return [RunResult(self.reasons[machine], int(self.cycles[machine]), self.reg[machine].tobytes(),
+                          int(self.PC[machine]), int(self.FL[machine]), "".join(self.output[machine]))
+                for machine in range(self.count)]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run one LS-8 program over many inputs at once with NumPy.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("inputs", help="file with one set of comma separated register values per line (see batch.py)")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop each machine after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    from batch import read_inputs
+
+    inputs = read_inputs(args.inputs)
+    cpu = CPU()
+    cpu.load_file(args.program)
+
+    try:
+        engine = Lockstep.from_cpu(cpu, len(inputs))
+    except ImportError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    for machine, values in enumerate(inputs):
+        for register, value in enumerate(values):
+            engine.reg[machine, register] = value & 0xFF
+
+    failed = 0
+    for values, result in zip(inputs, engine.run(args.max_cycles)):
+        failed += result.status
+        print(f"== {','.join(str(value) for value in values)}: {result.reason}, {result.cycles} cycles")
+        print(result.output, end="")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -3,9 +3,26 @@
 """Main."""
 
 from cpu import *
+from devices import Timer, Keyboard
+from output import OutputBuffer
 import sys
 
-cpu = CPU()
+cpu = CPU(output=OutputBuffer(sys.stdout))
 
 cpu.load()
-cpu.run()
+
+timer = Timer(cpu).start()
+keyboard = Keyboard(cpu).start()
+
+try:
+    result = cpu.run()
+finally:
+    # whatever the program printed goes out before anything else, even if run() raised
+    cpu.flush()
+    timer.stop()
+    keyboard.stop()
+
+if result.reason != HALTED:
+    print(result.reason, file=sys.stderr)
+
+sys.exit(result.status)
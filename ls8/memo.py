@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+"""
+Subroutine memoization. Calls are recorded while they run, and the ones that turn out to be pure (they only use
+registers, FL and their own stack frame) are cached by the values of the registers they read. When the same
+subroutine is called again with those values the whole call, everything it calls included, is skipped:
+its registers, flags, stack bytes and cycle count are put in place straight from the cache.
+"""
+
+import sys
+import argparse
+from operator import itemgetter
+from collections import namedtuple, OrderedDict
+
+from cpu import CPU, ALU, NAMES, INTERRUPT_REGISTERS
+
+OPCODES = {name: opcode for opcode, name in NAMES.items()}
+CALL = OPCODES["CALL"]
+RET = OPCODES["RET"]
+PUSH = OPCODES["PUSH"]
+POP = OPCODES["POP"]
+ST = OPCODES["ST"]
+LDI = OPCODES["LDI"]
+
+SP = 7
+FLAGS = 8       # FL's bit in the register masks, R0-R6 are bits 0-6
+
+# while no call is being recorded only these have to be looked at: CALLs, and the writes that can overwrite cached code
+IDLE = {CALL, PUSH, ST}
+# a call site that misses this many times in a row isn't looked up or recorded any more
+MISSES = 32
+
+"""
+What each instruction a pure subroutine can run reads and writes:
+(reads register a, reads register b, reads FL, writes register a, writes FL), a and b are its operands.
+Anything that isn't here (PRN, PRA, LD, ST, INT, IRET, HLT) makes the calls running it impure.
+"""
+EFFECTS = {opcode: (True, True, False, True, False) for opcode in range(256) if ALU[opcode] is not None}
+for name in ("INC", "DEC", "NOT"):
+    EFFECTS[OPCODES[name]] = (True, False, False, True, False)
+for name in ("JEQ", "JNE", "JGT", "JLT", "JGE", "JLE"):
+    EFFECTS[OPCODES[name]] = (True, False, True, False, False)
+EFFECTS.update({
+    OPCODES["CMP"]: (True, True, False, False, True),
+    LDI: (False, False, False, True, False),
+    PUSH: (True, False, False, False, False),
+    POP: (False, False, False, True, False),
+    CALL: (True, False, False, False, False),
+    OPCODES["JMP"]: (True, False, False, False, False),
+    RET: (False, False, False, False, False),
+    OPCODES["NOP"]: (False, False, False, False, False),
+})
+
+"""
+A cached call.
+reads, writes: masks of the registers (and FLAGS) it read before writing them and the ones it wrote
+registers: ((register, value), ...) it leaves behind, FL: what it leaves in FL, None if it doesn't touch it
+cycles: instructions from the CALL to the RET, ram: ((offset from SP, value), ...) of the stack bytes it wrote
+"""
+Entry = namedtuple("Entry", ["reads", "writes", "registers", "FL", "cycles", "ram"])
+
+
+class Stats(namedtuple("Stats", ["hits", "misses", "entries", "evictions", "skipped", "impure", "invalidations",
+                                 "cold"])):
+    """
+    hits, misses: CALLs found in the cache or not (calls to subroutines that were never pure aren't looked up)
+    entries: calls in the cache, evictions: the ones dropped to make room for newer ones
+    skipped: cycles the hits didn't have to run, impure: subroutines that aren't recorded any more
+    invalidations: times the cache was thrown away because code it ran was overwritten
+    cold: call sites that missed MISSES times in a row, they just run like without the memo
+    """
+
+    __slots__ = ()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class Frame:
+    """A call being recorded"""
+
+    __slots__ = ("target", "SP", "ret", "cycles", "state", "mark", "reads", "writes")
+
+    def __init__(self, target, SP, ret, cycles, state, mark):
+        self.target = target
+        self.SP = SP            # SP before the CALL
+        self.ret = ret          # where its RET has to go back to
+        self.cycles = cycles    # cycle count before the CALL
+        self.state = state      # R0-R7 and FL when it was called
+        self.mark = mark        # position in Memo.log where its RAM writes start
+        self.reads = 0
+        self.writes = 0
+
+
+def bits(mask):
+    return tuple(bit for bit in range(FLAGS + 1) if mask >> bit & 1)
+
+
+class Memo:
+    """
+    Memoizes pure calls, run a CPU with CPU.run(engine=memo) or memo.run(cpu).
+    The same Memo can be used for many runs of a program, what it learned in one run hits in the next.
+
+    size is the most calls kept, the least recently used one goes first.
+    A subroutine that does anything impure once is never recorded again, calls to it that were cached before
+    still hit. Interrupts only happen between instructions that really run, never inside a call that's skipped.
+    Recording costs more than running, so a call site that keeps missing is left alone (see MISSES), and while
+    nothing is being recorded only the instructions in IDLE are looked at.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.cache = OrderedDict()      # (target, inputs, their values) -> Entry
+        self.inputs = {}                # target -> {inputs: getter for their values}, inputs are register numbers
+        self.impure = set()             # targets that did something impure
+        self.code = bytearray(256)      # 1 for every byte a cached call ran as code
+        self.frames = []                # the calls being recorded, innermost last
+        self.log = []                   # addresses written while recording
+        self.last = {}                  # address -> position in log of its last write
+        self.left = None                # the CPU state when the loop last returned, see resume()
+        self.streaks = {}               # address of a CALL -> misses there since its last hit
+        self.cold = set()               # addresses of the CALLs that missed MISSES times in a row
+        self.watch = set(IDLE)          # opcodes the loop's hooks see, every one while calls are being recorded
+        self.hits = self.misses = self.evictions = self.skipped = self.invalidations = 0
+
+    def run(self, cpu, max_cycles=None, deadline=None):
+        """Same as CPU.run() but skipping the calls that are cached"""
+
+        return cpu.execute(lambda limit: self.loop(cpu, limit), max_cycles, deadline)
+
+    def loop(self, cpu, limit):
+        """CPU.hooked_loop() with hooks that look up every CALL and record the calls that aren't cached"""
+
+        ram = cpu.ram
+        reg = cpu.reg
+        inputs = self.inputs
+        impure = self.impure
+        frames = self.frames
+        streaks = self.streaks
+        cold = self.cold
+        watch = self.watch
+        target = state = address = finish = None
+        self.resume(cpu)
+        self.watching()
+
+        def before(PC):
+            nonlocal target, state, address, finish
+            IR = ram[PC]
+            target = None
+
+            # fetch() has checked the operands are registers
+            if IR == CALL and PC not in cold:
+                target = reg[ram[(PC + 1) & 0xFF]]
+                if target in inputs and self.lookup(cpu, target, limit):
+                    streaks[PC] = 0
+                    return True
+
+                streaks[PC] = streaks.get(PC, 0) + 1
+                if streaks[PC] >= MISSES:
+                    cold.add(PC)
+                elif target not in impure:
+                    self.misses += 1
+                    state = bytes(reg) + bytes((cpu.FL,))
+
+            address = None
+            if IR == ST:
+                address = reg[ram[(PC + 1) & 0xFF]]
+            elif IR == PUSH or IR == CALL:
+                address = (reg[SP] - 1) & 0xFF
+
+            finish = self.check(cpu, PC, IR, (IR >> 6) + 1) if frames else False
+
+        def after(PC):
+            if address is not None:
+                self.wrote(address)
+            if target is not None and target not in impure:
+                frames.append(Frame(target, (reg[SP] + 1) & 0xFF, (PC + 2) & 0xFF, cpu.cycles - 1, state,
+                                    len(self.log)))
+            if finish:
+                self.finish(cpu)
+            if bool(frames) != (len(watch) > len(IDLE)):
+                self.watching()
+
+        cpu.hooked_loop(limit, before, after, watch)
+        self.left = (cpu.PC, cpu.FL, bytes(reg), bytes(ram))
+
+    def watching(self):
+        """Sets the opcodes the hooks see, all of them while calls are being recorded"""
+
+        self.watch.clear()
+        self.watch.update(range(256) if self.frames else IDLE)
+
+    def resume(self, cpu):
+        """
+        When the loop starts again after something outside it changed the CPU (an interrupt, a device,
+        another program) the calls being recorded are dropped, and the cache too if its code was overwritten.
+        """
+
+        ram = cpu.ram
+        if self.left == (cpu.PC, cpu.FL, bytes(cpu.reg), bytes(ram)):
+            return
+
+        self.drop()
+        old = self.left[3] if self.left is not None else bytes(256)
+        if any(self.code[address] and ram[address] != old[address] for address in range(256)):
+            self.clear()
+
+    def lookup(self, cpu, target, limit):
+        """Skips the CALL at the PC if it's cached, returns True if it did"""
+
+        reg = cpu.reg
+        state = bytes(reg) + bytes((cpu.FL,))
+
+        for inputs, getter in self.inputs[target].items():
+            key = (target, inputs, getter(state))
+            entry = self.cache.get(key)
+            if entry is not None:
+                break
+        else:
+            return False
+
+        if cpu.cycles + entry.cycles > limit:
+            # it has to stop in the middle of the call
+            return False
+
+        SP = reg[7]
+        addresses = [(SP + offset) & 0xFF for offset, _ in entry.ram]
+        addresses.append((SP - 1) & 0xFF)
+        if any(self.code[address] for address in addresses):
+            # the stack is down in the code here, it doesn't do the same as when it was recorded
+            return False
+
+        if self.frames:
+            # the CALL itself is part of the calls being recorded
+            self.check(cpu, cpu.PC, CALL, 2)
+
+        self.cache.move_to_end(key)
+        self.hits += 1
+        self.skipped += entry.cycles
+
+        ret = (cpu.PC + 2) & 0xFF
+        cpu.ram_write((SP - 1) & 0xFF, ret)
+        for address, (_, value) in zip(addresses, entry.ram):
+            cpu.ram_write(address, value)
+        for register, value in entry.registers:
+            reg[register] = value
+        if entry.FL is not None:
+            cpu.FL = entry.FL
+        cpu.cycles += entry.cycles
+        cpu.PC = ret
+
+        if any(register in INTERRUPT_REGISTERS for register, _ in entry.registers):
+            # like CPU.mask_changed(), the run loop stops so the interrupts are checked
+            cpu.running = False
+
+        if self.frames:
+            self.read(entry.reads)
+            self.frames[-1].writes |= entry.writes
+            for address in addresses:
+                self.wrote(address)
+
+        return True
+
+    def check(self, cpu, PC, IR, size):
+        """
+        Goes over the instruction at PC before it runs, for the calls being recorded: drops the ones it makes
+        impure and keeps track of what they read and write. Returns True if it's the RET of the innermost one.
+        """
+
+        ram = cpu.ram
+        frames = self.frames
+
+        for offset in range(size):
+            self.code[(PC + offset) & 0xFF] = 1
+
+        effect = EFFECTS.get(IR)
+        a = ram[(PC + 1) & 0xFF]
+        b = ram[(PC + 2) & 0xFF]
+        # using SP as a value gives something different at every stack depth
+        if effect is None or (size > 1 and a == SP) or (size > 2 and IR != LDI and b == SP):
+            self.abort(0)
+            return False
+
+        read_a, read_b, read_FL, write_a, write_FL = effect
+        if IR == POP or IR == RET:
+            address = cpu.reg[SP]
+            if IR == RET and address == (frames[-1].SP - 1) & 0xFF:
+                return True
+
+            # the byte has to be one the call pushed itself, the calls that started after it was written are impure
+            written = self.last.get(address, -1)
+            depth = len(frames)
+            while depth and frames[depth - 1].mark > written:
+                depth -= 1
+            if depth < len(frames):
+                self.abort(depth)
+                if not frames:
+                    return False
+
+        self.read(read_a << a | read_b << b | read_FL << FLAGS)
+        frames[-1].writes |= write_a << a | write_FL << FLAGS
+        return False
+
+    def read(self, mask):
+        """Registers read, they're inputs of every call that didn't write them first"""
+
+        for frame in reversed(self.frames):
+            mask &= ~frame.writes
+            if not mask:
+                break
+            frame.reads |= mask
+
+    def wrote(self, address):
+        """A byte of RAM was written by an instruction in the loop"""
+
+        if self.code[address]:
+            self.clear()
+        if self.frames:
+            self.last[address] = len(self.log)
+            self.log.append(address)
+
+    def finish(self, cpu):
+        """The innermost call being recorded returned, it goes in the cache"""
+
+        frame = self.frames.pop()
+        if self.frames:
+            self.frames[-1].writes |= frame.writes
+
+        if cpu.PC != frame.ret:
+            # it changed its return address
+            self.impure.add(frame.target)
+        else:
+            self.store(cpu, frame)
+
+        if not self.frames:
+            self.log.clear()
+            self.last.clear()
+
+    def store(self, cpu, frame):
+        inputs = bits(frame.reads)
+        getters = self.inputs.setdefault(frame.target, {})
+        if inputs not in getters:
+            getters[inputs] = itemgetter(*inputs) if inputs else lambda state: ()
+
+        ret = (frame.SP - 1) & 0xFF
+        written = sorted(set(self.log[frame.mark:]) - {ret})
+        entry = Entry(frame.reads, frame.writes,
+                      tuple((register, cpu.reg[register]) for register in bits(frame.writes) if register < FLAGS),
+                      cpu.FL if frame.writes >> FLAGS & 1 else None,
+                      cpu.cycles - frame.cycles,
+                      tuple(((address - frame.SP) & 0xFF, cpu.ram[address]) for address in written))
+
+        self.cache[(frame.target, inputs, getters[inputs](frame.state))] = entry
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def abort(self, depth):
+        """The calls being recorded from depth on did something impure"""
+
+        aborted = self.frames[depth:]
+        del self.frames[depth:]
+
+        for frame in aborted:
+            self.impure.add(frame.target)
+            if self.frames:
+                self.frames[-1].writes |= frame.writes
+
+        if not self.frames:
+            self.log.clear()
+            self.last.clear()
+
+    def drop(self):
+        """Stops recording without blaming the calls"""
+
+        self.frames.clear()
+        self.log.clear()
+        self.last.clear()
+
+    def clear(self):
+        """Throws the cache away, code it ran was overwritten"""
+
+        self.cache.clear()
+        self.inputs.clear()
+        self.streaks.clear()
+        self.cold.clear()
+        self.code[:] = bytes(256)
+        self.drop()
+        self.invalidations += 1
+
+    def stats(self):
+        return Stats(self.hits, self.misses, len(self.cache), self.evictions, self.skipped, len(self.impure),
+                     self.invalidations, len(self.cold))
+
+    def report(self, file=sys.stdout):
+        stats = self.stats()
+        print(f"{stats.hits} hits, {stats.misses} misses ({100 * stats.hit_rate:.1f}% hit rate), "
+              f"{stats.skipped} cycles skipped", file=file)
+        print(f"{stats.entries} calls cached, {stats.evictions} evicted, {stats.impure} impure subroutines, "
+              f"{stats.invalidations} invalidations, {stats.cold} call sites given up on", file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run an LS-8 program skipping the calls it has already made.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("-n", "--size", type=int, default=4096, help="most calls to keep in the cache")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU(output=sys.stdout)
+    cpu.load_file(args.program)
+
+    memo = Memo(args.size)
+    result = cpu.run(args.max_cycles, engine=memo)
+
+    if result.reason != "HLT":
+        print(result.reason, file=sys.stderr)
+    memo.report(file=sys.stderr)
+
+    return result.status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
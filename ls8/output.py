@@ -0,0 +1,48 @@
+"""Buffered output channel for PRN/PRA."""
+
+import io
+
+
+class OutputBuffer:
+    """
+    Collects what PRN and PRA print in memory and writes it out in one go on flush(), when the buffer is full
+    or when the CPU stops (CPU.execute() calls flush()).
+
+    target can be a text file (sys.stdout, open(..., "w")), a binary file (io.BytesIO, open(..., "wb"),
+    sys.stdout.buffer, every character becomes one byte) or a function that gets called with the text.
+    """
+
+    def __init__(self, target, size=8192):
+        self.parts = []
+        self.length = 0         # characters waiting in parts
+        self.size = size        # flush when this many characters are waiting
+
+        if isinstance(target, io.TextIOBase):
+            write = target.write
+        elif hasattr(target, "write"):
+            # PRA prints characters 0-255, latin-1 turns each one into the same byte
+            write = lambda text: target.write(text.encode("latin-1"))
+        elif callable(target):
+            write = target
+        else:
+            raise TypeError("output target has to be a file or a function")
+
+        self.target = target
+        self.send = write
+
+    def write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            text = "".join(self.parts)
+            self.parts.clear()
+            self.length = 0
+            self.send(text)
+
+        if hasattr(self.target, "flush"):
+            self.target.flush()
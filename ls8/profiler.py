@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""Instruction level profiler, finds where the cycles of an LS-8 program go."""
+
+import sys
+import re
+import argparse
+
+from cpu import CPU, NAMES, CONDITIONS
+from image import MAGIC as IMAGE_MAGIC
+
+CALL = 0b01010000
+RET = 0b00010001
+
+# the assembler writes its labels into the .ls8 files as "# LABEL (address 24):"
+LABEL_REGEX = re.compile(r"#\s*(\w+)\s*\(address (\d+)\):")
+
+
+def read_labels(lines):
+    """Reads the label comments the assembler (asm/asm.py) leaves in a .ls8 file, returns {address: label}"""
+
+    labels = {}
+
+    for line in lines:
+        m = LABEL_REGEX.search(line)
+        if m is not None:
+            labels.setdefault(int(m.group(2)), m.group(1))
+
+    return labels
+
+
+class Profile:
+    """
+    Counts collected while a CPU runs with CPU.run(profile=...).
+    The counting happens in hooks on CPU.hooked_loop(), a CPU that isn't being profiled runs CPU.loop() and doesn't
+    pay for it.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}      # address -> label name, see read_labels()
+        self.addresses = [0] * 256      # times the instruction at each address ran
+        self.opcodes = [0] * 256        # times each opcode ran
+        self.calls = {}                 # CALL target address -> [number of calls, cycles spent until its RET]
+        self.branches = {}              # address of a conditional jump -> [taken, not taken]
+        self.stack = []                 # (target, cycles when called) of the calls that didn't RET yet
+
+    def run(self, cpu, max_cycles=None, deadline=None):
+        """Same as CPU.run() but counting every instruction"""
+
+        return cpu.execute(lambda limit: self.loop(cpu, limit), max_cycles, deadline)
+
+    def loop(self, cpu, limit):
+        """CPU.hooked_loop() with hooks that count every instruction"""
+
+        ram = cpu.ram
+        addresses = self.addresses
+        opcodes = self.opcodes
+        IR = None
+
+        def before(PC):
+            nonlocal IR
+            IR = ram[PC]
+            addresses[PC] += 1
+            opcodes[IR] += 1
+
+            if IR in CONDITIONS:
+                # the jump's own condition says if it's taken, the PC can't (a taken jump can land right after it)
+                bits, when_clear = CONDITIONS[IR]
+                taken = bool(cpu.FL & bits) != when_clear
+                self.branches.setdefault(PC, [0, 0])[0 if taken else 1] += 1
+
+        def after(PC):
+            if IR == CALL:
+                # the PC is at the target now
+                self.calls.setdefault(cpu.PC, [0, 0])[0] += 1
+                self.stack.append((cpu.PC, cpu.cycles))
+            elif IR == RET and self.stack:
+                target, start = self.stack.pop()
+                self.calls[target][1] += cpu.cycles - start
+
+        cpu.hooked_loop(limit, before, after)
+
+    def label(self, address):
+        """Name of an address from the nearest label before it, e.g. "PRINTSTRLOOP+3" """
+
+        before = [a for a in self.labels if a <= address]
+        if not before:
+            return ""
+
+        start = max(before)
+        offset = address - start
+        return self.labels[start] + (f"+{offset}" if offset else "")
+
+    def report(self, ram, top=20, file=sys.stdout):
+        """Prints the hot spots sorted by how often they ran"""
+
+        total = sum(self.addresses) or 1
+
+        print(f"{total} cycles", file=file)
+
+        print("\nhot spots:", file=file)
+        print("  addr  count      %  instruction  label", file=file)
+        hot = sorted((a for a in range(256) if self.addresses[a]), key=lambda a: -self.addresses[a])
+        for address in hot[:top]:
+            count = self.addresses[address]
+            name = NAMES.get(ram[address], f"{ram[address]:08b}")
+            line = f"    {address:02X} {count:6} {100 * count / total:5.1f}%  {name:11}  {self.label(address)}"
+            print(line.rstrip(), file=file)
+
+        print("\nopcodes:", file=file)
+        hot = sorted((o for o in range(256) if self.opcodes[o]), key=lambda o: -self.opcodes[o])
+        for opcode in hot:
+            count = self.opcodes[opcode]
+            print(f"  {NAMES.get(opcode, f'{opcode:08b}'):5} {count:6} {100 * count / total:5.1f}%", file=file)
+
+        if self.calls:
+            print("\ncalls (cycles include everything called from there):", file=file)
+            for target, (calls, cycles) in sorted(self.calls.items(), key=lambda item: -item[1][1]):
+                print(f"    {target:02X} {self.label(target):16} {calls:6} calls {cycles:8} cycles", file=file)
+
+        if self.branches:
+            print("\nbranches:", file=file)
+            for address, (taken, not_taken) in sorted(self.branches.items()):
+                name = NAMES.get(ram[address], "")
+                print(f"    {address:02X} {name:4} {self.label(address):16} taken {taken:6}  not taken {not_taken:6}",
+                      file=file)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run an LS-8 program and report where the cycles go.")
+    parser.add_argument("program", help=".ls8 file to run")
+    parser.add_argument("-n", "--top", type=int, default=20, help="number of hot spots to show")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.program, "rb") as file:
+        data = file.read()
+
+    cpu = CPU(output=sys.stdout)
+
+    if args.program.endswith(".ls8b") or data.startswith(IMAGE_MAGIC):
+        # binary images carry the symbol table themselves
+        image = cpu.load_image(data)
+        labels = {address: label for label, address in image.symbols.items()}
+    else:
+        lines = data.decode().splitlines()
+        cpu.load_program(lines)
+        labels = read_labels(lines)
+
+    profile = Profile(labels)
+    result = cpu.run(args.max_cycles, profile=profile)
+
+    print(f"\n{result.reason}", file=sys.stderr)
+    profile.report(cpu.ram, args.top, file=sys.stderr)
+
+    return result.status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Runs many CPUs in one thread, round robin in fixed time slices, so a program that never stops can't hold up the rest."""
+
+import sys
+import time
+import argparse
+from collections import deque
+
+from cpu import CPU
+
+# reasons run() stops with when the program isn't finished and can go on
+PREEMPTED = ("max cycles", "deadline")
+
+
+class Task:
+    """
+    A CPU the Scheduler runs.
+    max_cycles and timeout (seconds of its own running time) are its budget, when it uses it up it's stopped
+    with "max cycles" or "timeout" as the reason. result is the RunResult once it's done.
+    """
+
+    def __init__(self, name, cpu, max_cycles=None, timeout=None, blocks=False):
+        self.name = name
+        self.cpu = cpu
+        self.max_cycles = max_cycles
+        self.timeout = timeout
+        self.run = cpu.run_blocks if blocks else cpu.run
+        self.cycles = 0         # cycles it ran under the scheduler
+        self.time = 0.0         # seconds it ran under the scheduler
+        self.result = None
+
+
+class Scheduler:
+    """
+    Round robin over its tasks, each one runs for slice_time seconds (and at most slice_cycles instructions)
+    and goes to the back of the queue, until it halts, fails or runs out of budget.
+    Between slices a CPU's state stays where run() left it, so nothing is lost by being preempted.
+    """
+
+    def __init__(self, slice_time=0.01, slice_cycles=None):
+        self.slice_time = slice_time
+        self.slice_cycles = slice_cycles
+        self.ready = deque()
+        self.done = []
+
+    def add(self, cpu, name=None, max_cycles=None, timeout=None, blocks=False):
+        """Adds a loaded CPU, returns its Task"""
+
+        task = Task(len(self.ready) + len(self.done) if name is None else name, cpu, max_cycles, timeout, blocks)
+        self.ready.append(task)
+        return task
+
+    def step(self):
+        """Runs the next task for one slice, returns it. It's finished if its result is set."""
+
+        task = self.ready.popleft()
+
+        cycles = self.slice_cycles
+        if task.max_cycles is not None:
+            left = task.max_cycles - task.cycles
+            cycles = left if cycles is None else min(cycles, left)
+
+        seconds = self.slice_time
+        if task.timeout is not None:
+            seconds = min(seconds, task.timeout - task.time)
+
+        start = time.monotonic()
+        before = task.cpu.cycles
+        try:
+            result = task.run(cycles, deadline=start + seconds)
+        except Exception as e:
+            # a bug in the emulator shouldn't take the other tasks down, only this one stops
+            task.cpu.flush()
+            result = task.cpu.result()._replace(reason=f"crashed: {type(e).__name__}: {e}")
+        task.time += time.monotonic() - start
+        task.cycles += task.cpu.cycles - before
+
+        if result.reason not in PREEMPTED:
+            task.result = result
+        elif task.max_cycles is not None and task.cycles >= task.max_cycles:
+            task.result = result._replace(reason="max cycles")
+        elif task.timeout is not None and task.time >= task.timeout:
+            task.result = result._replace(reason="timeout")
+
+        if task.result is None:
+            self.ready.append(task)
+        else:
+            self.done.append(task)
+
+        return task
+
+    def run(self):
+        """Runs until every task is finished, returns them in the order they finished"""
+
+        while self.ready:
+            self.step()
+
+        return self.done
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run many LS-8 programs at once, sharing one CPU in time slices.")
+    parser.add_argument("programs", nargs="+", help=".ls8 or .ls8b files")
+    parser.add_argument("--slice", type=float, default=0.01, help="seconds each program runs before the next one")
+    parser.add_argument("--max-cycles", type=int, default=None, help="stop each program after this many instructions")
+    parser.add_argument("--timeout", type=float, default=None, help="stop each program after this many seconds of running")
+    parser.add_argument("--blocks", action="store_true", help="run with the block compiler")
+    args = parser.parse_args(argv[1:])
+
+    scheduler = Scheduler(args.slice)
+
+    for path in args.programs:
+        cpu = CPU()
+        try:
+            cpu.load_file(path)
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            return 2
+        scheduler.add(cpu, path, args.max_cycles, args.timeout, args.blocks)
+
+    status = 0
+    for task in scheduler.run():
+        print(f"== {task.name}: {task.result.reason}, {task.result.cycles} cycles, {task.time:.3f}s")
+        print(task.result.output, end="")
+        status = max(status, task.result.status)
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
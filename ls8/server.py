@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Emulator server, keeps worker processes with a CPU already made and runs programs for client.py over a Unix socket,
+so running a program costs one round trip instead of starting Python.
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import argparse
+import threading
+import socketserver
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import ipc
+from cpu import CPU
+from devices import TIMER_INTERRUPT, KEYBOARD_INTERRUPT, KEY_ADDRESS
+
+# each worker process's CPU, made once by warm() and reset for every program
+cpu = None
+
+
+def warm():
+    """Worker initializer, makes the CPU so requests don't pay for it"""
+
+    global cpu
+    cpu = CPU()
+
+
+def listening(path):
+    """True if a server is accepting connections on the Unix socket at path"""
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+    return True
+
+
+def ping(_):
+    # keeps a worker busy for a moment, so the pool starts all of them instead of reusing the first one
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def run_request(request):
+    """
+    Runs one program in this worker, request is what client.py sends:
+    program (base64), binary (it's a .ls8b image), input (base64, the keys the program gets),
+    max_cycles, timeout (seconds), timer (seconds between timer interrupts), blocks (use the block compiler).
+    Returns the reply: output, status, reason, cycles.
+    """
+
+    cpu.reset()
+
+    try:
+        cpu.load_data(ipc.decode(request["program"]), request.get("binary", False))
+    except Exception as e:
+        return {"output": "", "status": 2, "reason": f"can't load the program: {e}", "cycles": 0}
+
+    # every key waits its turn in the interrupt queue, see CPU.service_interrupts()
+    for key in ipc.decode(request.get("input", "")):
+        cpu.raise_interrupt(KEYBOARD_INTERRUPT, KEY_ADDRESS, key)
+
+    run = cpu.run_blocks if request.get("blocks") else cpu.run
+    cycles = request.get("max_cycles")
+    timeout = request.get("timeout")
+    interval = request.get("timer", 1.0)
+
+    start = time.monotonic()
+    end = float("inf") if timeout is None else start + timeout
+    tick = start + interval
+
+    try:
+        while True:
+            before = cpu.cycles
+            result = run(cycles, deadline=min(tick, end))
+            if cycles is not None:
+                cycles -= cpu.cycles - before
+
+            if result.reason != "deadline":
+                break
+            if time.monotonic() >= end:
+                result = result._replace(reason="timeout")
+                break
+
+            # the timer goes off at the deadline, without a thread in the worker
+            cpu.raise_interrupt(TIMER_INTERRUPT)
+            tick += interval
+    except Exception as e:
+        result = cpu.result()._replace(reason=f"crashed: {type(e).__name__}: {e}")
+
+    return {"output": result.output, "status": result.status, "reason": result.reason, "cycles": result.cycles}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """One client connection, it can send any number of requests one after the other"""
+
+    def handle(self):
+        while True:
+            request = ipc.receive(self.request)
+            if request is None:
+                break
+
+            if self.server.timeout_default is not None:
+                request.setdefault("timeout", self.server.timeout_default)
+
+            ipc.send(self.request, self.server.run(request))
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers=None, timeout=None):
+        if os.path.exists(path):
+            if listening(path):
+                raise OSError(errno.EADDRINUSE, f"a server is already listening on {path}")
+            # left behind by a server that didn't get to clean up
+            os.unlink(path)
+
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout_default = timeout
+        self.lock = threading.Lock()
+        self.pool = self.start_pool()
+
+        super().__init__(path, Handler)
+
+    def start_pool(self):
+        pool = ProcessPoolExecutor(self.workers, initializer=warm)
+        # start every worker now, not on the first requests
+        list(pool.map(ping, range(self.workers)))
+        return pool
+
+    def run(self, request):
+        """
+        Runs a request in a worker and returns the reply. If a worker died the pool is broken for every request,
+        so it's replaced with a new one and the request gets one more try.
+        """
+
+        for attempt in range(2):
+            pool = self.pool
+            try:
+                return pool.submit(run_request, request).result()
+            except BrokenProcessPool:
+                with self.lock:
+                    # another connection may have replaced it already
+                    if self.pool is pool:
+                        pool.shutdown(wait=False)
+                        self.pool = self.start_pool()
+
+        return {"output": "", "status": 1, "reason": "crashed: the worker running it died", "cycles": 0}
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve LS-8 runs to client.py over a Unix socket.")
+    parser.add_argument("--socket", default=ipc.SOCKET, help=f"socket path (default: {ipc.SOCKET}, or $LS8_SOCKET)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds a program may run when the client doesn't say (default: 10)")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        server = Server(args.socket, args.workers, args.timeout)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f"listening on {args.socket}", file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,72 @@
+"""analyze.py on the example programs and a few small ones made for it."""
+
+import os
+import io
+import unittest
+
+from cpu import parse_program
+from analyze import analyze, report
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# LDI R1,8  CALL R1  HLT  6: 2 bytes of data  8: PUSH R0  PUSH R1  POP R1  POP R0  RET
+SUBROUTINE = bytes([0b10000010, 1, 8, 0b01010000, 1, 0b00000001, 0xAA, 0xBB,
+                    0b01000101, 0, 0b01000101, 1, 0b01000110, 1, 0b01000110, 0, 0b00010001])
+
+
+def example(name):
+    with open(os.path.join(EXAMPLES, name)) as file:
+        return analyze(parse_program(file))
+
+
+class AnalyzeTest(unittest.TestCase):
+
+    def test_stack_depth(self):
+        analysis = analyze(SUBROUTINE)
+
+        self.assertEqual(analysis.calls, {3: 8})
+        # the subroutine pushes 2 bytes, the CALL itself 1 more
+        self.assertEqual(analysis.stack, {8: 2})
+        self.assertEqual(analysis.max_stack, 3)
+        self.assertTrue(analysis.ok)
+
+    def test_unreachable(self):
+        analysis = analyze(SUBROUTINE)
+
+        self.assertEqual(analysis.unreachable, [(6, 8)])
+        self.assertNotIn(6, analysis.instructions)
+        self.assertEqual(sorted(analysis.blocks), [0, 5, 8])
+
+        self.assertEqual(example("printstr.ls8").unreachable, [(38, 52)])    # the string
+        self.assertEqual(example("call.ls8").unreachable, [])
+
+    def test_recursion_has_no_limit(self):
+        analysis = example("fib.ls8")
+        self.assertIsNone(analysis.max_stack)
+        self.assertEqual(analysis.stack, {11: None})
+
+    def test_interrupt_handlers(self):
+        analysis = example("interrupts.ls8")
+        self.assertEqual(analysis.handlers, [17])
+        # PC, FL and R0-R6 go on the stack when an interrupt is taken
+        self.assertEqual(analysis.max_stack, 9)
+
+    def test_problems(self):
+        analysis = example("stackoverflow.ls8")
+        self.assertFalse(analysis.ok)
+        self.assertIn("the stack keeps growing", analysis.problems[0][1])
+
+        # LDI R0,5  JMP R9
+        self.assertEqual(analyze(bytes([0b10000010, 0, 5, 0b01010100, 9])).problems, [(3, "invalid register [R9]")])
+
+        self.assertEqual(analyze(bytes(300)).problems, [(0, "program of 300 bytes doesn't fit in RAM")])
+
+    def test_report(self):
+        out = io.StringIO()
+        report(analyze(SUBROUTINE), file=out)
+        self.assertIn("06-07", out.getvalue())
+        self.assertIn("stack: at most 3 bytes", out.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
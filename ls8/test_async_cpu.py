@@ -0,0 +1,73 @@
+"""async_cpu.py's serve_client over a real TCP connection."""
+
+import os
+import asyncio
+import unittest
+
+from async_cpu import serve_client
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+
+# LDI R0,7  PRN R0  LDI R1,8  8: JMP R1, never halts
+FOREVER = "\n".join(["10000010", "00000000", "00000111", "01000111", "00000000",
+                     "10000010", "00000001", "00001000", "01010100", "00000001"])
+
+
+def example(name):
+    with open(os.path.join(EXAMPLES, name)) as file:
+        return file.read()
+
+
+async def connect(program, client, max_cycles=None):
+    """Serves program on a local port, runs client(reader, writer) against it and waits for serve_client to end"""
+
+    served = asyncio.get_running_loop().create_future()
+
+    async def handle(reader, writer):
+        try:
+            await serve_client(program, reader, writer, max_cycles=max_cycles)
+        except Exception as error:
+            served.set_exception(error)
+        else:
+            served.set_result(None)
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    async with server:
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        received = await client(reader, writer)
+        await asyncio.wait_for(served, 5)
+    return received
+
+
+class ServeClientTest(unittest.TestCase):
+
+    def test_output_goes_to_the_client(self):
+        async def client(reader, writer):
+            received = await reader.read()
+            writer.close()
+            return received
+
+        self.assertEqual(asyncio.run(connect(example("printstr.ls8"), client)), b"Hello, world!\n")
+
+    def test_the_reason_is_sent_when_it_doesnt_halt(self):
+        async def client(reader, writer):
+            received = await reader.read()
+            writer.close()
+            return received
+
+        self.assertEqual(asyncio.run(connect(FOREVER, client, max_cycles=50)), b"7\nmax cycles\n")
+
+    def test_hanging_up_stops_the_machine(self):
+        # serve_client only ends because the client went away
+        async def client(reader, writer):
+            received = await reader.read(2)
+            writer.close()
+            return received
+
+        self.assertEqual(asyncio.run(connect(FOREVER, client)), b"7\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""CPU state: snapshots, restore() and fork(), and interrupts."""
+
+import os
+import unittest
+
+from cpu import CPU, IS
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+
+def loaded(name):
+    cpu = CPU()
+    cpu.load_file(os.path.join(EXAMPLES, name))
+    return cpu
+
+
+def state(cpu):
+    return cpu.snapshot(), cpu.output.getvalue()
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        cpu = loaded("fib.ls8")
+        cpu.run(500)
+        snapshot = cpu.snapshot()
+        self.assertEqual(len(snapshot), 282)
+
+        copy = CPU.from_snapshot(snapshot)
+        self.assertEqual(copy.snapshot(), snapshot)
+        self.assertEqual((copy.PC, copy.FL, copy.cycles, copy.reg, copy.ram),
+                         (cpu.PC, cpu.FL, cpu.cycles, cpu.reg, cpu.ram))
+
+        # both go on to the same end, the copy only has the output from after the snapshot
+        want = cpu.run()
+        got = copy.run()
+        self.assertEqual(got._replace(output=None), want._replace(output=None))
+        self.assertTrue(want.output.endswith(got.output))
+
+    def test_restore_over_a_running_program(self):
+        cpu = loaded("fib.ls8")
+        snapshot = cpu.snapshot()
+        first = cpu.run()
+
+        # the program changed RAM and the decoded cache, restore() has to undo both
+        cpu.restore(snapshot)
+        cpu.output.truncate(0)
+        cpu.output.seek(0)
+        self.assertEqual(cpu.run(), first)
+
+    def test_bad_snapshots(self):
+        cpu = loaded("fib.ls8")
+        cpu.run(100)
+        before = state(cpu)
+        snapshot = cpu.snapshot()
+
+        wrong_magic = b"XXXX" + snapshot[4:]
+        wrong_version = snapshot[:4] + b"\x63" + snapshot[5:]
+        for data in (snapshot[:-1], snapshot + b"\0", b"", wrong_magic, wrong_version):
+            with self.assertRaises(ValueError):
+                cpu.restore(data)
+            self.assertEqual(state(cpu), before)
+
+
+class ForkTest(unittest.TestCase):
+
+    def test_fork_is_independent(self):
+        cpu = loaded("fib.ls8")
+        cpu.run(300)
+        before = state(cpu)
+
+        fork = cpu.fork()
+        self.assertEqual(fork.snapshot(), cpu.snapshot())
+        self.assertEqual(fork.output.getvalue(), "")
+
+        finished = fork.run()
+        self.assertEqual(finished.reason, "HLT")
+        # running the fork changed nothing in the original
+        self.assertEqual(state(cpu), before)
+
+        self.assertEqual(cpu.run()._replace(output=None), finished._replace(output=None))
+
+    def test_forks_of_forks(self):
+        cpu = loaded("fib.ls8")
+        cpu.run(100)
+
+        forks = [cpu.fork() for _ in range(3)]
+        forks[0].reg[0] = 99
+        forks[1].ram[0x80] = 1
+        self.assertEqual((forks[2].reg[0], forks[2].ram[0x80]), (cpu.reg[0], cpu.ram[0x80]))
+
+        results = {fork.run().registers for fork in forks[1:]}
+        self.assertEqual(len(results), 1)
+
+
+class InterruptTest(unittest.TestCase):
+
+    # LDI R0,16  LDI R1,0xF8  ST R1,R0 (vector 0 -> 16)  LDI R5,1  LDI R6,1  HLT
+    # 16: LDI R2,42  PRN R2  HLT
+    # setting IS with LDI has to run the handler straight away, before the HLT right after it
+    SET_IS = bytes([0b10000010, 0, 16, 0b10000010, 1, 0xF8, 0b10000100, 1, 0, 0b10000010, 5, 1,
+                    0b10000010, 6, 1, 0b00000001, 0b10000010, 2, 42, 0b01000111, 2, 0b00000001])
+
+    def test_writing_IS_raises_an_interrupt(self):
+        for run in (CPU.run, CPU.run_blocks):
+            with self.subTest(run=run.__name__):
+                cpu = CPU()
+                cpu.load_bytes(self.SET_IS)
+                result = run(cpu, 100)
+                self.assertEqual((result.reason, result.output, result.cycles), ("HLT", "42\n", 8))
+                self.assertEqual(cpu.reg[IS], 0)
+
+    def test_masked_interrupt_waits(self):
+        # same without IM set, the handler never runs
+        code = bytearray(self.SET_IS)
+        code[11] = 0
+        cpu = CPU()
+        cpu.load_bytes(code)
+        result = cpu.run(100)
+        self.assertEqual((result.reason, result.output, result.cycles), ("HLT", "", 6))
+        self.assertEqual(cpu.reg[IS], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+Differential test: every example program (and a few broken ones) goes through each run engine and has to end up
+exactly where CPU.run() leaves it, same output, registers, FL, PC, cycle count, halt reason and RAM.
+Run it from this directory with python -m pytest or python -m unittest.
+"""
+
+import os
+import glob
+import unittest
+
+from cpu import CPU, NAMES
+from profiler import Profile
+from memo import Memo
+from fastforward import FastForward
+import lockstep
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "*.ls8")))
+
+# interrupts.ls8, keyboard.ls8 and loop.ls8 don't halt on their own
+MAX_CYCLES = 20000
+
+BROKEN = {
+    # LDI R0,5  PRN R0  JMP R9
+    "jump through R9": bytes([0b10000010, 0, 5, 0b01000111, 0, 0b01010100, 9]),
+    # LDI R0,5  INC R0  ADD R0,R12  HLT, the bad register is in the middle of a block
+    "add R12": bytes([0b10000010, 0, 5, 0b01100101, 0, 0b10100000, 0, 12, 0b00000001]),
+    # LDI R1,6  DIV R0,R1 (0 / 6)  MOD R1,R0 (6 % 0)  HLT
+    "division by zero": bytes([0b10000010, 1, 6, 0b10100011, 0, 1, 0b10100100, 1, 0, 0b00000001]),
+    "invalid instruction": bytes([0b10000010, 0, 1, 0b11111111]),
+}
+
+# programs that only exist to check one thing the engines have to get right
+TRICKY = {
+    # LDI R0,11  LDI R1,7  ST R0,R1  LDI R2,5  PRN R2  HLT, the ST changes the 5 to a 7 right before it runs
+    "self-modifying": bytes([0b10000010, 0, 11, 0b10000010, 1, 7, 0b10000100, 0, 1, 0b10000010, 2, 5,
+                             0b01000111, 2, 0b00000001]),
+}
+
+
+def programs():
+    """(name, a function that loads it into a CPU) for every program the engines are checked with"""
+
+    for path in EXAMPLES:
+        yield os.path.basename(path), lambda cpu, path=path: cpu.load_file(path)
+    for name, code in {**TRICKY, **BROKEN}.items():
+        yield name, lambda cpu, code=code: cpu.load_bytes(code)
+
+
+def loaded(load):
+    cpu = CPU()
+    load(cpu)
+    return cpu
+
+
+def uses_interrupts(load):
+    """True if the program runs INT or IRET, the lockstep engine doesn't do interrupts"""
+
+    profile = Profile()
+    loaded(load).run(MAX_CYCLES, profile=profile)
+    return any(profile.opcodes[opcode] for opcode, name in NAMES.items() if name in ("INT", "IRET"))
+
+
+class EngineTest(unittest.TestCase):
+
+    def check(self, run, interrupts=True):
+        """
+        run(cpu) runs a freshly loaded CPU with the engine being tested, it has to return its RunResult
+        (and leave the final RAM in the CPU). Without interrupts the programs that use them are left out.
+        """
+
+        for name, load in programs():
+            if not interrupts and uses_interrupts(load):
+                continue
+            with self.subTest(program=name):
+                expected = loaded(load)
+                want = expected.run(MAX_CYCLES)
+
+                cpu = loaded(load)
+                self.assertEqual(run(cpu), want)
+                self.assertEqual(cpu.ram, expected.ram)
+
+    def test_broken_programs_stop_with_a_reason(self):
+        for name, code in BROKEN.items():
+            cpu = CPU()
+            cpu.load_bytes(code)
+            self.assertNotEqual(cpu.run(MAX_CYCLES).reason, "HLT", name)
+
+        cpu = CPU()
+        cpu.load_bytes(BROKEN["jump through R9"])
+        result = cpu.run(MAX_CYCLES)
+        self.assertEqual((result.reason, result.output, result.cycles), ("invalid register [R9]", "5\n", 2))
+
+    def test_blocks(self):
+        self.check(lambda cpu: cpu.run_blocks(MAX_CYCLES))
+
+    @unittest.skipIf(lockstep.np is None, "the lockstep engine needs numpy")
+    def test_lockstep(self):
+        def run(cpu):
+            engine = lockstep.Lockstep.from_cpu(cpu, 1)
+            result = engine.run(MAX_CYCLES)[0]
+            cpu.ram[:] = engine.ram[0].tobytes()
+            return result
+
+        self.check(run, interrupts=False)
+
+    def test_fastforward(self):
+        self.check(lambda cpu: cpu.run(MAX_CYCLES, engine=FastForward()))
+
+    def test_memo(self):
+        def run(cpu):
+            # a first run on a copy fills the cache, so the checked run skips the calls it can
+            memo = Memo()
+            cpu.fork().run(MAX_CYCLES, engine=memo)
+            return cpu.run(MAX_CYCLES, engine=memo)
+
+        self.check(run)
+
+    def test_memo_gives_up_on_a_call_site_that_keeps_missing(self):
+        # LDI R0,0  LDI R1,15  LDI R2,9  9: INC R0  CALL R1  JMP R2  15: ADD R3,R0  RET, a new argument every call
+        code = bytes([0b10000010, 0, 0, 0b10000010, 1, 15, 0b10000010, 2, 9, 0b01100101, 0, 0b01010000, 1,
+                      0b01010100, 2, 0b10100000, 3, 0, 0b00010001])
+        expected = CPU()
+        expected.load_bytes(code)
+
+        memo = Memo()
+        cpu = CPU()
+        cpu.load_bytes(code)
+        self.assertEqual(cpu.run(MAX_CYCLES, engine=memo), expected.run(MAX_CYCLES))
+
+        stats = memo.stats()
+        self.assertEqual((stats.hits, stats.cold), (0, 1))
+        self.assertLess(stats.misses, 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Binary program images (.ls8b): image.py and loading them into a CPU."""
+
+import os
+import tempfile
+import unittest
+
+from cpu import CPU
+from image import Image, read_image, write_image, MAGIC
+
+# LDI R0,8  PRN R0  HLT
+CODE = bytes([0b10000010, 0, 8, 0b01000111, 0, 0b00000001])
+
+
+class ImageTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        symbols = {"START": 0, "PRINT": 3}
+        source_map = {0: 4, 3: 5, 5: 7}
+        data = write_image(CODE, 0, symbols, source_map)
+
+        self.assertTrue(data.startswith(MAGIC))
+        self.assertEqual(read_image(data), Image(CODE, 0, symbols, source_map))
+        self.assertEqual(read_image(memoryview(data)), read_image(bytearray(data)))
+        self.assertEqual(read_image(write_image(CODE)), Image(CODE, 0, {}, {}))
+
+    def test_no_header_is_raw_code(self):
+        self.assertEqual(read_image(CODE), Image(CODE, 0, {}, {}))
+        # a magic that's nearly right isn't a header either
+        self.assertEqual(read_image(b"LS8X" + CODE), Image(b"LS8X" + CODE, 0, {}, {}))
+
+    def test_broken_images(self):
+        data = write_image(CODE, 0, {"START": 0}, {0: 1})
+        wrong_version = data[:4] + bytes([99]) + data[5:]
+
+        for broken in (data[:8], data[:-1], data[:len(data) - 3], wrong_version):
+            with self.assertRaises(ValueError):
+                read_image(broken)
+
+    def test_load(self):
+        # LDI R0,8 at 0 is skipped, the entry point is the PRN
+        data = write_image(CODE, 3)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "program.ls8b")
+            with open(path, "wb") as file:
+                file.write(data)
+
+            cpu = CPU()
+            self.assertEqual(cpu.load_file(path), len(CODE))
+            self.assertEqual(cpu.PC, 3)
+            self.assertEqual(cpu.run().output, "0\n")
+
+            # a .ls8 name doesn't matter, the header says it's an image
+            text_path = os.path.join(directory, "program.ls8")
+            os.rename(path, text_path)
+            cpu = CPU()
+            cpu.load_file(text_path)
+            self.assertEqual(cpu.ram[:len(CODE)], CODE)
+
+    def test_load_raw_code(self):
+        # .ls8b without the header, the code starts at 0
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "program.ls8b")
+            with open(path, "wb") as file:
+                file.write(CODE)
+
+            cpu = CPU()
+            self.assertEqual(cpu.load_file(path), len(CODE))
+            self.assertEqual((cpu.PC, cpu.run().output), (0, "8\n"))
+
+    def test_too_big(self):
+        with self.assertRaises(ValueError):
+            CPU().load_image(write_image(bytes(300)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Run deadlines and the round robin Scheduler."""
+
+import os
+import time
+import unittest
+
+from cpu import CPU
+from scheduler import Scheduler
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+# LDI R0,3  JMP R0, never halts
+FOREVER = bytes([0b10000010, 0, 3, 0b01010100, 0])
+
+
+def forever():
+    cpu = CPU()
+    cpu.load_bytes(FOREVER)
+    return cpu
+
+
+def example(name):
+    cpu = CPU()
+    cpu.load_file(os.path.join(EXAMPLES, name))
+    return cpu
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_deadline(self):
+        for run in (CPU.run, CPU.run_blocks):
+            with self.subTest(run=run.__name__):
+                cpu = forever()
+                start = time.monotonic()
+                result = run(cpu, deadline=start + 0.05)
+                took = time.monotonic() - start
+
+                self.assertEqual(result.reason, "deadline")
+                self.assertGreaterEqual(took, 0.05)
+                self.assertLess(took, 1)
+
+                # and it goes on from there
+                self.assertEqual(run(cpu, 10).cycles, result.cycles + 10)
+
+    def test_deadline_in_the_past(self):
+        # still runs up to one clock check, then stops
+        result = forever().run(deadline=time.monotonic() - 1)
+        self.assertEqual(result.reason, "deadline")
+
+    def test_halting_before_the_deadline(self):
+        result = example("printstr.ls8").run(deadline=time.monotonic() + 10)
+        self.assertEqual((result.reason, result.output), ("HLT", "Hello, world!\n"))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_round_robin(self):
+        scheduler = Scheduler(slice_time=10, slice_cycles=100)
+        tasks = [scheduler.add(forever(), name) for name in "abc"]
+
+        order = [scheduler.step().name for _ in range(9)]
+        self.assertEqual(order, list("abcabcabc"))
+        # every slice is the same size, so they all got the same share
+        self.assertEqual([task.cycles for task in tasks], [300, 300, 300])
+        self.assertEqual([task.cpu.cycles for task in tasks], [300, 300, 300])
+        self.assertTrue(all(task.result is None for task in tasks))
+
+    def test_budgets(self):
+        scheduler = Scheduler(slice_time=0.01, slice_cycles=1000)
+        cycles = scheduler.add(forever(), "cycles", max_cycles=2500)
+        timeout = scheduler.add(forever(), "timeout", timeout=0.05)
+        halts = scheduler.add(example("printstr.ls8"), "halts")
+
+        done = scheduler.run()
+
+        # printstr.ls8 halts in its first slice, the others go round until their budgets run out
+        self.assertIs(done[0], halts)
+        self.assertEqual(len(done), 3)
+        self.assertEqual((halts.result.reason, halts.result.output), ("HLT", "Hello, world!\n"))
+        self.assertEqual((cycles.result.reason, cycles.cycles, cycles.result.cycles), ("max cycles", 2500, 2500))
+        self.assertEqual(timeout.result.reason, "timeout")
+        self.assertGreaterEqual(timeout.time, 0.05)
+
+    def test_a_crash_only_stops_that_task(self):
+        scheduler = Scheduler(slice_cycles=100)
+        broken = scheduler.add(forever(), "broken")
+        broken.run = lambda *args, **kwargs: 1 / 0
+        fine = scheduler.add(example("printstr.ls8"), "fine")
+
+        scheduler.run()
+
+        self.assertTrue(broken.result.reason.startswith("crashed: ZeroDivisionError"))
+        self.assertEqual(fine.result.reason, "HLT")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""server.py and client.py over a real Unix socket, with one warm worker."""
+
+import os
+import errno
+import socket
+import tempfile
+import threading
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+import server
+from client import Client
+
+PRINTSTR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "printstr.ls8")
+
+
+def serve(path):
+    """A Server on path answering in a thread, shut it down with stop()"""
+
+    running = server.Server(path, workers=1, timeout=5)
+    threading.Thread(target=running.serve_forever, daemon=True).start()
+    return running
+
+
+def stop(running):
+    running.shutdown()
+    running.server_close()
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "ls8.sock")
+        self.server = serve(self.path)
+
+    def tearDown(self):
+        stop(self.server)
+        self.directory.cleanup()
+
+    def run_program(self, path=None):
+        with open(PRINTSTR, "rb") as file:
+            program = file.read()
+        with Client(path or self.path) as client:
+            return client.run(program)
+
+    def test_runs_a_program(self):
+        reply = self.run_program()
+        self.assertEqual((reply["output"], reply["status"], reply["reason"]), ("Hello, world!\n", 0, "HLT"))
+
+    def test_a_live_socket_is_not_taken_over(self):
+        with self.assertRaises(OSError) as raised:
+            server.Server(self.path, workers=1)
+        self.assertEqual(raised.exception.errno, errno.EADDRINUSE)
+
+        # the first server still has its socket
+        self.assertEqual(self.run_program()["status"], 0)
+
+    def test_a_stale_socket_is_replaced(self):
+        path = os.path.join(self.directory.name, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+        self.assertFalse(server.listening(path))
+
+        other = serve(path)
+        try:
+            self.assertEqual(self.run_program(path)["status"], 0)
+        finally:
+            stop(other)
+        self.assertFalse(os.path.exists(path))
+
+    def test_a_dead_worker_is_replaced(self):
+        with self.assertRaises(BrokenProcessPool):
+            self.server.pool.submit(os._exit, 1).result()
+
+        self.assertEqual(self.run_program()["output"], "Hello, world!\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Recording traces with tracer.Recorder, reading them back and replaying them."""
+
+import io
+import os
+import tempfile
+import unittest
+
+from cpu import CPU
+import tracer
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+
+
+def loaded(name):
+    cpu = CPU()
+    cpu.load_file(os.path.join(EXAMPLES, name))
+    return cpu
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_recording_doesnt_change_the_run(self):
+        for name in ("fib.ls8", "printstr.ls8", "stack.ls8"):
+            with self.subTest(program=name):
+                self.assertEqual(loaded(name).run(engine=tracer.Recorder(1024)), loaded(name).run())
+
+    def test_record_and_replay(self):
+        cpu = loaded("fib.ls8")
+        cpu.run(100)
+        recorder = tracer.Recorder(16384)
+        result = cpu.run(engine=recorder)
+        trace = recorder.trace()
+
+        # every instruction from where the recording started, the last one left the final state
+        self.assertEqual([record.cycle for record in trace.records], list(range(101, result.cycles + 1)))
+        self.assertEqual(tracer.start_cycle(trace), 100)
+        self.assertEqual(trace.records[-1].registers, result.registers)
+        self.assertEqual(trace.records[-1].IR, 0b00000001)
+
+        out = io.StringIO()
+        self.assertTrue(tracer.replay(trace, file=out))
+        self.assertIn(f"replayed {len(trace.records)} instructions", out.getvalue())
+
+    def test_replay_finds_a_difference(self):
+        recorder = tracer.Recorder(1024)
+        loaded("printstr.ls8").run(engine=recorder)
+        trace = recorder.trace()
+
+        records = list(trace.records)
+        records[10] = records[10]._replace(registers=bytes(8))
+        out = io.StringIO()
+        self.assertFalse(tracer.replay(trace._replace(records=records), file=out))
+        self.assertIn(f"replay differs at cycle {records[10].cycle}", out.getvalue())
+
+        out = io.StringIO()
+        self.assertEqual(tracer.diff(trace, trace._replace(records=records), file=out), records[10].cycle)
+
+    def test_ring_wraps_around(self):
+        recorder = tracer.Recorder(16)
+        cpu = loaded("fib.ls8")
+        result = cpu.run(100, engine=recorder)
+        trace = recorder.trace()
+
+        # only the last 16 are kept, oldest first
+        self.assertEqual([record.cycle for record in trace.records], list(range(85, 101)))
+        self.assertEqual(trace.records[-1].registers, result.registers)
+        self.assertIsNone(tracer.registers_before(trace))
+        self.assertFalse(tracer.replay(trace, file=io.StringIO()))
+
+        # going on with the same recorder keeps wrapping
+        cpu.run(20, engine=recorder)
+        self.assertEqual([record.cycle for record in recorder.trace().records], list(range(105, 121)))
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fib.trace")
+            recorder = tracer.Recorder(8192, path)
+            loaded("fib.ls8").run(engine=recorder)
+            trace = recorder.trace()
+            recorder.close()
+
+            self.assertEqual(tracer.read_trace_file(path), trace)
+            self.assertTrue(tracer.replay(trace, file=io.StringIO()))
+
+    def test_not_a_trace(self):
+        for data in (b"", b"LS8X" + bytes(400), tracer.Recorder(16).data[:-1]):
+            with self.assertRaises(ValueError):
+                tracer.read_trace(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
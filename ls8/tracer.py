@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+Execution trace recorder. Every instruction goes into a fixed size ring buffer as a small binary record,
+in memory or in a memory mapped file, and the tools here decode, replay and diff the traces afterwards.
+"""
+
+import sys
+import mmap
+import struct
+import argparse
+from collections import namedtuple
+
+from cpu import CPU, NAMES, SNAPSHOT
+
+# trace file: header, the snapshot of the CPU when the recording started, then the ring buffer
+HEADER = struct.Struct("<4sBI")         # magic, format version, capacity (records)
+MAGIC = b"LS8T"
+VERSION = 2
+SNAPSHOT_SIZE = SNAPSHOT.size + 8 + 256
+
+# one per instruction: cycle number, PC, IR, the 2 bytes after it, FL and R0-R7 after it ran.
+# Slots that were never written have cycle 0 (a recorded instruction is at least cycle 1), the cycle numbers
+# also give the order after the buffer wraps around. They're 64 bits like CPU.cycles in the snapshot, so they never wrap
+RECORD = struct.Struct("<QBBBBB8s")
+
+Record = namedtuple("Record", ["cycle", "PC", "IR", "a", "b", "FL", "registers"])
+
+# capacity: slots in the ring, snapshot: CPU state before the first recorded instruction
+# records: the ones that are still in the ring, oldest first
+Trace = namedtuple("Trace", ["capacity", "snapshot", "records"])
+
+
+class Recorder:
+    """
+    Records what a CPU runs with CPU.run(engine=recorder), or recorder.run(cpu).
+
+    The last capacity instructions are kept. With a path the ring buffer is a memory mapped file that's
+    always up to date, so it's still there to look at if the process dies.
+    """
+
+    def __init__(self, capacity=65536, path=None):
+        self.capacity = capacity
+        self.slot = 0               # where the next record goes
+        self.started = False
+        size = HEADER.size + SNAPSHOT_SIZE + capacity * RECORD.size
+
+        if path is None:
+            self.file = None
+            self.data = bytearray(size)
+        else:
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+            self.data = mmap.mmap(self.file.fileno(), size)
+
+        HEADER.pack_into(self.data, 0, MAGIC, VERSION, capacity)
+        self.buffer = memoryview(self.data)[HEADER.size + SNAPSHOT_SIZE:]
+
+    def run(self, cpu, max_cycles=None, deadline=None):
+        """Same as CPU.run() but recording every instruction"""
+
+        if not self.started:
+            self.data[HEADER.size:HEADER.size + SNAPSHOT_SIZE] = cpu.snapshot()
+            self.started = True
+
+        return cpu.execute(lambda limit: self.loop(cpu, limit), max_cycles, deadline)
+
+    def loop(self, cpu, limit):
+        """CPU.hooked_loop() with hooks that write a record after every instruction"""
+
+        ram = cpu.ram
+        reg = cpu.reg
+        buffer = self.buffer
+        pack = RECORD.pack_into
+        size = RECORD.size
+        capacity = self.capacity
+        fetched = None
+
+        def before(PC):
+            nonlocal fetched
+            # read before it runs, an instruction can overwrite itself
+            fetched = ram[PC], ram[(PC + 1) & 0xFF], ram[(PC + 2) & 0xFF]
+
+        def after(PC):
+            slot = self.slot
+            pack(buffer, slot * size, cpu.cycles, PC, *fetched, cpu.FL, reg)
+            self.slot = slot + 1 if slot + 1 < capacity else 0
+
+        cpu.hooked_loop(limit, before, after)
+
+    def trace(self):
+        """The recording so far as a Trace"""
+        return read_trace(self.data)
+
+    def save(self, path):
+        """Writes the recording to a file (a recorder with a path already is one)"""
+
+        with open(path, "wb") as file:
+            file.write(self.data)
+
+    def close(self):
+        if self.file is not None:
+            self.buffer.release()
+            self.data.close()
+            self.file.close()
+            self.file = None
+
+
+def read_trace(data):
+    """Decodes a trace file (or a Recorder's buffer), raises ValueError if it isn't one"""
+
+    data = memoryview(data)
+
+    try:
+        magic, version, capacity = HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("not an LS-8 trace")
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an LS-8 trace")
+
+    snapshot = bytes(data[HEADER.size:HEADER.size + SNAPSHOT_SIZE])
+    start = HEADER.size + SNAPSHOT_SIZE
+
+    if len(data) < start + capacity * RECORD.size:
+        raise ValueError("trace is truncated")
+
+    records = [Record(*fields) for fields in RECORD.iter_unpack(data[start:start + capacity * RECORD.size])
+               if fields[0] != 0]
+    records.sort(key=lambda record: record.cycle)
+
+    return Trace(capacity, snapshot, records)
+
+
+def read_trace_file(path):
+    with open(path, "rb") as file:
+        return read_trace(file.read())
+
+
+def registers_before(trace):
+    """Registers before the first record that's still in the ring, None if they aren't known any more"""
+
+    if trace.records and trace.records[0].cycle == start_cycle(trace) + 1:
+        return bytes(CPU.from_snapshot(trace.snapshot).reg)
+    return None
+
+
+def start_cycle(trace):
+    return SNAPSHOT.unpack_from(trace.snapshot)[-1]
+
+
+def describe(record, before=None):
+    """One line for a record: cycle, address, instruction and what it changed"""
+
+    name = NAMES.get(record.IR, f"{record.IR:08b}")
+    operands = (record.IR >> 6)
+    if operands == 1:
+        name += f" {record.a:02X}"
+    elif operands == 2:
+        name += f" {record.a:02X},{record.b:02X}"
+
+    if before is None:
+        changes = " ".join(f"R{n}={value:02X}" for n, value in enumerate(record.registers))
+    else:
+        changes = " ".join(f"R{n}={value:02X}" for n, (value, old) in enumerate(zip(record.registers, before))
+                           if value != old)
+
+    return f"{record.cycle:10} {record.PC:02X}  {name:14} FL={record.FL:03b}  {changes}".rstrip()
+
+
+def show(trace, last=None, file=sys.stdout):
+    """Prints the records, only the last ones if last is given"""
+
+    records = trace.records
+    before = registers_before(trace)
+
+    if last is not None and len(records) > last:
+        before = records[-last - 1].registers
+        records = records[-last:]
+
+    for record in records:
+        print(describe(record, before), file=file)
+        before = record.registers
+
+
+def same(a, b):
+    """Records that ran the same instruction with the same result"""
+    return a[1:] == b[1:]
+
+
+def diff(first, second, context=5, file=sys.stdout):
+    """
+    Compares two traces cycle by cycle where they overlap and prints the first place they went different ways
+    with context records before it. Returns the cycle number where they differ or None.
+    """
+
+    records = {record.cycle: record for record in second.records}
+    previous = []
+
+    for record in first.records:
+        other = records.get(record.cycle)
+        if other is None:
+            continue
+
+        if not same(record, other):
+            print(f"traces differ at cycle {record.cycle}:", file=file)
+            for earlier in previous[-context:]:
+                print("  " + describe(earlier), file=file)
+            print("< " + describe(record), file=file)
+            print("> " + describe(other), file=file)
+            return record.cycle
+
+        previous.append(record)
+
+    print(f"traces are the same for the {len(previous)} cycles both have", file=file)
+    return None
+
+
+def replay(trace, file=sys.stdout):
+    """
+    Runs the program again from the snapshot one instruction at a time and checks every step against the trace.
+    Only works if the ring still has everything from the start. Returns True if they all match.
+    Interrupts from devices aren't in the trace, a program that used them won't replay the same.
+    """
+
+    if registers_before(trace) is None:
+        print("the start of the trace was overwritten, it can't be replayed", file=file)
+        return False
+
+    cpu = CPU.from_snapshot(trace.snapshot)
+
+    for record in trace.records:
+        PC = cpu.PC
+        IR, a, b = cpu.ram[PC], cpu.ram[(PC + 1) & 0xFF], cpu.ram[(PC + 2) & 0xFF]
+        result = cpu.run(1)
+        replayed = Record(cpu.cycles, PC, IR, a, b, cpu.FL, bytes(cpu.reg))
+
+        if not same(replayed, record):
+            print(f"replay differs at cycle {record.cycle}:", file=file)
+            print("  trace:  " + describe(record), file=file)
+            print("  replay: " + describe(replayed), file=file)
+            return False
+
+        if result.reason not in ("max cycles", None):
+            break
+
+    print(f"replayed {len(trace.records)} instructions, all the same", file=file)
+    return True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Record and look at LS-8 execution traces.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="run a program recording a trace")
+    record.add_argument("program", help=".ls8 or .ls8b file")
+    record.add_argument("trace", help="trace file to write")
+    record.add_argument("-n", "--capacity", type=int, default=65536, help="instructions the ring buffer keeps")
+    record.add_argument("--max-cycles", type=int, default=None, help="stop after this many instructions")
+
+    show_command = commands.add_parser("show", help="print a trace")
+    show_command.add_argument("trace")
+    show_command.add_argument("-n", "--last", type=int, default=None, help="only the last N instructions")
+
+    diff_command = commands.add_parser("diff", help="find where two traces of the same program differ")
+    diff_command.add_argument("first")
+    diff_command.add_argument("second")
+
+    replay_command = commands.add_parser("replay", help="run the program again and check it against the trace")
+    replay_command.add_argument("trace")
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        if args.command == "record":
+            cpu = CPU(output=sys.stdout)
+            cpu.load_file(args.program)
+            recorder = Recorder(args.capacity, args.trace)
+            try:
+                result = cpu.run(args.max_cycles, engine=recorder)
+            finally:
+                recorder.close()
+            print(f"{result.reason}, {result.cycles} cycles", file=sys.stderr)
+            return 0
+
+        if args.command == "show":
+            show(read_trace_file(args.trace), args.last)
+            return 0
+
+        if args.command == "diff":
+            return 0 if diff(read_trace_file(args.first), read_trace_file(args.second)) is None else 1
+
+        return 0 if replay(read_trace_file(args.trace)) else 1
+
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))